@@ -1,6 +1,7 @@
 from datetime import date, timedelta
 from functools import wraps
 
+from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured, PermissionDenied
 from django.contrib import auth, messages
 from django.contrib.auth.backends import ModelBackend
@@ -8,7 +9,7 @@ from django.contrib.auth.views import redirect_to_login
 from django.utils.decorators import available_attrs
 from django.utils.translation import ugettext_lazy as _
 
-from evap.evaluation.models import UserProfile, EmailTemplate
+from evap.evaluation.models import UserProfile, UserRoles, EmailTemplate, get_user_roles_version
 
 
 class RequestAuthMiddleware(object):
@@ -76,6 +77,35 @@ class RequestAuthMiddleware(object):
             messages.warning(request, _("Invalid login URL. Please request a new one below."))
 
 
+class UserRolesMiddleware(object):
+    """
+    Middleware for keeping the roles of request.user in the session.
+
+    The roles of a user are loaded with a single query when they are first
+    needed in a request, see UserProfile.roles. If USER_ROLES_SESSION_CACHE is
+    enabled, they are stored in the session together with the user's current
+    roles version and reused until their roles change.
+    """
+
+    session_key = "user_roles"
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if settings.USER_ROLES_SESSION_CACHE and request.user.is_authenticated:
+            self.process_request(request)
+        return self.get_response(request)
+
+    def process_request(self, request):
+        version = get_user_roles_version(request.user.id)
+        stored_roles = request.session.get(self.session_key)
+        if stored_roles and stored_roles['user_id'] == request.user.id and stored_roles['version'] == version:
+            request.user.roles = UserRoles(*stored_roles['roles'])
+        else:
+            request.session[self.session_key] = dict(user_id=request.user.id, version=version, roles=list(request.user.roles))
+
+
 class RequestAuthUserBackend(ModelBackend):
     """
     The RequestAuthBackend works together with the RequestAuthMiddleware to
@@ -0,0 +1,190 @@
+"""A two-tier cache for values that are expensive to load from the shared cache.
+
+Looking up a value in the shared cache (the database cache by default) costs
+a query and unpickling the cache entry, so every process additionally keeps
+recently used values in an in-memory LRU cache that is limited by the number
+of entries and their size. The size of an entry is estimated by the length of
+its pickled value, which is computed once when the entry is stored.
+
+Every value in the shared cache is stored together with a version token,
+which is replaced whenever the value is set or deleted. Local entries remember
+the token of the value they have been loaded from and are dropped when it has
+changed, so a change only drops the entries of its own key. The token of a key
+is compared at its first lookup within a request, and on every lookup outside
+of requests (e.g. in management commands). Random tokens are used instead of incremented
+numbers, because the database cache can't increment atomically and might cull
+the entries. A missing token drops the local entries of its key.
+"""
+
+import pickle
+import threading
+from collections import OrderedDict
+from uuid import uuid4
+
+from django.core.cache import cache
+
+
+class TwoTierCache:
+    """Connect `request_started` and `request_finished` to the methods of the
+    same name, so that the versions are checked once per request. The version
+    tokens are stored under `version_key_prefix` followed by the key."""
+
+    def __init__(self, version_key_prefix, max_entries, max_bytes):
+        self._version_key_prefix = version_key_prefix
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (value, source key, version, size), least recently used first
+        self._bytes = 0
+        # whether the current thread is handling a request and the keys whose versions it has checked in it
+        self._request_state = threading.local()
+        self._lock = threading.RLock()
+        self.reset_statistics()
+
+    def get_many(self, keys):
+        """Returns a dict mapping those of the given keys that are cached to their values."""
+        values = {}
+        with self._lock:
+            self._check_versions(keys)
+            for key in keys:
+                if key in self._entries:
+                    self._entries.move_to_end(key)
+                    values[key] = self._entries[key][0]
+            self.hits += len(values)
+
+        missing_keys = [key for key in keys if key not in values]
+        if not missing_keys:
+            return values
+
+        shared_values = cache.get_many(missing_keys + [self._version_key(key) for key in missing_keys])
+        with self._lock:
+            self.misses += len(missing_keys)
+            for key in missing_keys:
+                if key not in shared_values:
+                    continue
+                values[key] = shared_values[key]
+                version = shared_values.get(self._version_key(key))
+                if version is not None:
+                    self._store(key, values[key], key, version)
+                    self._mark_checked(key)
+        return values
+
+    def set_many(self, data):
+        """Caches the given values, replacing those cached before."""
+        versions = {key: uuid4().hex for key in data}
+        shared_data = dict(data)
+        shared_data.update({self._version_key(key): version for key, version in versions.items()})
+        cache.set_many(shared_data, None)
+        with self._lock:
+            for key, value in data.items():
+                self._remove_derived(key)
+                self._store(key, value, key, versions[key])
+                self._mark_checked(key)
+
+    def set(self, key, value):
+        self.set_many({key: value})
+
+    def delete(self, key):
+        cache.delete_many([key, self._version_key(key)])
+        with self._lock:
+            self._remove_derived(key)
+
+    def get_local(self, key):
+        """Returns a value stored with `set_local` or `None`."""
+        with self._lock:
+            self._check_versions([key])
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key][0]
+
+    def set_local(self, key, value, source_key):
+        """Stores a value derived from the cached value of `source_key` only in
+        this process. It is dropped together with the local entry of
+        `source_key` and isn't stored if that entry doesn't exist."""
+        with self._lock:
+            if source_key in self._entries:
+                self._store(key, value, source_key, self._entries[source_key][2])
+
+    def clear_local(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def reset_statistics(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.evicted_bytes = 0
+        self.invalidations = 0
+
+    def statistics(self):
+        """Returns the statistics of this process' local cache."""
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'evicted_bytes': self.evicted_bytes,
+                'invalidations': self.invalidations,
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+            }
+
+    def request_started(self, **kwargs):
+        self._request_state.in_request = True
+        self._request_state.checked_keys = set()
+
+    def request_finished(self, **kwargs):
+        self._request_state.in_request = False
+
+    def _version_key(self, key):
+        return self._version_key_prefix + key
+
+    def _check_versions(self, keys):
+        """Drops the local entries of the given keys whose values have changed
+        in the shared cache, together with the entries derived from the same values."""
+        source_keys = {self._entries[key][1] for key in keys if key in self._entries}
+        if getattr(self._request_state, 'in_request', False):
+            source_keys -= self._request_state.checked_keys
+            self._request_state.checked_keys.update(source_keys)
+        if not source_keys:
+            return
+
+        versions = cache.get_many([self._version_key(source_key) for source_key in source_keys])
+        outdated_keys = [
+            key for key, (__, source_key, version, __) in self._entries.items()
+            if source_key in source_keys and versions.get(self._version_key(source_key)) != version
+        ]
+        for key in outdated_keys:
+            self._remove(key)
+        self.invalidations += len(outdated_keys)
+
+    def _mark_checked(self, key):
+        if getattr(self._request_state, 'in_request', False):
+            self._request_state.checked_keys.add(key)
+
+    def _remove_derived(self, source_key):
+        for key in [key for key, (__, entry_source_key, __, __) in self._entries.items() if entry_source_key == source_key]:
+            self._remove(key)
+
+    def _remove(self, key):
+        self._bytes -= self._entries.pop(key)[3]
+
+    def _store(self, key, value, source_key, version):
+        if key in self._entries:
+            self._remove(key)
+        size = len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        if self.max_entries == 0 or size > self.max_bytes:
+            return
+        while len(self._entries) >= self.max_entries or self._bytes + size > self.max_bytes:
+            __, (__, __, __, evicted_size) = self._entries.popitem(last=False)
+            self._bytes -= evicted_size
+            self.evictions += 1
+            self.evicted_bytes += evicted_size
+        self._entries[key] = (value, source_key, version, size)
+        self._bytes += size
+
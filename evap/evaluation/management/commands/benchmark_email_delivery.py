@@ -0,0 +1,37 @@
+from timeit import default_timer
+
+from django.conf import settings
+from django.core import mail
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+
+from evap.evaluation.models import EmailTemplate, UserProfile
+
+
+class Command(BaseCommand):
+    args = ''
+    help = ('Measures how many emails per second are rendered and sent with different numbers of emails per connection. '
+            'Uses the in-memory email backend by default, use --backend to send the emails e.g. to a local SMTP debugging server.')
+    requires_migrations_checks = True
+
+    def add_arguments(self, parser):
+        parser.add_argument('--recipients', type=int, default=1000, help='Number of emails sent in each run')
+        parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, settings.EMAIL_BATCH_SIZE], help='Numbers of emails per connection to compare')
+        parser.add_argument('--backend', default='django.core.mail.backends.locmem.EmailBackend', help='Email backend used for sending')
+
+    def handle(self, *args, **options):
+        template = EmailTemplate.objects.get(name=EmailTemplate.EVALUATION_STARTED)
+        # the users are not saved, internal email addresses make sure that no login keys are generated for them
+        domain = settings.INSTITUTION_EMAIL_DOMAINS[0]
+        users = [UserProfile(username="benchmark{}".format(i), email="benchmark{}@{}".format(i, domain)) for i in range(options['recipients'])]
+
+        for batch_size in options['batch_sizes']:
+            recipients = [(user, {}, {'user': user, 'courses': []}) for user in users]
+            with override_settings(EMAIL_BACKEND=options['backend'], EMAIL_BATCH_SIZE=batch_size):
+                start = default_timer()
+                failed_users = EmailTemplate.send_to_users(template, recipients, use_cc=False, send_immediately=True)
+                duration = default_timer() - start
+                mail.outbox = []
+
+            self.stdout.write("{} emails per connection: {} emails in {:.2f} s, {:.0f} emails per second, {} failed emails".format(
+                batch_size, len(users), duration, len(users) / duration, len(failed_users)))
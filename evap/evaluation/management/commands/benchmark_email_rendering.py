@@ -0,0 +1,43 @@
+from timeit import default_timer
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.template import Context, Template
+
+from evap.evaluation.models import EmailTemplate, UserProfile, compile_email_template
+
+
+class Command(BaseCommand):
+    args = ''
+    help = 'Compares the time per recipient for rendering an email template when it is compiled for each recipient and when it is compiled once'
+    requires_migrations_checks = True
+
+    def add_arguments(self, parser):
+        parser.add_argument('--recipients', type=int, default=3000, help='Number of recipients the template is rendered for')
+        parser.add_argument('--template', default=EmailTemplate.STUDENT_REMINDER, help='Name of the email template')
+
+    def handle(self, *args, **options):
+        template = EmailTemplate.objects.get(name=options['template'])
+        # the users are not saved, internal email addresses make sure that no login keys are generated for them
+        domain = settings.INSTITUTION_EMAIL_DOMAINS[0]
+        users = [UserProfile(username="benchmark{}".format(i), email="benchmark{}@{}".format(i, domain)) for i in range(options['recipients'])]
+
+        def render(compile_template):
+            for user in users:
+                params = {'user': user, 'login_url': "", 'first_due_in_days': 2, 'due_courses': [], 'courses': []}
+                for text in [template.subject, template.body]:
+                    compile_template(text).render(Context(params, autoescape=False))
+
+        compile_email_template.cache_clear()
+        uncached_duration = self.measure(render, Template)
+        cached_duration = self.measure(render, compile_email_template)
+
+        for name, duration in [("Compiled for each recipient", uncached_duration), ("Compiled once", cached_duration)]:
+            self.stdout.write("{}: {} recipients in {:.2f} s, {:.3f} ms per recipient".format(
+                name, len(users), duration, duration / len(users) * 1000))
+
+    @staticmethod
+    def measure(function, *args):
+        start = default_timer()
+        function(*args)
+        return default_timer() - start
@@ -0,0 +1,54 @@
+import pickle
+from timeit import default_timer
+
+from django.core.management.base import BaseCommand
+
+from evap.evaluation.models import Course
+from evap.results.tools import _calculate_snapshots, _sections_from_snapshot, SnapshotModels
+
+
+class Command(BaseCommand):
+    args = ''
+    help = 'Compares size and load time of the cached results snapshots with pickled result sections'
+    requires_migrations_checks = True
+
+    def add_arguments(self, parser):
+        parser.add_argument('--semester', type=int, help='Only use the courses of the semester with this id')
+        parser.add_argument('--repetitions', type=int, default=10, help='Number of times each cache entry is loaded')
+
+    def handle(self, *args, **options):
+        courses = Course.objects.filter(state='published')
+        if options['semester'] is not None:
+            courses = courses.filter(semester_id=options['semester'])
+        courses = list(courses)
+        if not courses:
+            self.stdout.write("There are no published courses to benchmark.")
+            return
+
+        snapshots, models = _calculate_snapshots(courses)
+        # the format that was cached before: result sections containing model instances
+        sections = {course.id: _sections_from_snapshot(snapshots[course.id], course, models) for course in courses}
+
+        snapshot_payloads = [pickle.dumps(snapshot, pickle.HIGHEST_PROTOCOL) for snapshot in snapshots.values()]
+        section_payloads = [pickle.dumps(course_sections, pickle.HIGHEST_PROTOCOL) for course_sections in sections.values()]
+
+        repetitions = options['repetitions']
+        snapshot_load_time = self.measure(lambda: [pickle.loads(payload) for payload in snapshot_payloads], repetitions)
+        section_load_time = self.measure(lambda: [pickle.loads(payload) for payload in section_payloads], repetitions)
+        courses_by_id = {course.id: course for course in courses}
+        rehydration_time = self.measure(
+            lambda: [_sections_from_snapshot(snapshot, courses_by_id[course_id], SnapshotModels({}, {}, {})) for course_id, snapshot in snapshots.items()],
+            repetitions)
+
+        self.stdout.write("Courses: {}".format(len(courses)))
+        self.stdout.write("Snapshots: {} bytes, loaded in {:.2f} ms".format(sum(map(len, snapshot_payloads)), snapshot_load_time * 1000))
+        self.stdout.write("Sections: {} bytes, loaded in {:.2f} ms".format(sum(map(len, section_payloads)), section_load_time * 1000))
+        self.stdout.write("Turning the snapshots into sections (including queries): {:.2f} ms".format(rehydration_time * 1000))
+
+    @staticmethod
+    def measure(function, repetitions):
+        """Returns the average time in seconds that a call of `function` takes."""
+        start = default_timer()
+        for __ in range(repetitions):
+            function()
+        return (default_timer() - start) / repetitions
@@ -0,0 +1,91 @@
+import datetime
+import threading
+from timeit import default_timer
+from uuid import uuid4
+
+from django.core.management.base import BaseCommand
+from django.db import DatabaseError, connection, transaction
+from django.test.utils import override_settings
+
+from evap.evaluation.models import Contribution, Course, CourseType, Question, Questionnaire, RatingAnswerCounter, Semester, UserProfile
+
+
+class Command(BaseCommand):
+    args = ''
+    help = ('Measures the throughput of concurrent votes for the same rating answer with different numbers of counter shards. '
+            'With --ballots, whole ballots of different participants are recorded like in the vote view. '
+            'Use a database with row-level locking like PostgreSQL, SQLite locks the whole database for each write.')
+    requires_migrations_checks = True
+
+    def add_arguments(self, parser):
+        parser.add_argument('--voters', type=int, default=8, help='Number of threads voting concurrently')
+        parser.add_argument('--votes', type=int, default=100, help='Number of votes of each thread')
+        parser.add_argument('--shards', type=int, nargs='+', default=[1, 8], help='Numbers of counter shards to compare')
+        parser.add_argument('--ballots', action='store_true', help='Record whole ballots of different participants instead of single votes')
+
+    def handle(self, *args, **options):
+        # the voting threads use their own connections, so the benchmark data must be committed
+        name = "benchmark {}".format(uuid4().hex)
+        semester = Semester.objects.create(name_de=name, name_en=name)
+        course_type = CourseType.objects.create(name_de=name, name_en=name)
+        questionnaire = Questionnaire.objects.create(name_de=name, name_en=name, public_name_de=name, public_name_en=name)
+        question = Question.objects.create(questionnaire=questionnaire, text_de=name, text_en=name, type="G")
+        course = Course.objects.create(semester=semester, type=course_type, name_de=name, name_en=name,
+                                       vote_start_date=datetime.date.today(), vote_end_date=datetime.date.today())
+        rating_votes = [(course.general_contribution.id, question.id, 1)]
+        users = []
+        if options['ballots']:
+            UserProfile.objects.bulk_create([UserProfile(username="{} {}".format(name, i)) for i in range(options['voters'] * options['votes'])])
+            users = list(UserProfile.objects.filter(username__startswith=name))
+
+        def vote(voter_index, vote_index):
+            if options['ballots']:
+                course.add_ballot(users[voter_index * options['votes'] + vote_index], rating_votes, [])
+            else:
+                RatingAnswerCounter.add_votes(rating_votes)
+
+        try:
+            for shards in options['shards']:
+                with override_settings(RATING_ANSWER_COUNTER_SHARDS=shards, VOTE_QUEUE_ENABLED=False):
+                    duration, failed_count = self.run_voters(vote, options['voters'], options['votes'])
+                counters = RatingAnswerCounter.objects.filter(contribution=course.general_contribution, question=question)
+                vote_count = sum(counter.count for counter in counters)
+                self.stdout.write("{} shards: {} votes in {:.2f} s, {:.0f} votes per second, {} failed votes".format(
+                    shards, vote_count, duration, vote_count / duration, failed_count))
+                if options['ballots']:
+                    self.stdout.write("Voter count of the course: {}".format(Course.objects.get(pk=course.pk).num_voters))
+                    course.voters.clear()
+                counters.delete()
+        finally:
+            UserProfile.objects.filter(pk__in=[user.pk for user in users]).delete()
+            Contribution.objects.filter(course=course).delete()
+            course.delete()
+            questionnaire.delete()
+            course_type.delete()
+            semester.delete()
+
+    @staticmethod
+    def run_voters(vote, voter_count, vote_count):
+        """Lets `voter_count` threads call `vote` with their index and the index of the vote `vote_count`
+        times each, in a transaction each. Returns the time in seconds until all votes were counted and
+        the number of votes that failed, e.g. because of lock timeouts."""
+        failed_votes = []
+
+        def vote_repeatedly(voter_index):
+            try:
+                for vote_index in range(vote_count):
+                    try:
+                        with transaction.atomic():
+                            vote(voter_index, vote_index)
+                    except DatabaseError:
+                        failed_votes.append(1)
+            finally:
+                connection.close()
+
+        voters = [threading.Thread(target=vote_repeatedly, args=(voter_index,)) for voter_index in range(voter_count)]
+        start = default_timer()
+        for voter in voters:
+            voter.start()
+        for voter in voters:
+            voter.join()
+        return default_timer() - start, len(failed_votes)
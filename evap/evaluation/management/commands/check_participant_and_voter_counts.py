@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count
+
+from evap.evaluation.models import Course
+
+
+class Command(BaseCommand):
+    args = ''
+    help = 'Checks that the stored participant and voter counts of the courses match their participants and voters'
+    requires_migrations_checks = True
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repair', action='store_true', help='Recount the participants and voters of the courses with wrong counts')
+
+    def handle(self, *args, **options):
+        courses = Course.with_counted_participants_and_voters().annotate(
+            participant_count=Count('participants', distinct=True), voter_count=Count('voters', distinct=True))
+        wrong_courses = [course for course in courses
+                         if (course._participant_count, course._voter_count) != (course.participant_count, course.voter_count)]
+
+        for course in wrong_courses:
+            self.stdout.write("Course {} (id {}): stored {} participants and {} voters, counted {} participants and {} voters.".format(
+                course, course.id, course._participant_count, course._voter_count, course.participant_count, course.voter_count))
+
+        if options['repair']:
+            Course.update_participant_and_voter_counts([course.id for course in wrong_courses])
+            self.stdout.write("Repaired the counts of {} courses.".format(len(wrong_courses)))
+        else:
+            self.stdout.write("Found {} courses with wrong counts.".format(len(wrong_courses)))
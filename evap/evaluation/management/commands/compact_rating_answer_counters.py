@@ -0,0 +1,48 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count
+
+from evap.evaluation.models import RatingAnswerCounter
+
+
+def compact_counters(counters):
+    """Merges the shards of the given rating answer counters into their first
+    shard. Returns the number of deleted counters. Votes can be added while
+    this runs: the shards of each answer are locked while they are merged, and
+    RatingAnswerCounter.add_votes adds the votes for counters that have been
+    deleted after it looked them up again."""
+    sharded_answers = (counters.order_by().values('contribution_id', 'question_id', 'answer')
+                       .annotate(shard_count=Count('id')).filter(shard_count__gt=1))
+
+    deleted_count = 0
+    for sharded_answer in list(sharded_answers):
+        with transaction.atomic():
+            shards = list(RatingAnswerCounter.objects.select_for_update().filter(
+                contribution_id=sharded_answer['contribution_id'],
+                question_id=sharded_answer['question_id'],
+                answer=sharded_answer['answer'],
+            ).order_by('shard'))
+            RatingAnswerCounter.objects.filter(id=shards[0].id).update(count=sum(shard.count for shard in shards))
+            RatingAnswerCounter.objects.filter(id__in=[shard.id for shard in shards[1:]]).delete()
+            deleted_count += len(shards) - 1
+    return deleted_count
+
+
+class Command(BaseCommand):
+    args = ''
+    help = 'Merges the shards of the rating answer counters, e.g. after the evaluation of the courses has ended'
+    requires_migrations_checks = True
+
+    def add_arguments(self, parser):
+        parser.add_argument('--semester', type=int, action='append', default=[], help='Only compact the counters of the semester with this id')
+        parser.add_argument('--course', type=int, action='append', default=[], help='Only compact the counters of the course with this id')
+
+    def handle(self, *args, **options):
+        counters = RatingAnswerCounter.objects.all()
+        if options['semester']:
+            counters = counters.filter(contribution__course__semester_id__in=options['semester'])
+        if options['course']:
+            counters = counters.filter(contribution__course_id__in=options['course'])
+
+        deleted_count = compact_counters(counters)
+        self.stdout.write("Deleted {} rating answer counters.".format(deleted_count))
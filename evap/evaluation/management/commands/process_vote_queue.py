@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from evap.evaluation.models import QueuedBallot
+
+
+class Command(BaseCommand):
+    args = ''
+    help = 'Adds the answers of all queued ballots to the rating answer counters and text answers'
+    requires_migrations_checks = True
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Number of ballots processed in each transaction')
+
+    def handle(self, *args, **options):
+        ballot_count = 0
+        while True:
+            processed_count = QueuedBallot.process(options['batch_size'])
+            if processed_count == 0:
+                break
+            ballot_count += processed_count
+        self.stdout.write("Processed {} ballots.".format(ballot_count))
@@ -1,28 +1,90 @@
+from collections import Counter
+from multiprocessing import Pool
+from timeit import default_timer
+
 from django.core.management.base import BaseCommand
 from django.core.serializers.base import ProgressBar
-from django.core.cache import cache
+from django.db import connections
 
 from evap.evaluation.models import Course
-from evap.results.tools import calculate_results
+from evap.results.tools import GRADE_SUMMARY_STATES, get_courses_with_outdated_results, recalculate_results
+
+# number of courses whose results are calculated together
+BATCH_SIZE = 50
+
+
+def refresh_courses(course_ids):
+    """Recalculates the cached results and grade summaries of the courses with
+    the given ids. Returns the time spent in each phase."""
+    timings = Counter()
+
+    start = default_timer()
+    courses = list(Course.objects.filter(id__in=course_ids))
+    timings['loading courses'] += default_timer() - start
+
+    start = default_timer()
+    recalculate_results(courses)
+    timings['calculating results and grade summaries'] += default_timer() - start
+
+    return len(courses), timings
 
 
 class Command(BaseCommand):
     args = ''
-    help = 'Clears the cache and pre-warms it with the results of all courses'
+    help = 'Recalculates the cached results and grade summaries of all courses whose evaluation has ended'
     requires_migrations_checks = True
 
+    def add_arguments(self, parser):
+        parser.add_argument('--semester', type=int, action='append', default=[], help='Only refresh the courses of the semester with this id')
+        parser.add_argument('--course', type=int, action='append', default=[], help='Only refresh the course with this id')
+        parser.add_argument('--only-stale', action='store_true', help='Only refresh courses whose results are missing or outdated')
+        parser.add_argument('--jobs', type=int, default=1, help='Number of processes calculating results in parallel')
+
     def handle(self, *args, **options):
-        self.stdout.write("Clearing cache...")
-        cache.clear()
-        total_count = Course.objects.count()
+        timings = Counter()
 
-        self.stdout.write("Calculating results for all courses...")
+        start = default_timer()
+        courses = Course.objects.filter(state__in=GRADE_SUMMARY_STATES)
+        if options['semester']:
+            courses = courses.filter(semester_id__in=options['semester'])
+        if options['course']:
+            courses = courses.filter(id__in=options['course'])
+        if options['only_stale']:
+            course_ids = [course.id for course in get_courses_with_outdated_results(courses)]
+        else:
+            course_ids = list(courses.values_list('id', flat=True))
+        timings['selecting courses'] += default_timer() - start
 
+        self.stdout.write("Refreshing the results of {} courses...".format(len(course_ids)))
+        batches = [course_ids[i:i + BATCH_SIZE] for i in range(0, len(course_ids), BATCH_SIZE)]
+
+        start = default_timer()
         self.stdout.ending = None
-        progress_bar = ProgressBar(self.stdout, total_count)
+        progress_bar = ProgressBar(self.stdout, len(course_ids))
+        refreshed_count = 0
+        for count, batch_timings in self.refresh(batches, options['jobs']):
+            refreshed_count += count
+            timings.update(batch_timings)
+            progress_bar.update(refreshed_count)
+        self.stdout.ending = '\n'
+        total_time = default_timer() - start
+
+        self.stdout.write("Results cache has been refreshed.")
+        self.stdout.write("{:.2f} s selecting courses".format(timings.pop('selecting courses')))
+        # the other phases are run by the jobs, so their durations are summed up over all of them
+        for phase, duration in sorted(timings.items()):
+            self.stdout.write("{:.2f} s {}".format(duration, phase))
+        self.stdout.write("{:.2f} s refreshing in total with {} jobs".format(total_time, options['jobs']))
 
-        for counter, course in enumerate(Course.objects.all()):
-            progress_bar.update(counter + 1)
-            calculate_results(course)
+    @staticmethod
+    def refresh(batches, jobs):
+        """Refreshes the given batches of course ids, distributed across `jobs`
+        processes. Yields the results of `refresh_courses` for each batch."""
+        if jobs <= 1:
+            yield from map(refresh_courses, batches)
+            return
 
-        self.stdout.write("Results cache has been refreshed.\n")
+        # the forked processes must not share the database connections of this one
+        connections.close_all()
+        with Pool(jobs) as pool:
+            yield from pool.imap_unordered(refresh_courses, batches)
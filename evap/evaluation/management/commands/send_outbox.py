@@ -0,0 +1,20 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from evap.evaluation.models import OutboxMessage
+
+
+class Command(BaseCommand):
+    args = ''
+    help = 'Sends the emails in the outbox whose next attempt is due and deletes old sent emails'
+    requires_migrations_checks = True
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=settings.EMAIL_BATCH_SIZE, help='Number of emails sent over one connection')
+        parser.add_argument('--rate-limit', type=float, default=settings.EMAIL_OUTBOX_RATE_LIMIT, help='Maximum number of emails sent per second')
+
+    def handle(self, *args, **options):
+        report = OutboxMessage.send_due(options['batch_size'], options['rate_limit'])
+        self.stdout.write("Sent {} emails, {} emails will be retried, {} emails failed.".format(*report))
+        deleted_count = OutboxMessage.delete_old_sent()
+        self.stdout.write("Deleted {} old sent emails.".format(deleted_count))
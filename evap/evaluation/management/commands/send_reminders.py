@@ -1,20 +1,53 @@
 import datetime
 import operator
 import logging
+from collections import OrderedDict, defaultdict
+from timeit import default_timer
 
 from django.core.management.base import BaseCommand
 from django.conf import settings
+from django.db.models import Exists, OuterRef
 
-from evap.evaluation.models import Course, EmailTemplate
+from evap.evaluation.models import Course, EmailTemplate, UserProfile
 from evap.evaluation.management.commands.tools import log_exceptions
 
 logger = logging.getLogger(__name__)
 
 
+def get_due_courses_per_user(check_dates):
+    """Returns an OrderedDict mapping the users who haven't voted for a course
+    in evaluation that ends on one of the `check_dates` to all courses in
+    evaluation they haven't voted for, as (course, due_in_days) pairs sorted
+    by the days left. The participations are loaded with a single query."""
+    has_voted = Exists(Course.voters.through.objects.filter(course_id=OuterRef('course_id'), userprofile_id=OuterRef('userprofile_id')))
+    due_participations = (Course.participants.through.objects.filter(course__state='in_evaluation')
+                          .annotate(has_voted=has_voted).filter(has_voted=False))
+    users_to_remind = due_participations.filter(course__vote_end_date__in=check_dates).values('userprofile_id')
+
+    due_course_ids_per_user = defaultdict(list)
+    for user_id, course_id in due_participations.filter(userprofile_id__in=users_to_remind).values_list('userprofile_id', 'course_id'):
+        due_course_ids_per_user[user_id].append(course_id)
+
+    courses = Course.objects.in_bulk({course_id for course_ids in due_course_ids_per_user.values() for course_id in course_ids})
+    users = UserProfile.objects.in_bulk(list(due_course_ids_per_user))
+
+    today = datetime.date.today()
+    due_courses_per_user = OrderedDict()
+    for user_id, course_ids in sorted(due_course_ids_per_user.items()):
+        due_courses = [(courses[course_id], (courses[course_id].vote_end_date - today).days) for course_id in sorted(course_ids)]
+        # Sort courses by number of days left for evaluation and bring them to following format:
+        # [(course, due_in_days), ...]
+        due_courses_per_user[users[user_id]] = sorted(due_courses, key=operator.itemgetter(1))
+    return due_courses_per_user
+
+
 @log_exceptions
 class Command(BaseCommand):
     help = 'Sends email reminders X days before course evaluation ends.'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Only print how many reminders would be sent, without sending them')
+
     def handle(self, *args, **options):
         logger.info("send_reminders called.")
         check_dates = []
@@ -23,20 +56,17 @@ class Command(BaseCommand):
         for number_of_days in settings.REMIND_X_DAYS_AHEAD_OF_END_DATE:
             check_dates.append(datetime.date.today() + datetime.timedelta(days=number_of_days))
 
-        recipients = set()
-        for course in Course.objects.filter(state='in_evaluation', vote_end_date__in=check_dates):
-            recipients.update(course.due_participants)
-
-        for recipient in recipients:
-            due_courses = dict()
-            for course in Course.objects.filter(participants=recipient, state='in_evaluation').exclude(voters=recipient):
-                due_courses[course] = (course.vote_end_date - datetime.date.today()).days
-            first_due_in_days = min(due_courses.values())
+        start = default_timer()
+        due_courses_per_user = get_due_courses_per_user(check_dates)
+        duration = default_timer() - start
 
-            # Sort courses by number of days left for evaluation and bring them to following format:
-            # [(course, due_in_days), ...]
-            due_courses = sorted(due_courses.items(), key=operator.itemgetter(1))
+        if options['dry_run']:
+            course_count = len({course for due_courses in due_courses_per_user.values() for course, __ in due_courses})
+            self.stdout.write("Would send reminders to {} people about {} courses. Found them in {:.2f} s.".format(
+                len(due_courses_per_user), course_count, duration))
+            return
 
-            EmailTemplate.send_reminder_to_user(recipient, first_due_in_days=first_due_in_days, due_courses=due_courses)
+        start = default_timer()
+        EmailTemplate.send_reminders_to_users(due_courses_per_user)
         logger.info("send_reminders finished.")
-        logger.info("sent reminders to {} people.".format(len(recipients)))
+        logger.info("sent reminders to {} people in {:.2f} s, found them in {:.2f} s.".format(len(due_courses_per_user), default_timer() - start, duration))
@@ -8,5 +8,9 @@ from evap.evaluation.management.commands.tools import log_exceptions
 class Command(BaseCommand):
     help = 'Updates the state of all courses whose evaluation period starts or ends today.'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100, help='Number of courses updated in one transaction')
+
     def handle(self, *args, **options):
-        Course.update_courses()
+        report = Course.update_courses(batch_size=options['batch_size'])
+        self.stdout.write("Scanned {} courses: the evaluation of {} courses began, the evaluation of {} courses ended, {} courses were published.".format(*report))
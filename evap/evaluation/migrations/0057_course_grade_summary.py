@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 07:09
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('evaluation', '0056_alter_userprofile_email'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CourseGradeSummary',
+            fields=[
+                ('course', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='grade_summary', serialize=False, to='evaluation.Course', verbose_name='course')),
+                ('average_grade', models.FloatField(blank=True, db_index=True, null=True, verbose_name='average grade')),
+                ('average_deviation', models.FloatField(blank=True, null=True, verbose_name='average deviation')),
+                ('answer_1_count', models.IntegerField(default=0, verbose_name='number of answers 1')),
+                ('answer_2_count', models.IntegerField(default=0, verbose_name='number of answers 2')),
+                ('answer_3_count', models.IntegerField(default=0, verbose_name='number of answers 3')),
+                ('answer_4_count', models.IntegerField(default=0, verbose_name='number of answers 4')),
+                ('answer_5_count', models.IntegerField(default=0, verbose_name='number of answers 5')),
+                ('version', models.PositiveSmallIntegerField(verbose_name='version')),
+                ('computed_at', models.DateTimeField(auto_now=True, verbose_name='computed at')),
+            ],
+            options={
+                'verbose_name': 'course grade summary',
+                'verbose_name_plural': 'course grade summaries',
+            },
+        ),
+    ]
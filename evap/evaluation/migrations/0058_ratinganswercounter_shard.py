@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 07:32
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('evaluation', '0057_course_grade_summary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ratinganswercounter',
+            name='shard',
+            field=models.PositiveSmallIntegerField(default=0, verbose_name='shard'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='ratinganswercounter',
+            unique_together=set([('question', 'contribution', 'answer', 'shard')]),
+        ),
+    ]
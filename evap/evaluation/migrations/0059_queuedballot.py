@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 07:35
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('evaluation', '0058_ratinganswercounter_shard'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QueuedBallot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('rating_votes', models.TextField(verbose_name='rating votes')),
+                ('text_answers', models.TextField(verbose_name='text answers')),
+                ('course', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='queued_ballots', to='evaluation.Course')),
+            ],
+            options={
+                'verbose_name': 'queued ballot',
+                'verbose_name_plural': 'queued ballots',
+            },
+        ),
+    ]
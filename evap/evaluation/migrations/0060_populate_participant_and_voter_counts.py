@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+SINGLE_RESULT_QUESTIONNAIRE_NAME = "Single result"
+
+
+def populate_participant_and_voter_counts(apps, schema_editor):
+    Course = apps.get_model('evaluation', 'Course')
+
+    # archived courses and single results already store their counts
+    for course in Course.objects.filter(semester__is_archived=False):
+        is_single_result = (course.vote_start_date == course.vote_end_date and course.contributions.filter(
+            responsible=True, questionnaires__name_en=SINGLE_RESULT_QUESTIONNAIRE_NAME).exists())
+        if is_single_result:
+            continue
+        course._participant_count = course.participants.count()
+        course._voter_count = course.voters.count()
+        course.save()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('evaluation', '0059_queuedballot'),
+    ]
+
+    operations = [
+        migrations.RunPython(populate_participant_and_voter_counts, reverse_code=migrations.RunPython.noop),
+    ]
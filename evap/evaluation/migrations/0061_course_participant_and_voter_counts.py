@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 07:46
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('evaluation', '0060_populate_participant_and_voter_counts'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='course',
+            name='_participant_count',
+            field=models.IntegerField(default=0, verbose_name='participant count'),
+        ),
+        migrations.AlterField(
+            model_name='course',
+            name='_voter_count',
+            field=models.IntegerField(default=0, verbose_name='voter count'),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 08:12
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import F
+
+SINGLE_RESULT_QUESTIONNAIRE_NAME = "Single result"
+
+
+def populate_is_single_result(apps, schema_editor):
+    Course = apps.get_model('evaluation', 'Course')
+    Contribution = apps.get_model('evaluation', 'Contribution')
+
+    single_result_ids = Contribution.objects.filter(
+        responsible=True, questionnaires__name_en=SINGLE_RESULT_QUESTIONNAIRE_NAME).values('course_id')
+    Course.objects.filter(vote_start_date=F('vote_end_date'), pk__in=single_result_ids).update(is_single_result=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('evaluation', '0061_course_participant_and_voter_counts'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='course',
+            name='is_single_result',
+            field=models.BooleanField(db_index=True, default=False, verbose_name='is single result'),
+        ),
+        migrations.RunPython(populate_is_single_result, reverse_code=migrations.RunPython.noop),
+    ]
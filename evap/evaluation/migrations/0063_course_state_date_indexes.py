@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 07:50
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('evaluation', '0062_course_is_single_result'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='course',
+            index_together=set([('state', 'vote_start_date'), ('state', 'vote_end_date')]),
+        ),
+    ]
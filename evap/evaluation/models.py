@@ -1,14 +1,23 @@
 import datetime
+import json
 import logging
 import random
+import time
+from collections import Counter, OrderedDict, defaultdict, namedtuple
+from functools import lru_cache
+from timeit import default_timer
+from uuid import uuid4
 
 from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth.models import AbstractBaseUser, BaseUserManager, Group, PermissionsMixin
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
-from django.core.mail import EmailMessage
-from django.db import models, transaction
-from django.db.models import Count, Q
+from django.core.mail import EmailMessage, get_connection
+from django.db import IntegrityError, models, transaction
+from django.db.models import Count, Exists, F, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce
+from django.db.models.signals import m2m_changed, post_delete, post_init, post_save, pre_delete
 from django.dispatch import Signal, receiver
 from django.template import Context, Template
 from django.template.base import TemplateEncodingError, TemplateSyntaxError
@@ -219,16 +228,20 @@ class Course(models.Model, metaclass=LocalizeModelBase):
 
     # students that are allowed to vote
     participants = models.ManyToManyField(settings.AUTH_USER_MODEL, verbose_name=_("participants"), blank=True, related_name='courses_participating_in')
-    _participant_count = models.IntegerField(verbose_name=_("participant count"), blank=True, null=True, default=None)
+    # kept up to date by update_participant_and_voter_counts, frozen when the semester is archived
+    _participant_count = models.IntegerField(verbose_name=_("participant count"), default=0)
 
     # students that already voted
     voters = models.ManyToManyField(settings.AUTH_USER_MODEL, verbose_name=_("voters"), blank=True, related_name='courses_voted_for')
-    _voter_count = models.IntegerField(verbose_name=_("voter count"), blank=True, null=True, default=None)
+    _voter_count = models.IntegerField(verbose_name=_("voter count"), default=0)
 
     # when the evaluation takes place
     vote_start_date = models.DateField(verbose_name=_("first day of evaluation"))
     vote_end_date = models.DateField(verbose_name=_("last day of evaluation"))
 
+    # single results only store the answer counts of a single question, see SingleResultForm
+    is_single_result = models.BooleanField(verbose_name=_("is single result"), default=False, db_index=True)
+
     # who last modified this course
     last_modified_time = models.DateTimeField(auto_now=True)
     last_modified_user = models.ForeignKey(settings.AUTH_USER_MODEL, models.SET_NULL, null=True, blank=True, related_name="course_last_modified_user+")
@@ -241,6 +254,11 @@ class Course(models.Model, metaclass=LocalizeModelBase):
             ('semester', 'name_de'),
             ('semester', 'name_en'),
         )
+        # for finding the courses whose evaluation begins or ends, see update_courses
+        index_together = (
+            ('state', 'vote_start_date'),
+            ('state', 'vote_end_date'),
+        )
         verbose_name = _("course")
         verbose_name_plural = _("courses")
 
@@ -259,11 +277,12 @@ class Course(models.Model, metaclass=LocalizeModelBase):
 
     @property
     def is_fully_reviewed(self):
-        return not self.open_textanswer_set.exists()
+        # the text answers of queued ballots can't be reviewed yet
+        return not self.open_textanswer_set.exists() and not self.queued_ballots.exists()
 
     @property
     def is_not_fully_reviewed(self):
-        return self.open_textanswer_set.exists()
+        return not self.is_fully_reviewed
 
     @property
     def is_in_evaluation_period(self):
@@ -274,19 +293,46 @@ class Course(models.Model, metaclass=LocalizeModelBase):
     def has_enough_questionnaires(self):
         return self.general_contribution and (self.is_single_result or all(self.contributions.annotate(Count('questionnaires')).values_list("questionnaires__count", flat=True)))
 
+    def add_ballot(self, user, rating_votes, text_answers):
+        """Records the vote of the user with the given rating votes as passed to
+        `RatingAnswerCounter.add_votes` and the given (unsaved) text answers.
+        Returns False without recording anything if the user has voted already.
+        Must be called in a transaction."""
+        # not using self.voters.add(user) since it fails silently when done twice.
+        # manually inserting like this gives us the 'created' return value and ensures at the database level that nobody votes twice.
+        __, created = self.voters.through.objects.get_or_create(userprofile_id=user.pk, course_id=self.pk)
+        if not created:
+            return False
+
+        # the answers are written in bulk, so the number of queries doesn't depend on the length of the questionnaires.
+        # this skips the answers' model signals, which is fine because results of courses in evaluation are neither cached nor summarized.
+        if settings.VOTE_QUEUE_ENABLED:
+            # the answers are processed later by the process_vote_queue command
+            QueuedBallot.create(self, rating_votes, text_answers)
+        else:
+            RatingAnswerCounter.add_votes(rating_votes)
+            TextAnswer.objects.bulk_create(text_answers)
+
+        # inserting into the through model doesn't send m2m_changed, so the voter count is updated here. this happens after
+        # the commit, so that concurrent voters of the course don't wait for each other's lock on the course row.
+        # counts that miss a vote because the process stopped in between are repaired by check_participant_and_voter_counts
+        transaction.on_commit(lambda: Course.objects.filter(pk=self.pk).update(_voter_count=F('_voter_count') + 1))
+        return True
+
     def can_user_vote(self, user):
         """Returns whether the user is allowed to vote on this course."""
+        access = CourseAccessContext.for_user(user)
         return (self.state == "in_evaluation"
             and self.is_in_evaluation_period
-            and user in self.participants.all()
-            and user not in self.voters.all())
+            and access.is_participant(self)
+            and not access.is_voter(self))
 
     def can_user_see_course(self, user):
         if user.is_reviewer:
             return True
         if self.is_user_contributor_or_delegate(user):
             return True
-        if self.is_private and user not in self.participants.all():
+        if self.is_private and not CourseAccessContext.for_user(user).is_participant(self):
             return False
         return True
 
@@ -301,14 +347,6 @@ class Course(models.Model, metaclass=LocalizeModelBase):
             return self.can_user_see_course(user)
         return False
 
-    @property
-    def is_single_result(self):
-        # early return to save some queries
-        if self.vote_start_date != self.vote_end_date:
-            return False
-
-        return self.contributions.filter(responsible=True, questionnaires__name_en=Questionnaire.SINGLE_RESULT_QUESTIONNAIRE_NAME).exists()
-
     @property
     def can_staff_edit(self):
         return not self.is_archived and self.state in ['new', 'prepared', 'editor_approved', 'approved', 'in_evaluation', 'evaluated', 'reviewed']
@@ -388,17 +426,13 @@ class Course(models.Model, metaclass=LocalizeModelBase):
         except Contribution.DoesNotExist:
             return None
 
-    @cached_property
+    @property
     def num_participants(self):
-        if self._participant_count is not None:
-            return self._participant_count
-        return self.participants.count()
+        return self._participant_count
 
-    @cached_property
+    @property
     def num_voters(self):
-        if self._voter_count is not None:
-            return self._voter_count
-        return self.voters.count()
+        return self._voter_count
 
     @property
     def due_participants(self):
@@ -417,39 +451,19 @@ class Course(models.Model, metaclass=LocalizeModelBase):
         return (self.vote_start_date - datetime.date.today()).days
 
     def is_user_editor_or_delegate(self, user):
-        if self.contributions.filter(can_edit=True, contributor=user).exists():
-            return True
-        else:
-            represented_users = user.represented_users.all()
-            if self.contributions.filter(can_edit=True, contributor__in=represented_users).exists():
-                return True
-
-        return False
+        return CourseAccessContext.for_user(user).is_contributor(self, can_edit=True, include_represented_users=True)
 
     def is_user_responsible_or_delegate(self, user):
-        if self.contributions.filter(responsible=True, contributor=user).exists():
-            return True
-        else:
-            represented_users = user.represented_users.all()
-            if self.contributions.filter(responsible=True, contributor__in=represented_users).exists():
-                return True
-
-        return False
+        return CourseAccessContext.for_user(user).is_contributor(self, responsible=True, include_represented_users=True)
 
     def is_user_contributor(self, user):
-        return self.contributions.filter(contributor=user).exists()
+        return CourseAccessContext.for_user(user).is_contributor(self)
 
     def is_user_contributor_or_delegate(self, user):
-        if self.is_user_contributor(user):
-            return True
-        else:
-            represented_users = user.represented_users.all()
-            if self.contributions.filter(contributor__in=represented_users).exists():
-                return True
-        return False
+        return CourseAccessContext.for_user(user).is_contributor(self, include_represented_users=True)
 
     def is_user_editor(self, user):
-        return self.contributions.filter(contributor=user, can_edit=True).exists()
+        return CourseAccessContext.for_user(user).is_contributor(self, can_edit=True)
 
     def warnings(self):
         result = []
@@ -482,6 +496,22 @@ class Course(models.Model, metaclass=LocalizeModelBase):
     def num_reviewed_textanswers(self):
         return self.reviewed_textanswer_set.count()
 
+    @classmethod
+    def with_counted_participants_and_voters(cls):
+        """Returns the courses whose participant and voter counts match their
+        participants and voters. This excludes archived courses, whose counts
+        are frozen, and single results, which only have counts."""
+        return cls.objects.filter(semester__is_archived=False, is_single_result=False)
+
+    @classmethod
+    def update_participant_and_voter_counts(cls, course_ids):
+        """Recounts the participants and voters of the given courses with a single query."""
+        courses = cls.with_counted_participants_and_voters().filter(pk__in=course_ids)
+        return courses.update(
+            _participant_count=_count_per_course(cls.participants.through),
+            _voter_count=_count_per_course(cls.voters.through),
+        )
+
     @property
     def ratinganswer_counters(self):
         """Pseudo relationship to all rating answers for this course"""
@@ -491,16 +521,12 @@ class Course(models.Model, metaclass=LocalizeModelBase):
         """Should be called only via Semester.archive"""
         if not self.is_archiveable:
             raise NotArchiveable()
-        self._participant_count = self.num_participants
-        self._voter_count = self.num_voters
-        self.save()
+        # the participant and voter counts are frozen from now on, so they are recounted a last time
+        self.update_participant_and_voter_counts([self.pk])
 
     @property
     def is_archived(self):
-        semester_is_archived = self.semester.is_archived
-        if semester_is_archived:
-            assert self._participant_count is not None and self._voter_count is not None
-        return semester_is_archived
+        return self.semester.is_archived
 
     @property
     def is_archiveable(self):
@@ -522,37 +548,156 @@ class Course(models.Model, metaclass=LocalizeModelBase):
         return are_grades_activated(self.semester)
 
     @classmethod
-    def update_courses(cls):
+    def update_courses(cls, batch_size=100):
+        """Begins and ends the evaluations that are due. Only the courses whose
+        state changes are loaded, together with what decides whether they can
+        be reviewed and published right away, and they are updated in
+        transactions of `batch_size` courses. Returns a `CourseUpdateReport`."""
         logger.info("update_courses called. Processing courses now.")
         from evap.evaluation.tools import send_publish_notifications
+        from evap.grades.models import GradeDocument
         today = datetime.date.today()
 
+        courses = list(cls.objects.filter(
+            Q(state="approved", vote_start_date__lte=today) | Q(state="in_evaluation", vote_end_date__lt=today)
+        ).annotate(
+            has_open_textanswers=Exists(TextAnswer.objects.filter(contribution__course=OuterRef('pk'), state=TextAnswer.NOT_REVIEWED)),
+            has_queued_ballots=Exists(QueuedBallot.objects.filter(course=OuterRef('pk'))),
+            has_final_grade_documents=Exists(GradeDocument.objects.filter(course=OuterRef('pk'), type=GradeDocument.FINAL_GRADES)),
+        ).order_by('pk'))
+        cronjob_user = UserProfile.cronjob_user()
+
         courses_new_in_evaluation = []
+        courses_evaluated = []
         evaluation_results_courses = []
 
-        for course in cls.objects.all():
-            try:
-                if course.state == "approved" and course.vote_start_date <= today:
-                    course.evaluation_begin()
-                    course.last_modified_user = UserProfile.cronjob_user()
-                    course.save()
-                    courses_new_in_evaluation.append(course)
-                elif course.state == "in_evaluation" and course.vote_end_date < today:
-                    course.evaluation_end()
-                    if course.is_fully_reviewed:
-                        course.review_finished()
-                        if not course.is_graded or course.final_grade_documents.exists() or course.gets_no_grade_documents:
-                            course.publish()
-                            evaluation_results_courses.append(course)
-                    course.last_modified_user = UserProfile.cronjob_user()
-                    course.save()
-            except Exception:
-                logger.exception('An error occured when updating the state of course "{}" (id {}).'.format(course, course.id))
+        for batch_start in range(0, len(courses), batch_size):
+            with transaction.atomic():
+                for course in courses[batch_start:batch_start + batch_size]:
+                    try:
+                        with transaction.atomic():
+                            cls._update_course_state(course, cronjob_user)
+                    except Exception:
+                        logger.exception('An error occured when updating the state of course "{}" (id {}).'.format(course, course.id))
+                        continue
+                    if course.state == "in_evaluation":
+                        courses_new_in_evaluation.append(course)
+                    else:
+                        courses_evaluated.append(course)
+                    if course.state == "published":
+                        evaluation_results_courses.append(course)
 
         template = EmailTemplate.objects.get(name=EmailTemplate.EVALUATION_STARTED)
         EmailTemplate.send_to_users_in_courses(template, courses_new_in_evaluation, [EmailTemplate.ALL_PARTICIPANTS], use_cc=False, request=None)
         send_publish_notifications(evaluation_results_courses)
-        logger.info("update_courses finished.")
+
+        report = CourseUpdateReport(len(courses), len(courses_new_in_evaluation), len(courses_evaluated), len(evaluation_results_courses))
+        logger.info("update_courses finished. {}".format(report))
+        return report
+
+    @staticmethod
+    def _update_course_state(course, cronjob_user):
+        if course.state == "approved":
+            course.evaluation_begin()
+        else:
+            course.evaluation_end()
+            if not course.has_open_textanswers and not course.has_queued_ballots:
+                course.review_finished()
+                if not course.is_graded or course.has_final_grade_documents or course.gets_no_grade_documents:
+                    course.publish()
+        course.last_modified_user = cronjob_user
+        course.save()
+
+
+# the numbers of courses loaded by Course.update_courses and of those whose evaluation began or ended or that were published
+CourseUpdateReport = namedtuple('CourseUpdateReport', ('scanned_count', 'begun_count', 'ended_count', 'published_count'))
+
+
+class CourseAccessContext:
+    """Answers whether a user participates in, has voted for or contributes to
+    courses, or represents one of their contributors. Each kind of membership
+    is loaded for all courses of the user with one query when it is first
+    needed, so checking many courses costs as many queries as checking one.
+
+    The context is stored in the user object, so it lives as long as the
+    request. Use `forget` after changing the memberships of a user object."""
+
+    def __init__(self, user):
+        self.user = user
+
+    @classmethod
+    def for_user(cls, user):
+        if not hasattr(user, '_course_access_context'):
+            user._course_access_context = cls(user)
+        return user._course_access_context
+
+    @staticmethod
+    def forget(user):
+        if hasattr(user, '_course_access_context'):
+            del user._course_access_context
+
+    @cached_property
+    def participated_course_ids(self):
+        return frozenset(Course.participants.through.objects.filter(userprofile_id=self.user.id).values_list('course_id', flat=True))
+
+    @cached_property
+    def voted_course_ids(self):
+        return frozenset(Course.voters.through.objects.filter(userprofile_id=self.user.id).values_list('course_id', flat=True))
+
+    @cached_property
+    def contributions(self):
+        """Maps the ids of the courses the user contributes to to (can_edit, responsible) tuples of the contributions."""
+        return self._group_by_course(Contribution.objects.filter(contributor=self.user))
+
+    @cached_property
+    def represented_contributions(self):
+        """Like `contributions`, for the contributions of the users represented by the user."""
+        return self._group_by_course(Contribution.objects.filter(contributor__delegates=self.user))
+
+    @staticmethod
+    def _group_by_course(contributions):
+        contributions_by_course = defaultdict(list)
+        for course_id, can_edit, responsible in contributions.values_list('course_id', 'can_edit', 'responsible'):
+            contributions_by_course[course_id].append((can_edit, responsible))
+        return contributions_by_course
+
+    def is_participant(self, course):
+        return course.id in self.participated_course_ids
+
+    def is_voter(self, course):
+        return course.id in self.voted_course_ids
+
+    def is_contributor(self, course, can_edit=False, responsible=False, include_represented_users=False):
+        """Returns whether the user (or, optionally, one of the users represented
+        by them) contributes to the course, optionally as editor or responsible."""
+        def matches(contributions):
+            return any((is_editor or not can_edit) and (is_responsible or not responsible) for is_editor, is_responsible in contributions.get(course.id, []))
+
+        return matches(self.contributions) or (include_represented_users and matches(self.represented_contributions))
+
+
+def _count_per_course(through_model):
+    """Returns a subquery counting the rows of a many-to-many relation of a course."""
+    counts = through_model.objects.filter(course_id=OuterRef('pk')).order_by().values('course_id').annotate(count=Count('*')).values('count')
+    return Coalesce(Subquery(counts, output_field=models.IntegerField()), 0)
+
+
+@receiver(m2m_changed, sender=Course.participants.through)
+@receiver(m2m_changed, sender=Course.voters.through)
+def update_participant_and_voter_counts_on_change(sender, instance, action, reverse, pk_set, **kwargs):
+    if reverse and action == 'pre_clear':
+        # the courses are not known anymore after clearing
+        instance._cleared_course_ids = list(sender.objects.filter(userprofile_id=instance.pk).values_list('course_id', flat=True))
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+
+    if not reverse:
+        Course.update_participant_and_voter_counts([instance.pk])
+        instance.refresh_from_db(fields=['_participant_count', '_voter_count'])
+    elif action == 'post_clear':
+        Course.update_participant_and_voter_counts(instance.__dict__.pop('_cleared_course_ids'))
+    else:
+        Course.update_participant_and_voter_counts(pk_set)
 
 
 @receiver(post_transition, sender=Course)
@@ -564,6 +709,59 @@ def log_state_transition(sender, **kwargs):
     logger.info('Course "{}" (id {}) moved from state "{}" to state "{}", caused by transition "{}".'.format(course, course.id, source_state, target_state, transition_name))
 
 
+@receiver(post_transition, sender=Course)
+def update_results_cache_on_transition(sender, instance, source, target, **kwargs):
+    from evap.results.tools import GRADE_SUMMARY_STATES, calculate_results, invalidate_results_cache, update_grade_summaries
+    if target == 'published':
+        # results might have been cached during an earlier publication of the course
+        calculate_results(instance, force_recalculation=True)
+    elif source == 'published':
+        invalidate_results_cache(instance)
+
+    # the summaries are kept up to date here and when answers change, so lists of courses only have to read them
+    if target in GRADE_SUMMARY_STATES:
+        update_grade_summaries([instance])
+    else:
+        CourseGradeSummary.objects.filter(course=instance).delete()
+
+
+class CourseGradeSummary(models.Model):
+    """The final average grade and deviation and the numbers of all rating answers
+    of a course, so that lists of courses can be shown, sorted and filtered
+    without calculating their results. Summaries are stored for courses whose
+    evaluation has ended and are recalculated whenever their results change, see
+    evap.results.tools.update_grade_summaries. Courses in evaluation have no
+    summary, so votes never have to update them."""
+
+    # must be increased whenever the calculation of the summaries changes
+    VERSION = 1
+
+    course = models.OneToOneField(Course, models.CASCADE, primary_key=True, verbose_name=_("course"), related_name="grade_summary")
+    average_grade = models.FloatField(verbose_name=_("average grade"), blank=True, null=True, db_index=True)
+    average_deviation = models.FloatField(verbose_name=_("average deviation"), blank=True, null=True)
+
+    answer_1_count = models.IntegerField(verbose_name=_("number of answers 1"), default=0)
+    answer_2_count = models.IntegerField(verbose_name=_("number of answers 2"), default=0)
+    answer_3_count = models.IntegerField(verbose_name=_("number of answers 3"), default=0)
+    answer_4_count = models.IntegerField(verbose_name=_("number of answers 4"), default=0)
+    answer_5_count = models.IntegerField(verbose_name=_("number of answers 5"), default=0)
+
+    version = models.PositiveSmallIntegerField(verbose_name=_("version"))
+    computed_at = models.DateTimeField(verbose_name=_("computed at"), auto_now=True)
+
+    class Meta:
+        verbose_name = _("course grade summary")
+        verbose_name_plural = _("course grade summaries")
+
+    @property
+    def counts(self):
+        return OrderedDict((answer, getattr(self, 'answer_{}_count'.format(answer))) for answer in range(1, 6))
+
+    @property
+    def total_count(self):
+        return sum(self.counts.values())
+
+
 class Contribution(models.Model):
     """A contributor who is assigned to a course and his questionnaires."""
 
@@ -615,6 +813,25 @@ class Contribution(models.Model):
         return self.contributor is None
 
 
+@receiver([post_save, post_delete], sender=Contribution)
+def invalidate_results_cache_on_contribution_change(sender, instance, raw=False, **kwargs):
+    from evap.results.tools import invalidate_results_cache
+    # don't touch the cache while loading fixtures
+    if raw:
+        return
+    CourseGradeSummary.objects.filter(course_id=instance.course_id).delete()
+    # the course is queried again because it might not exist anymore or still be loaded from a fixture
+    published_course = Course.objects.filter(pk=instance.course_id, state='published').first()
+    if published_course:
+        invalidate_results_cache(published_course)
+
+
+@receiver(m2m_changed, sender=Contribution.questionnaires.through)
+def invalidate_results_cache_on_questionnaires_change(sender, instance, action, reverse, **kwargs):
+    if not reverse and action in ('post_add', 'post_remove', 'post_clear'):
+        invalidate_results_cache_on_contribution_change(sender, instance)
+
+
 class Question(models.Model, metaclass=LocalizeModelBase):
     """A question including a type."""
 
@@ -665,6 +882,15 @@ class Question(models.Model, metaclass=LocalizeModelBase):
         return self.is_grade_question or self.is_likert_question
 
 
+@receiver([post_save, post_delete], sender=Questionnaire)
+@receiver([post_save, post_delete], sender=Question)
+def invalidate_form_spec_on_questionnaire_change(sender, instance, raw=False, **kwargs):
+    from evap.student.forms import invalidate_form_spec
+    # don't touch the cache while loading fixtures
+    if not raw:
+        invalidate_form_spec(instance.id if sender == Questionnaire else instance.questionnaire_id)
+
+
 class Answer(models.Model):
     """An abstract answer to a question. For anonymity purposes, the answering
     user ist not stored in the object. Concrete subclasses are `RatingAnswerCounter`,
@@ -680,14 +906,20 @@ class Answer(models.Model):
 
 
 class RatingAnswerCounter(Answer):
-    """A rating answer counter to a question. A lower answer is better or indicates more agreement."""
+    """A rating answer counter to a question. A lower answer is better or indicates more agreement.
+
+    The votes for an answer can be spread across several counters with
+    different shards (see RATING_ANSWER_COUNTER_SHARDS), so concurrent voters
+    don't have to wait for each other's row locks. The number of answers is
+    the sum of the counts of all shards."""
 
     answer = models.IntegerField(verbose_name=_("answer"))
     count = models.IntegerField(verbose_name=_("count"), default=0)
+    shard = models.PositiveSmallIntegerField(verbose_name=_("shard"), default=0)
 
     class Meta:
         unique_together = (
-            ('question', 'contribution', 'answer'),
+            ('question', 'contribution', 'answer', 'shard'),
         )
         verbose_name = _("rating answer")
         verbose_name_plural = _("rating answers")
@@ -695,6 +927,70 @@ class RatingAnswerCounter(Answer):
     def add_vote(self):
         self.count += 1
 
+    @classmethod
+    def add_votes(cls, votes, shards=None):
+        """Adds a vote for each of the given (contribution_id, question_id, answer)
+        tuples with a fixed number of queries. Missing counters are created and
+        the others are incremented in the database. Counters that
+        compact_rating_answer_counters deleted before they could be incremented
+        are created again, so concurrent votes are not lost. Like all bulk
+        operations, this does not send any model signals.
+
+        The votes for each answer are counted in a random one of `shards`
+        shards, which defaults to the RATING_ANSWER_COUNTER_SHARDS setting."""
+        if shards is None:
+            shards = settings.RATING_ANSWER_COUNTER_SHARDS
+        vote_counts = {vote + (random.randrange(shards),): count for vote, count in Counter(votes).items()}
+
+        # the incremented counters stay locked until the transaction ends, so they can't be deleted after the update
+        with transaction.atomic():
+            while vote_counts:
+                existing_counters = cls._get_counter_ids(vote_counts)
+                missing_counters = [
+                    cls(contribution_id=contribution_id, question_id=question_id, answer=answer, shard=shard, count=count)
+                    for (contribution_id, question_id, answer, shard), count in vote_counts.items()
+                    if (contribution_id, question_id, answer, shard) not in existing_counters
+                ]
+                if missing_counters:
+                    try:
+                        with transaction.atomic():
+                            cls.objects.bulk_create(missing_counters)
+                    except IntegrityError:
+                        # a concurrent vote created one of the counters, so it has to be incremented instead
+                        continue
+
+                # one update per distinct number of votes, which is a single one for a ballot
+                counter_ids_by_count = defaultdict(list)
+                for vote, count in vote_counts.items():
+                    if vote in existing_counters:
+                        counter_ids_by_count[count].append(existing_counters[vote])
+                updated_count = 0
+                for count, counter_ids in counter_ids_by_count.items():
+                    updated_count += cls.objects.filter(id__in=counter_ids).update(count=F('count') + count)
+                if updated_count == sum(len(counter_ids) for counter_ids in counter_ids_by_count.values()):
+                    break
+
+                # some counters have been merged into another shard after they were looked up, so their votes are added again
+                remaining_counter_ids = set(cls.objects.filter(id__in=existing_counters.values()).values_list('id', flat=True))
+                vote_counts = {
+                    vote: count for vote, count in vote_counts.items()
+                    if vote in existing_counters and existing_counters[vote] not in remaining_counter_ids
+                }
+
+    @classmethod
+    def _get_counter_ids(cls, vote_counts):
+        """Returns a dict mapping those of the given (contribution_id, question_id, answer, shard)
+        tuples that have a counter to the counter's id."""
+        return {
+            (contribution_id, question_id, answer, shard): counter_id
+            for counter_id, contribution_id, question_id, answer, shard in cls.objects.filter(
+                contribution_id__in={vote[0] for vote in vote_counts},
+                question_id__in={vote[1] for vote in vote_counts},
+                answer__in={vote[2] for vote in vote_counts},
+                shard__in={vote[3] for vote in vote_counts},
+            ).values_list('id', 'contribution_id', 'question_id', 'answer', 'shard')
+        }
+
 
 class TextAnswer(Answer):
     """A free-form text answer to a question (usually a comment about a course
@@ -757,6 +1053,73 @@ class TextAnswer(Answer):
         self.state = self.NOT_REVIEWED
 
 
+class QueuedBallot(models.Model):
+    """The answers of a ballot which have not been added to the rating answer
+    counters and text answers yet. If VOTE_QUEUE_ENABLED is set, votes are
+    stored like this first and processed later by the process_vote_queue
+    command. For anonymity purposes, the voter is not stored in the object."""
+
+    course = models.ForeignKey(Course, models.CASCADE, related_name="queued_ballots")
+    # JSON lists of [contribution_id, question_id, answer] lists
+    rating_votes = models.TextField(verbose_name=_("rating votes"))
+    text_answers = models.TextField(verbose_name=_("text answers"))
+
+    class Meta:
+        verbose_name = _("queued ballot")
+        verbose_name_plural = _("queued ballots")
+
+    @classmethod
+    def create(cls, course, rating_votes, text_answers):
+        """Queues a ballot with the given rating votes as passed to `RatingAnswerCounter.add_votes`
+        and the given (unsaved) text answers."""
+        return cls.objects.create(
+            course=course,
+            rating_votes=json.dumps(list(rating_votes)),
+            text_answers=json.dumps([(text_answer.contribution_id, text_answer.question_id, text_answer.answer) for text_answer in text_answers]),
+        )
+
+    def get_rating_votes(self):
+        return [tuple(vote) for vote in json.loads(self.rating_votes)]
+
+    def get_text_answers(self):
+        return [
+            TextAnswer(contribution_id=contribution_id, question_id=question_id, original_answer=answer)
+            for contribution_id, question_id, answer in json.loads(self.text_answers)
+        ]
+
+    @classmethod
+    def get_rating_vote_counts(cls, courses):
+        """Returns a Counter of the queued (contribution_id, question_id, answer) votes of the given courses."""
+        vote_counts = Counter()
+        for ballot in cls.objects.filter(course__in=courses).only('rating_votes'):
+            vote_counts.update(ballot.get_rating_votes())
+        return vote_counts
+
+    @classmethod
+    def process(cls, batch_size):
+        """Adds the answers of up to `batch_size` queued ballots to the answer
+        counters and text answers and deletes the ballots. Returns the number
+        of processed ballots. The results already contain the votes of queued
+        ballots, so they don't change."""
+        with transaction.atomic():
+            ballots = list(cls.objects.select_for_update(skip_locked=True).order_by('id')[:batch_size])
+            RatingAnswerCounter.add_votes(vote for ballot in ballots for vote in ballot.get_rating_votes())
+            TextAnswer.objects.bulk_create([text_answer for ballot in ballots for text_answer in ballot.get_text_answers()])
+            cls.objects.filter(id__in=[ballot.id for ballot in ballots]).delete()
+        return len(ballots)
+
+
+@receiver([post_save, post_delete], sender=RatingAnswerCounter)
+@receiver([post_save, post_delete], sender=TextAnswer)
+def update_results_cache_on_answer_change(sender, instance, raw=False, **kwargs):
+    from evap.results.tools import invalidate_results_cache_for_answer, update_grade_summary_for_answer
+    # don't touch the cache while loading fixtures
+    if not raw:
+        invalidate_results_cache_for_answer(instance)
+        if sender == RatingAnswerCounter:
+            update_grade_summary_for_answer(instance)
+
+
 class FaqSection(models.Model, metaclass=LocalizeModelBase):
     """Section in the frequently asked questions"""
 
@@ -828,6 +1191,31 @@ class UserProfileManager(BaseUserManager):
         return user
 
 
+# whether a user is in the groups and has the memberships that decide what they can access, see UserProfile.roles
+UserRoles = namedtuple('UserRoles', ('is_staff', 'is_reviewer', 'is_grade_publisher', 'is_participant', 'is_contributor', 'is_editor', 'is_delegate'))
+
+def get_user_roles_version_cache_key(user_id):
+    return 'evap.evaluation.models.user_roles_version-{:d}'.format(user_id)
+
+
+def get_user_roles_version(user_id):
+    """Returns a token that changes whenever the roles of the user change.
+    Roles stored together with an outdated token must be loaded again."""
+    cache_key = get_user_roles_version_cache_key(user_id)
+    version = cache.get(cache_key)
+    if version is None:
+        cache.add(cache_key, uuid4().hex, None)
+        version = cache.get(cache_key)
+    return version
+
+
+def invalidate_user_roles(user_ids):
+    """Changes the roles versions of the given users. The model signals do this
+    for single changes, but it has to be called after changing their groups,
+    participations, contributions or delegations with QuerySet.update."""
+    cache.delete_many([get_user_roles_version_cache_key(user_id) for user_id in set(user_ids) if user_id is not None])
+
+
 class UserProfile(AbstractBaseUser, PermissionsMixin):
     username = models.CharField(max_length=255, unique=True, verbose_name=_('username'))
 
@@ -898,17 +1286,36 @@ class UserProfile(AbstractBaseUser, PermissionsMixin):
     def is_active(self):
         return True
 
+    @cached_property
+    def roles(self):
+        """The groups and memberships of the user, loaded with a single query.
+        During requests, they might come from the session instead, see
+        UserRolesMiddleware."""
+        def in_group(name):
+            return Exists(Group.objects.filter(user=OuterRef('pk'), name=name))
+
+        return UserRoles(*UserProfile.objects.filter(pk=self.pk).annotate(
+            in_staff_group=in_group('Staff'),
+            in_reviewer_group=in_group('Reviewer'),
+            in_grade_publisher_group=in_group('Grade publisher'),
+            participates=Exists(Course.participants.through.objects.filter(userprofile_id=OuterRef('pk'))),
+            contributes=Exists(Contribution.objects.filter(contributor=OuterRef('pk'))),
+            edits=Exists(Contribution.objects.filter(contributor=OuterRef('pk'), can_edit=True)),
+            represents=Exists(UserProfile.objects.filter(delegates=OuterRef('pk'))),
+        ).values_list('in_staff_group', 'in_reviewer_group', 'in_grade_publisher_group', 'participates', 'contributes', 'edits', 'represents').get())
+
+    # these and is_contributor can be overridden by annotations, see staff.views.user_index
     @cached_property
     def is_staff(self):
-        return self.groups.filter(name='Staff').exists()
+        return self.roles.is_staff
 
     @cached_property
     def is_reviewer(self):
-        return self.is_staff or self.groups.filter(name='Reviewer').exists()
+        return self.is_staff or self.roles.is_reviewer
 
     @cached_property
     def is_grade_publisher(self):
-        return self.groups.filter(name='Grade publisher').exists()
+        return self.roles.is_grade_publisher
 
     CRONJOB_USER_USERNAME = "cronjob"
 
@@ -931,7 +1338,7 @@ class UserProfile(AbstractBaseUser, PermissionsMixin):
 
     @property
     def is_participant(self):
-        return self.courses_participating_in.exists()
+        return self.roles.is_participant
 
     @property
     def is_student(self):
@@ -950,13 +1357,13 @@ class UserProfile(AbstractBaseUser, PermissionsMixin):
 
         return last_semester_participated.created_at >= last_semester_contributed.created_at
 
-    @property
+    @cached_property
     def is_contributor(self):
-        return self.contributions.exists()
+        return self.roles.is_contributor
 
     @property
     def is_editor(self):
-        return self.contributions.filter(can_edit=True).exists()
+        return self.roles.is_editor
 
     @property
     def is_responsible(self):
@@ -965,7 +1372,7 @@ class UserProfile(AbstractBaseUser, PermissionsMixin):
 
     @property
     def is_delegate(self):
-        return self.represented_users.exists()
+        return self.roles.is_delegate
 
     @property
     def is_editor_or_delegate(self):
@@ -1026,6 +1433,66 @@ class UserProfile(AbstractBaseUser, PermissionsMixin):
         return self.courses_voted_for.order_by('semester__created_at', 'name_de')
 
 
+@receiver(m2m_changed, sender=UserProfile.groups.through)
+@receiver(m2m_changed, sender=UserProfile.delegates.through)
+@receiver(m2m_changed, sender=Course.participants.through)
+def invalidate_user_roles_on_membership_change(sender, instance, action, model, pk_set, **kwargs):
+    if action == 'pre_clear':
+        # the users are not known anymore after clearing
+        instance_fields = [field.name for field in sender._meta.fields if field.related_model == type(instance)]
+        user_fields = [field.name for field in sender._meta.fields if field.related_model == UserProfile]
+        memberships = Q()
+        for name in instance_fields:
+            memberships |= Q(**{name: instance.pk})
+        instance._cleared_user_ids = [user_id for row in sender.objects.filter(memberships).values_list(*user_fields) for user_id in row]
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+
+    if action == 'post_clear':
+        user_ids = instance.__dict__.pop('_cleared_user_ids')
+    else:
+        user_ids = list(pk_set) if model == UserProfile else []
+    if isinstance(instance, UserProfile):
+        user_ids.append(instance.pk)
+    invalidate_user_roles(user_ids)
+
+
+@receiver(post_init, sender=Contribution)
+def remember_contributor_of_contribution(sender, instance, **kwargs):
+    # the contributor might be changed, which changes the roles of the previous one as well.
+    # deferred fields are not loaded here
+    instance._initial_contributor_id = instance.__dict__.get('contributor_id')
+
+
+@receiver([post_save, post_delete], sender=Contribution)
+def invalidate_user_roles_on_contribution_change(sender, instance, raw=False, **kwargs):
+    if not raw:
+        invalidate_user_roles([instance._initial_contributor_id, instance.contributor_id])
+        instance._initial_contributor_id = instance.contributor_id
+
+
+@receiver(pre_delete, sender=Course)
+def remember_participants_of_deleted_course(sender, instance, **kwargs):
+    # the participations are deleted without sending m2m_changed
+    instance._participant_ids = list(instance.participants.values_list('pk', flat=True))
+
+
+@receiver(post_delete, sender=Course)
+def invalidate_user_roles_on_course_deletion(sender, instance, **kwargs):
+    invalidate_user_roles(instance._participant_ids)
+
+
+@receiver(pre_delete, sender=UserProfile)
+def remember_courses_of_deleted_user(sender, instance, **kwargs):
+    # the participations and votes are deleted without sending m2m_changed
+    instance._course_ids = list(Course.objects.filter(Q(participants=instance) | Q(voters=instance)).values_list('pk', flat=True).distinct())
+
+
+@receiver(post_delete, sender=UserProfile)
+def update_participant_and_voter_counts_on_user_deletion(sender, instance, **kwargs):
+    Course.update_participant_and_voter_counts(instance._course_ids)
+
+
 def validate_template(value):
     """Field validator which ensures that the value can be compiled into a
     Django Template."""
@@ -1035,6 +1502,14 @@ def validate_template(value):
         raise ValidationError(str(e))
 
 
+@lru_cache(maxsize=128)
+def compile_email_template(text):
+    """Returns the compiled Django Template of the given subject or body.
+    Mass mails render the same texts for every recipient, so the compiled
+    templates are kept in the memory of each process, keyed by their text."""
+    return Template(text)
+
+
 class EmailTemplate(models.Model):
     name = models.CharField(max_length=1024, unique=True, verbose_name=_("Name"))
 
@@ -1063,73 +1538,117 @@ class EmailTemplate(models.Model):
 
     @classmethod
     def recipient_list_for_course(cls, course, recipient_groups, filter_users_in_cc):
-        recipients = []
-
-        if cls.CONTRIBUTORS in recipient_groups:
-            recipients += UserProfile.objects.filter(contributions__course=course)
-        elif cls.EDITORS in recipient_groups:
-            recipients += UserProfile.objects.filter(contributions__course=course, contributions__can_edit=True)
-        elif cls.RESPONSIBLE in recipient_groups:
-            recipients += course.responsible_contributors
+        return list(cls.recipients_for_courses([course], recipient_groups, filter_users_in_cc))
 
-        if cls.ALL_PARTICIPANTS in recipient_groups:
-            recipients += course.participants.all()
-        elif cls.DUE_PARTICIPANTS in recipient_groups:
-            recipients += course.due_participants
+    @classmethod
+    def recipients_for_courses(cls, courses, recipient_groups, filter_users_in_cc):
+        """Returns an OrderedDict mapping the recipients in the given groups to
+        their courses. The number of queries doesn't depend on the number of
+        courses. If `filter_users_in_cc` is set, the delegates and CC users of
+        the recipients are prefetched, because they are put in CC."""
+        courses = list(courses)
+        course_ids = [course.id for course in courses]
+        user_ids_per_course = defaultdict(set)
+
+        contributions = Contribution.objects.filter(course_id__in=course_ids, contributor__isnull=False)
+        # the contributors include the editors, which include the responsible contributors
+        if cls.CONTRIBUTORS not in recipient_groups:
+            if cls.EDITORS in recipient_groups:
+                contributions = contributions.filter(can_edit=True)
+            elif cls.RESPONSIBLE in recipient_groups:
+                contributions = contributions.filter(responsible=True)
+        if any(group in recipient_groups for group in [cls.CONTRIBUTORS, cls.EDITORS, cls.RESPONSIBLE]):
+            for user_id, course_id in contributions.values_list('contributor_id', 'course_id'):
+                user_ids_per_course[course_id].add(user_id)
+
+        participations = Course.participants.through.objects.filter(course_id__in=course_ids)
+        if cls.DUE_PARTICIPANTS in recipient_groups and cls.ALL_PARTICIPANTS not in recipient_groups:
+            participations = participations.annotate(has_voted=Exists(Course.voters.through.objects.filter(
+                course_id=OuterRef('course_id'), userprofile_id=OuterRef('userprofile_id')))).filter(has_voted=False)
+        if cls.ALL_PARTICIPANTS in recipient_groups or cls.DUE_PARTICIPANTS in recipient_groups:
+            for user_id, course_id in participations.values_list('userprofile_id', 'course_id'):
+                user_ids_per_course[course_id].add(user_id)
 
         if filter_users_in_cc:
             # remove delegates and CC users of recipients from the recipient list
             # so they won't get the exact same email twice
-            users_excluded = UserProfile.objects.filter(Q(represented_users__in=recipients) | Q(ccing_users__in=recipients))
             # but do so only if they have no delegates/cc_users, because otherwise
             # those won't get the email at all. consequently, some "edge case users"
             # will get the email twice, but there is no satisfying way around that.
-            users_excluded = users_excluded.filter(delegates=None, cc_users=None)
-
-            recipients = list(set(recipients) - set(users_excluded))
+            recipient_ids = set().union(*user_ids_per_course.values())
+            users_in_cc = defaultdict(set)
+            for through in [UserProfile.delegates.through, UserProfile.cc_users.through]:
+                pairs = through.objects.filter(from_userprofile_id__in=recipient_ids, to_userprofile__delegates=None, to_userprofile__cc_users=None)
+                for user_id, user_in_cc_id in pairs.values_list('from_userprofile_id', 'to_userprofile_id'):
+                    users_in_cc[user_id].add(user_in_cc_id)
+            for user_ids in user_ids_per_course.values():
+                user_ids -= set().union(*(users_in_cc[user_id] for user_id in user_ids))
+
+        users = UserProfile.objects.filter(pk__in=set().union(*user_ids_per_course.values()))
+        if filter_users_in_cc:
+            users = users.prefetch_related('delegates', 'cc_users')
+        users_by_id = {user.id: user for user in users}
 
+        recipients = OrderedDict()
+        for course in courses:
+            for user_id in sorted(user_ids_per_course[course.id]):
+                recipients.setdefault(users_by_id[user_id], []).append(course)
         return recipients
 
     @classmethod
     def __render_string(cls, text, dictionary):
-        return Template(text).render(Context(dictionary, autoescape=False))
+        return compile_email_template(text).render(Context(dictionary, autoescape=False))
 
     @classmethod
     def send_to_users_in_courses(cls, template, courses, recipient_groups, use_cc, request):
-        user_course_map = {}
-        for course in courses:
-            recipients = cls.recipient_list_for_course(course, recipient_groups, filter_users_in_cc=use_cc)
-            for user in recipients:
-                user_course_map.setdefault(user, []).append(course)
+        user_course_map = cls.recipients_for_courses(courses, recipient_groups, filter_users_in_cc=use_cc)
+        recipients = [(user, {}, {'user': user, 'courses': courses}) for user, courses in user_course_map.items()]
+        cls.send_to_users(template, recipients, use_cc=use_cc, request=request)
 
-        for user, courses in user_course_map.items():
-            subject_params = {}
-            body_params = {'user': user, 'courses': courses}
-            cls.send_to_user(user, template, subject_params, body_params, use_cc=use_cc, request=request)
+    @classmethod
+    def send_to_user(cls, user, template, subject_params, body_params, use_cc, request=None, send_immediately=False):
+        cls.send_to_users(template, [(user, subject_params, body_params)], use_cc=use_cc, request=request, send_immediately=send_immediately)
 
     @classmethod
-    def send_to_user(cls, user, template, subject_params, body_params, use_cc, request=None):
+    def send_to_users(cls, template, recipients, use_cc, request=None, send_immediately=False):
+        """Sends the template to each of the given (user, subject_params,
+        body_params) recipients. All emails are rendered before the first one
+        is sent, see send_mails. If EMAIL_OUTBOX_ENABLED is set, the emails are
+        stored in the outbox instead, unless they must be sent immediately.
+        Returns the users whose emails couldn't be sent."""
+        prepared_mails = [cls.__prepare_mail(user, template, subject_params, body_params, use_cc, request) for user, subject_params, body_params in recipients]
+        prepared_mails = [prepared_mail for prepared_mail in prepared_mails if prepared_mail is not None]
+        if settings.EMAIL_OUTBOX_ENABLED and not send_immediately:
+            OutboxMessage.enqueue(prepared_mails)
+            return []
+        return cls.send_mails(prepared_mails, request)
+
+    @classmethod
+    def __prepare_mail(cls, user, template, subject_params, body_params, use_cc, request):
+        """Returns the email to the user together with a separate email containing
+        their login URL if it can't be included, or None if the user has no email address."""
         if not user.email:
             warning_message = "{} has no email address defined. Could not send email.".format(user.username)
             logger.warning(warning_message)
             if request is not None:
                 messages.warning(request, _(warning_message))
-            return
+            return None
 
         if use_cc:
-            cc_users = set(user.delegates.all() | user.cc_users.all())
+            cc_users = set(user.delegates.all()) | set(user.cc_users.all())
             cc_addresses = [p.email for p in cc_users if p.email]
         else:
             cc_addresses = []
 
-        send_separate_login_url = False
+        login_url_mail = None
         body_params['login_url'] = ""
         if user.needs_login_key:
             user.generate_login_key()
             if not cc_addresses:
                 body_params['login_url'] = user.login_url
             else:
-                send_separate_login_url = True
+                login_url_template = cls.objects.get(name=cls.LOGIN_KEY_CREATED)
+                __, login_url_mail, __ = cls.__prepare_mail(user, login_url_template, {}, {'user': user, 'login_url': user.login_url}, False, request)
 
         subject = cls.__render_string(template.subject, subject_params)
         body = cls.__render_string(template.body, body_params)
@@ -1141,22 +1660,61 @@ class EmailTemplate(models.Model):
             cc=cc_addresses,
             bcc=[a[1] for a in settings.MANAGERS],
             headers={'Reply-To': settings.REPLY_TO_EMAIL})
+        return user, mail, login_url_mail
+
+    @classmethod
+    def send_mails(cls, prepared_mails, request=None):
+        """Sends the (user, mail, login_url_mail) triples returned by __prepare_mail.
+        The emails are sent in chunks of EMAIL_BATCH_SIZE users, each over a
+        single connection to the mail server. Returns the users whose emails
+        couldn't be sent."""
+        failed_users = []
+        for chunk_start in range(0, len(prepared_mails), settings.EMAIL_BATCH_SIZE):
+            chunk = prepared_mails[chunk_start:chunk_start + settings.EMAIL_BATCH_SIZE]
+            connection = get_connection()
+            try:
+                connection.open()
+            except Exception:
+                logger.exception('An exception occurred when connecting to the mail server to send emails to {} users.'.format(len(chunk)))
+                failed_users.extend(user for user, __, __ in chunk)
+                continue
+
+            try:
+                for user, mail, login_url_mail in chunk:
+                    # the messages are sent one by one over the open connection to know which of them failed
+                    if not cls.__send_mail(connection, user, mail) or (login_url_mail and not cls.__send_mail(connection, user, login_url_mail)):
+                        failed_users.append(user)
+            finally:
+                connection.close()
+
+        if failed_users and request is not None:
+            messages.error(request, _("The emails to the following users could not be sent: {}").format(", ".join(user.username for user in failed_users)))
+        return failed_users
 
+    @classmethod
+    def __send_mail(cls, connection, user, mail):
         try:
-            mail.send(False)
-            logger.info(('Sent email "{}" to {}.').format(subject, user.username))
-            if send_separate_login_url:
-                cls.send_login_url_to_user(user)
+            connection.send_messages([mail])
+            logger.info(('Sent email "{}" to {}.').format(mail.subject, user.username))
+            return True
         except Exception:
             logger.exception('An exception occurred when sending the following email to user "{}":\n{}\n'.format(user.username, mail.message()))
+            return False
 
     @classmethod
-    def send_reminder_to_user(cls, user, first_due_in_days, due_courses):
+    def send_reminders_to_users(cls, due_courses_per_user):
+        """Sends one reminder to each of the given users about their due
+        courses, given as lists of (course, due_in_days) pairs sorted by
+        the days left. Returns the users whose emails couldn't be sent."""
         template = cls.objects.get(name=cls.STUDENT_REMINDER)
-        subject_params = {'user': user, 'first_due_in_days': first_due_in_days}
-        body_params = {'user': user, 'first_due_in_days': first_due_in_days, 'due_courses': due_courses}
+        recipients = []
+        for user, due_courses in due_courses_per_user.items():
+            first_due_in_days = due_courses[0][1]
+            subject_params = {'user': user, 'first_due_in_days': first_due_in_days}
+            body_params = {'user': user, 'first_due_in_days': first_due_in_days, 'due_courses': due_courses}
+            recipients.append((user, subject_params, body_params))
 
-        cls.send_to_user(user, template, subject_params, body_params, use_cc=False)
+        return cls.send_to_users(template, recipients, use_cc=False)
 
     @classmethod
     def send_login_url_to_user(cls, user):
@@ -1164,5 +1722,157 @@ class EmailTemplate(models.Model):
         subject_params = {}
         body_params = {'user': user, 'login_url': user.login_url}
 
-        cls.send_to_user(user, template, subject_params, body_params, use_cc=False)
+        # the user is waiting for the login URL
+        cls.send_to_user(user, template, subject_params, body_params, use_cc=False, send_immediately=True)
         logger.info(('Sent login url to {}.').format(user.username))
+
+
+class OutboxMessage(models.Model):
+    """An email waiting to be sent by the send_outbox command, see
+    EMAIL_OUTBOX_ENABLED. Failed emails are retried with growing delays and
+    marked as failed after EMAIL_OUTBOX_MAX_ATTEMPTS attempts. Sent emails are
+    deleted after EMAIL_OUTBOX_RETENTION_DAYS days."""
+
+    QUEUED = 'queued'
+    SENT = 'sent'
+    FAILED = 'failed'
+    STATES = (
+        (QUEUED, _('queued')),
+        (SENT, _('sent')),
+        (FAILED, _('failed')),
+    )
+
+    # how long a batch is reserved for the worker sending it, see send_due
+    CLAIM_DURATION = datetime.timedelta(minutes=10)
+
+    # the recipient, for the status page. the email is sent to the stored addresses
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, models.SET_NULL, verbose_name=_("user"), related_name="outbox_messages", null=True, blank=True)
+    subject = models.TextField(verbose_name=_("subject"))
+    body = models.TextField(verbose_name=_("body"))
+    # the JSON encoded recipient addresses and headers of the email
+    envelope = models.TextField(verbose_name=_("envelope"))
+
+    state = models.CharField(max_length=16, choices=STATES, default=QUEUED, verbose_name=_("state"))
+    attempts = models.PositiveSmallIntegerField(default=0, verbose_name=_("attempts"))
+    next_attempt_time = models.DateTimeField(default=datetime.datetime.now, verbose_name=_("next attempt"))
+    last_error = models.TextField(blank=True, verbose_name=_("last error"))
+
+    created_time = models.DateTimeField(auto_now_add=True, verbose_name=_("created"))
+    sent_time = models.DateTimeField(null=True, blank=True, verbose_name=_("sent"))
+
+    class Meta:
+        ordering = ('-created_time', '-id')
+        # for finding the messages that are due, see send_due
+        index_together = (('state', 'next_attempt_time'),)
+        verbose_name = _("outbox message")
+        verbose_name_plural = _("outbox messages")
+
+    @classmethod
+    def enqueue(cls, prepared_mails):
+        """Stores the (user, mail, login_url_mail) triples of EmailTemplate.send_mails."""
+        outbox_messages = []
+        for user, mail, login_url_mail in prepared_mails:
+            outbox_messages.append(cls.from_email_message(user, mail))
+            if login_url_mail:
+                outbox_messages.append(cls.from_email_message(user, login_url_mail))
+        cls.objects.bulk_create(outbox_messages)
+
+    @classmethod
+    def from_email_message(cls, user, mail):
+        envelope = dict(to=mail.to, cc=mail.cc, bcc=mail.bcc, headers=mail.extra_headers)
+        return cls(user=user, subject=mail.subject, body=mail.body, envelope=json.dumps(envelope))
+
+    def to_email_message(self):
+        envelope = json.loads(self.envelope)
+        return EmailMessage(subject=self.subject, body=self.body, to=envelope['to'], cc=envelope['cc'], bcc=envelope['bcc'], headers=envelope['headers'])
+
+    @classmethod
+    def send_due(cls, batch_size, rate_limit=None):
+        """Sends the queued messages whose next attempt is due, `batch_size`
+        of them over one connection, and at most `rate_limit` per second.
+        Returns an `OutboxReport`.
+
+        Each batch is claimed by postponing its next attempt by CLAIM_DURATION
+        in a short transaction and sent afterwards, so several workers can run
+        at the same time without keeping a transaction open while sending.
+        The messages of a worker that is stopped while sending are sent again
+        after CLAIM_DURATION, so they might be sent twice."""
+        state_counts = Counter()
+        last_send_time = None
+        while True:
+            outbox_messages = cls.claim_due(batch_size)
+            if not outbox_messages:
+                break
+
+            connection = get_connection()
+            try:
+                connection.open()
+            except Exception as error:
+                logger.exception('An exception occurred when connecting to the mail server to send {} outbox messages.'.format(len(outbox_messages)))
+                for message in outbox_messages:
+                    message.record_failure(error)
+                    state_counts[message.state] += 1
+                continue
+
+            try:
+                for message in outbox_messages:
+                    if rate_limit and last_send_time is not None:
+                        time.sleep(max(0, last_send_time + 1 / rate_limit - default_timer()))
+                    last_send_time = default_timer()
+                    message.send(connection)
+                    state_counts[message.state] += 1
+            finally:
+                connection.close()
+
+        return OutboxReport(sent_count=state_counts[cls.SENT], retried_count=state_counts[cls.QUEUED], failed_count=state_counts[cls.FAILED])
+
+    @classmethod
+    def claim_due(cls, batch_size):
+        """Returns up to `batch_size` queued messages whose next attempt is due
+        and postpones their next attempt by CLAIM_DURATION."""
+        now = datetime.datetime.now()
+        with transaction.atomic():
+            outbox_messages = list(cls.objects.select_for_update(skip_locked=True).filter(
+                state=cls.QUEUED, next_attempt_time__lte=now).order_by('next_attempt_time', 'id')[:batch_size])
+            cls.objects.filter(id__in=[message.id for message in outbox_messages]).update(next_attempt_time=now + cls.CLAIM_DURATION)
+        return outbox_messages
+
+    def send(self, connection):
+        try:
+            connection.send_messages([self.to_email_message()])
+        except Exception as error:
+            logger.exception('An exception occurred when sending outbox message {} to user "{}".'.format(self.id, self.user))
+            self.record_failure(error)
+            return
+        self.state = self.SENT
+        self.attempts += 1
+        self.sent_time = datetime.datetime.now()
+        self.save(update_fields=['state', 'attempts', 'sent_time'])
+
+    def record_failure(self, error):
+        """Schedules the next attempt after 1, 2, 4, ... times EMAIL_OUTBOX_RETRY_DELAY,
+        or marks the message as failed after EMAIL_OUTBOX_MAX_ATTEMPTS attempts."""
+        self.attempts += 1
+        self.last_error = "{}: {}".format(type(error).__name__, error)
+        if self.attempts >= settings.EMAIL_OUTBOX_MAX_ATTEMPTS:
+            self.state = self.FAILED
+        else:
+            delay = settings.EMAIL_OUTBOX_RETRY_DELAY * 2 ** (self.attempts - 1)
+            self.next_attempt_time = datetime.datetime.now() + datetime.timedelta(seconds=delay)
+        self.save(update_fields=['state', 'attempts', 'next_attempt_time', 'last_error'])
+
+    @classmethod
+    def retry_failed(cls):
+        """Queues the failed messages again, e.g. after the mail server was fixed. Returns their number."""
+        return cls.objects.filter(state=cls.FAILED).update(state=cls.QUEUED, attempts=0, next_attempt_time=datetime.datetime.now())
+
+    @classmethod
+    def delete_old_sent(cls):
+        """Deletes the messages that were sent more than EMAIL_OUTBOX_RETENTION_DAYS days ago,
+        because their bodies might contain login URLs. Returns their number."""
+        oldest_sent_time = datetime.datetime.now() - datetime.timedelta(days=settings.EMAIL_OUTBOX_RETENTION_DAYS)
+        return cls.objects.filter(state=cls.SENT, sent_time__lt=oldest_sent_time).delete()[0]
+
+
+# the numbers of outbox messages that were sent, will be retried and failed in OutboxMessage.send_due
+OutboxReport = namedtuple('OutboxReport', ('sent_count', 'retried_count', 'failed_count'))
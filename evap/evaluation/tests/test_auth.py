@@ -1,9 +1,12 @@
+from django.contrib.auth.models import Group
+from django.db import connection
+from django.test.utils import CaptureQueriesContext, override_settings
 from django.urls import reverse
 from django.core import mail
 
 from model_mommy import mommy
 
-from evap.evaluation.models import UserProfile
+from evap.evaluation.models import Course, UserProfile
 from evap.evaluation.tests.tools import WebTest
 
 
@@ -31,3 +34,27 @@ class LoginTests(WebTest):
         self.external_user.refresh_from_db()
         page = self.app.get(reverse("results:index") + "?loginkey=%s" % self.external_user.login_key)
         self.assertContains(page, 'Logged in as ' + self.external_user.full_name)
+
+
+class UserRolesTests(WebTest):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.student = mommy.make(UserProfile, username='student', courses_participating_in=[mommy.make(Course, state='in_evaluation')])
+
+    def get_number_of_role_queries(self):
+        with CaptureQueriesContext(connection) as context:
+            self.app.get(reverse("student:index"), user="student")
+        return len([query for query in context.captured_queries if 'auth_group' in query['sql']])
+
+    def test_roles_are_loaded_with_one_query(self):
+        self.assertEqual(self.get_number_of_role_queries(), 1)
+
+    @override_settings(USER_ROLES_SESSION_CACHE=True)
+    def test_roles_are_kept_in_the_session(self):
+        self.get_number_of_role_queries()
+        self.assertEqual(self.get_number_of_role_queries(), 0)
+
+        self.student.groups.add(Group.objects.get(name='Staff'))
+        self.assertEqual(self.get_number_of_role_queries(), 1)
+        self.get_assert_200(reverse("staff:index"), "student")
@@ -0,0 +1,118 @@
+import pickle
+import threading
+
+from django.core.cache import cache
+from django.test import TestCase
+
+from evap.evaluation.cache import TwoTierCache
+
+
+def make_two_tier_cache(max_bytes=1024 * 1024):
+    return TwoTierCache('evap.evaluation.tests.test_cache.version-', max_entries=3, max_bytes=max_bytes)
+
+
+class TestTwoTierCache(TestCase):
+    def setUp(self):
+        self.two_tier_cache = make_two_tier_cache()
+
+    def test_values_are_cached_locally(self):
+        self.two_tier_cache.set_many({'a': 1, 'b': 2})
+        cache.delete('a')
+
+        self.assertEqual(self.two_tier_cache.get_many(['a', 'b', 'c']), {'a': 1, 'b': 2})
+        self.assertEqual(self.two_tier_cache.statistics()['hits'], 2)
+        self.assertEqual(self.two_tier_cache.statistics()['misses'], 1)
+
+    def test_values_are_loaded_from_shared_cache(self):
+        make_two_tier_cache().set('a', 1)
+
+        self.assertEqual(self.two_tier_cache.get_many(['a']), {'a': 1})
+        cache.delete('a')
+        self.assertEqual(self.two_tier_cache.get_many(['a']), {'a': 1})
+
+    def test_least_recently_used_entries_are_evicted(self):
+        self.two_tier_cache.set_many({'a': 1, 'b': 2, 'c': 3})
+        self.two_tier_cache.get_many(['a'])
+        self.two_tier_cache.set_many({'d': 4})
+        for key in 'abcd':
+            cache.delete(key)
+
+        self.assertEqual(self.two_tier_cache.get_many(['a', 'b', 'c', 'd']), {'a': 1, 'c': 3, 'd': 4})
+        self.assertEqual(self.two_tier_cache.statistics()['evictions'], 1)
+
+    def test_size_is_limited(self):
+        value_size = len(pickle.dumps('x' * 100, pickle.HIGHEST_PROTOCOL))
+        two_tier_cache = make_two_tier_cache(max_bytes=2 * value_size + 1)
+        two_tier_cache.set_many({'a': 'x' * 100, 'b': 'y' * 100})
+        two_tier_cache.set('c', 'z' * 100)
+        # values larger than the limit are only stored in the shared cache
+        two_tier_cache.set('d', 'x' * 1000)
+
+        statistics = two_tier_cache.statistics()
+        self.assertEqual((statistics['entries'], statistics['bytes']), (2, 2 * value_size))
+        self.assertEqual((statistics['evictions'], statistics['evicted_bytes']), (1, value_size))
+        for key in 'abcd':
+            cache.delete(key)
+        self.assertEqual(two_tier_cache.get_many(['a', 'b', 'c', 'd']), {'b': 'y' * 100, 'c': 'z' * 100})
+
+    def test_changes_invalidate_other_processes(self):
+        other_two_tier_cache = make_two_tier_cache()
+        self.two_tier_cache.set_many({'a': 1, 'b': 1})
+        other_two_tier_cache.get_many(['a', 'b'])
+
+        self.two_tier_cache.set('a', 2)
+        self.assertEqual(other_two_tier_cache.get_many(['a', 'b']), {'a': 2, 'b': 1})
+
+        self.two_tier_cache.delete('a')
+        self.assertEqual(other_two_tier_cache.get_many(['a']), {})
+        self.assertEqual(other_two_tier_cache.statistics()['invalidations'], 2)
+        # the entry of the unchanged key has been kept
+        self.assertEqual(other_two_tier_cache.statistics()['entries'], 1)
+
+    def test_missing_version_drops_local_entries(self):
+        self.two_tier_cache.set('a', 1)
+        cache.clear()
+
+        self.assertEqual(self.two_tier_cache.get_many(['a']), {})
+
+    def test_local_values_are_dropped_with_their_source(self):
+        other_two_tier_cache = make_two_tier_cache()
+        self.two_tier_cache.set('a', 1)
+        other_two_tier_cache.get_many(['a'])
+        other_two_tier_cache.set_local('derived', 2, source_key='a')
+        other_two_tier_cache.set_local('not stored', 3, source_key='b')
+
+        self.assertEqual(other_two_tier_cache.get_local('derived'), 2)
+        self.assertIsNone(other_two_tier_cache.get_local('not stored'))
+
+        self.two_tier_cache.set('a', 2)
+        self.assertIsNone(other_two_tier_cache.get_local('derived'))
+
+    def test_versions_are_checked_once_per_request(self):
+        self.two_tier_cache.set_many({'a': 1, 'b': 2})
+        self.two_tier_cache.request_started()
+
+        with self.assertNumQueries(1):
+            self.assertEqual(self.two_tier_cache.get_many(['a']), {'a': 1})
+        with self.assertNumQueries(0):
+            self.assertEqual(self.two_tier_cache.get_many(['a']), {'a': 1})
+
+        self.two_tier_cache.request_finished()
+        with self.assertNumQueries(1):
+            self.two_tier_cache.get_many(['a'])
+
+    def test_request_state_is_kept_per_thread(self):
+        self.two_tier_cache.set('a', 1)
+        self.two_tier_cache.request_started()
+        self.two_tier_cache.get_many(['a'])
+
+        def other_request():
+            self.two_tier_cache.request_started()
+            self.two_tier_cache.request_finished()
+        thread = threading.Thread(target=other_request)
+        thread.start()
+        thread.join()
+
+        # the other request neither ended this one nor checked the versions for it
+        with self.assertNumQueries(0):
+            self.two_tier_cache.get_many(['a'])
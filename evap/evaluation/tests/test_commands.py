@@ -5,12 +5,14 @@ from unittest.mock import patch
 
 from django.conf import settings
 from django.core import management, mail
+from django.core.cache import cache
 from django.test import TestCase
 from django.test.utils import override_settings
 
 from model_mommy import mommy
 
-from evap.evaluation.models import UserProfile, Course, Semester
+from evap.evaluation.models import UserProfile, Contribution, Course, CourseGradeSummary, CourseUpdateReport, EmailTemplate, OutboxMessage, Question, QueuedBallot, RatingAnswerCounter, Semester
+from evap.results.tools import calculate_results, get_results_cache_key, invalidate_results_cache, recalculate_results
 
 
 class TestAnonymizeCommand(TestCase):
@@ -58,20 +60,157 @@ class TestReloadTestdataCommand(TestCase):
 
 
 class TestRefreshResultsCacheCommand(TestCase):
-    def test_calls_calculate_results(self):
-        mommy.make(Course)
-        with patch('evap.results.tools.calculate_results') as mock:
-            management.call_command('refresh_results_cache', stdout=StringIO())
+    def setUp(self):
+        self.semester = mommy.make(Semester)
+        self.published_course = mommy.make(Course, state='published', semester=self.semester)
+        self.evaluated_course = mommy.make(Course, state='evaluated', semester=self.semester)
+        self.other_course = mommy.make(Course, state='published')
+        mommy.make(Course, state='in_evaluation', semester=self.semester)
 
-        self.assertEqual(mock.call_count, Course.objects.count())
+    def refreshed_course_ids(self, **options):
+        with patch('evap.evaluation.management.commands.refresh_results_cache.recalculate_results', wraps=recalculate_results) as mock:
+            management.call_command('refresh_results_cache', stdout=StringIO(), **options)
+        return {course.id for call in mock.call_args_list for course in call[0][0]}
+
+    def test_refreshes_courses_whose_evaluation_has_ended(self):
+        self.assertEqual(self.refreshed_course_ids(), {self.published_course.id, self.evaluated_course.id, self.other_course.id})
+        self.assertIsNotNone(cache.get(get_results_cache_key(self.published_course)))
+        self.assertTrue(CourseGradeSummary.objects.filter(course=self.evaluated_course).exists())
+
+    def test_does_not_clear_cache(self):
+        cache.set('unrelated', 'value')
+        management.call_command('refresh_results_cache', stdout=StringIO())
+        self.assertEqual(cache.get('unrelated'), 'value')
+
+    def test_filters(self):
+        self.assertEqual(self.refreshed_course_ids(semester=[self.semester.id]), {self.published_course.id, self.evaluated_course.id})
+        self.assertEqual(self.refreshed_course_ids(course=[self.other_course.id]), {self.other_course.id})
+
+    def test_only_stale(self):
+        management.call_command('refresh_results_cache', stdout=StringIO())
+        self.assertEqual(self.refreshed_course_ids(only_stale=True), set())
+
+        invalidate_results_cache(self.published_course)
+        CourseGradeSummary.objects.filter(course=self.evaluated_course).update(version=CourseGradeSummary.VERSION - 1)
+        self.assertEqual(self.refreshed_course_ids(only_stale=True), {self.published_course.id, self.evaluated_course.id})
+
+    def test_prints_timings(self):
+        output = StringIO()
+        management.call_command('refresh_results_cache', stdout=output)
+        self.assertIn("s selecting courses", output.getvalue())
+        self.assertIn("s calculating results and grade summaries", output.getvalue())
+
+
+class TestBenchmarkResultsCacheCommand(TestCase):
+    def test_reports_sizes_and_load_times(self):
+        mommy.make(Course, state='published')
+        output = StringIO()
+
+        management.call_command('benchmark_results_cache', repetitions=1, stdout=output)
+
+        self.assertIn("Courses: 1", output.getvalue())
+        self.assertIn("Snapshots:", output.getvalue())
+        self.assertIn("Sections:", output.getvalue())
+
+
+class TestBenchmarkEmailDeliveryCommand(TestCase):
+    def test_reports_throughput(self):
+        output = StringIO()
+
+        management.call_command('benchmark_email_delivery', recipients=3, batch_sizes=[1, 2], stdout=output)
+
+        self.assertIn("1 emails per connection: 3 emails", output.getvalue())
+        self.assertIn("2 emails per connection: 3 emails", output.getvalue())
+        self.assertEqual(len(mail.outbox), 0)
+
+
+class TestBenchmarkEmailRenderingCommand(TestCase):
+    def test_reports_time_per_recipient(self):
+        output = StringIO()
+
+        management.call_command('benchmark_email_rendering', recipients=3, stdout=output)
+
+        self.assertIn("Compiled for each recipient: 3 recipients", output.getvalue())
+        self.assertIn("Compiled once: 3 recipients", output.getvalue())
+
+
+@override_settings(EMAIL_OUTBOX_ENABLED=True)
+class TestSendOutboxCommand(TestCase):
+    def test_sends_queued_emails(self):
+        users = [mommy.make(UserProfile, email="user{}@institution.example.com".format(i)) for i in range(2)]
+        EmailTemplate.send_to_users(mommy.make(EmailTemplate), [(user, {}, {}) for user in users], use_cc=False)
+        output = StringIO()
+
+        management.call_command('send_outbox', stdout=output)
+
+        self.assertIn("Sent 2 emails, 0 emails will be retried, 0 emails failed.", output.getvalue())
+        self.assertIn("Deleted 0 old sent emails.", output.getvalue())
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertFalse(OutboxMessage.objects.filter(state=OutboxMessage.QUEUED).exists())
+
+
+class TestCompactRatingAnswerCountersCommand(TestCase):
+    def test_merges_shards(self):
+        contribution = mommy.make(Contribution, course=mommy.make(Course, state='published'))
+        question = mommy.make(Question, type="G")
+        for shard, count in enumerate([2, 3, 4]):
+            mommy.make(RatingAnswerCounter, contribution=contribution, question=question, answer=1, shard=shard, count=count)
+        mommy.make(RatingAnswerCounter, contribution=contribution, question=question, answer=2, shard=1, count=5)
+        results = calculate_results(contribution.course)
+        output = StringIO()
+
+        management.call_command('compact_rating_answer_counters', stdout=output)
+
+        self.assertIn("Deleted 2 rating answer counters.", output.getvalue())
+        self.assertEqual(set(RatingAnswerCounter.objects.values_list('answer', 'shard', 'count')), {(1, 0, 9), (2, 1, 5)})
+        self.assertEqual(calculate_results(contribution.course, force_recalculation=True), results)
+
+
+class TestProcessVoteQueueCommand(TestCase):
+    def test_processes_all_ballots(self):
+        course = mommy.make(Course)
+        mommy.make(QueuedBallot, course=course, rating_votes="[]", text_answers="[]", _quantity=3)
+        output = StringIO()
+
+        management.call_command('process_vote_queue', batch_size=2, stdout=output)
+
+        self.assertIn("Processed 3 ballots.", output.getvalue())
+        self.assertFalse(QueuedBallot.objects.exists())
+
+
+class TestCheckParticipantAndVoterCountsCommand(TestCase):
+    def setUp(self):
+        self.course = mommy.make(Course, participants=mommy.make(UserProfile, _quantity=2))
+        Course.objects.filter(pk=self.course.pk).update(_participant_count=5)
+
+    def test_wrong_counts_are_reported(self):
+        output = StringIO()
+        management.call_command('check_participant_and_voter_counts', stdout=output)
+
+        self.assertIn("Found 1 courses with wrong counts.", output.getvalue())
+        self.assertEqual(Course.objects.get(pk=self.course.pk).num_participants, 5)
+
+    def test_wrong_counts_are_repaired(self):
+        management.call_command('check_participant_and_voter_counts', '--repair', stdout=StringIO())
+
+        self.assertEqual(Course.objects.get(pk=self.course.pk).num_participants, 2)
 
 
 class TestUpdateCourseStatesCommand(TestCase):
     def test_update_courses_called(self):
-        with patch('evap.evaluation.models.Course.update_courses') as mock:
-            management.call_command('update_course_states')
+        with patch('evap.evaluation.models.Course.update_courses', return_value=CourseUpdateReport(3, 1, 2, 1)) as mock:
+            management.call_command('update_course_states', '--batch-size=10', stdout=StringIO())
 
-        self.assertEqual(mock.call_count, 1)
+        mock.assert_called_once_with(batch_size=10)
+
+    def test_report_is_printed(self):
+        mommy.make(Course, state='approved', vote_start_date=datetime.date.today())
+        mommy.make(Course, state='published', vote_end_date=datetime.date.today() - datetime.timedelta(days=1))
+        output = StringIO()
+
+        management.call_command('update_course_states', stdout=output)
+
+        self.assertIn("Scanned 1 courses: the evaluation of 1 courses began", output.getvalue())
 
 
 class TestDumpTestDataCommand(TestCase):
@@ -96,11 +235,11 @@ class TestSendRemindersCommand(TestCase):
                 vote_end_date=self.today + datetime.timedelta(days=2),
                 participants=[user_to_remind])
 
-        with patch('evap.evaluation.models.EmailTemplate.send_reminder_to_user') as mock:
+        with patch('evap.evaluation.models.EmailTemplate.send_reminders_to_users') as mock:
             management.call_command('send_reminders')
 
         self.assertEqual(mock.call_count, 1)
-        mock.assert_called_once_with(user_to_remind, first_due_in_days=2, due_courses=[(course, 2)])
+        mock.assert_called_once_with({user_to_remind: [(course, 2)]})
 
     def test_remind_user_once_about_two_courses(self):
         user_to_remind = mommy.make(UserProfile)
@@ -117,11 +256,11 @@ class TestSendRemindersCommand(TestCase):
                 vote_end_date=self.today + datetime.timedelta(days=2),
                 participants=[user_to_remind])
 
-        with patch('evap.evaluation.models.EmailTemplate.send_reminder_to_user') as mock:
+        with patch('evap.evaluation.models.EmailTemplate.send_reminders_to_users') as mock:
             management.call_command('send_reminders')
 
         self.assertEqual(mock.call_count, 1)
-        mock.assert_called_once_with(user_to_remind, first_due_in_days=0, due_courses=[(course1, 0), (course2, 2)])
+        mock.assert_called_once_with({user_to_remind: [(course1, 0), (course2, 2)]})
 
     def test_dont_remind_already_voted(self):
         user_no_remind = mommy.make(UserProfile)
@@ -133,8 +272,34 @@ class TestSendRemindersCommand(TestCase):
                 participants=[user_no_remind],
                 voters=[user_no_remind])
 
-        with patch('evap.evaluation.models.EmailTemplate.send_reminder_to_user') as mock:
+        with patch('evap.evaluation.models.EmailTemplate.send_reminders_to_users') as mock:
+            management.call_command('send_reminders')
+
+        mock.assert_called_once_with({})
+        self.assertEqual(len(mail.outbox), 0)
+
+    def test_reminders_are_sent_in_one_pass(self):
+        users = [mommy.make(UserProfile, email="user{}@institution.example.com".format(i)) for i in range(3)]
+        for days_left in [0, 2]:
+            mommy.make(Course, state='in_evaluation', vote_start_date=self.today - datetime.timedelta(days=1),
+                       vote_end_date=self.today + datetime.timedelta(days=days_left), participants=users)
+        # not ending soon, but also listed in the reminders
+        mommy.make(Course, state='in_evaluation', vote_start_date=self.today - datetime.timedelta(days=1),
+                   vote_end_date=self.today + datetime.timedelta(days=5), participants=users[:1])
+
+        # the reminder template, the participations, the courses and the users
+        with self.assertNumQueries(4):
             management.call_command('send_reminders')
 
-        self.assertEqual(mock.call_count, 0)
+        self.assertEqual([message.to for message in mail.outbox], [[user.email] for user in users])
+
+    def test_dry_run(self):
+        user = mommy.make(UserProfile, email="user@institution.example.com")
+        mommy.make(Course, state='in_evaluation', vote_start_date=self.today - datetime.timedelta(days=1),
+                   vote_end_date=self.today, participants=[user])
+        output = StringIO()
+
+        management.call_command('send_reminders', dry_run=True, stdout=output)
+
+        self.assertIn("Would send reminders to 1 people about 1 courses.", output.getvalue())
         self.assertEqual(len(mail.outbox), 0)
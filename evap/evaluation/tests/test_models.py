@@ -1,15 +1,23 @@
-from datetime import date, timedelta
-from unittest.mock import patch, Mock
+from datetime import date, datetime, timedelta
+from smtplib import SMTPException
+from unittest.mock import patch
 
+from django.contrib.auth.models import Group
 from django.test import TestCase
 from django.core.cache import cache
 from django.core import mail
+from django.core.mail import get_connection
+from django.core.mail.backends import locmem
+from django.template import Template
+from django.test.utils import override_settings
 
 from model_mommy import mommy
 
-from evap.evaluation.models import Course, UserProfile, Contribution, Semester, \
-                                   Questionnaire, CourseType, NotArchiveable, EmailTemplate
-from evap.results.tools import calculate_average_grades_and_deviation
+from evap.evaluation.management.commands.compact_rating_answer_counters import compact_counters
+from evap.evaluation.models import Course, CourseAccessContext, CourseUpdateReport, UserProfile, Contribution, Semester, \
+                                   Questionnaire, Question, CourseType, NotArchiveable, EmailTemplate, OutboxMessage, QueuedBallot, RatingAnswerCounter, \
+                                   TextAnswer, compile_email_template, get_user_roles_version
+from evap.results.tools import calculate_average_grades_and_deviation, calculate_results
 
 
 class TestCourses(TestCase):
@@ -29,10 +37,9 @@ class TestCourses(TestCase):
 
     def test_in_evaluation_to_evaluated(self):
         course = mommy.make(Course, state='in_evaluation', vote_end_date=date.today() - timedelta(days=1))
+        mommy.make(TextAnswer, contribution=course.general_contribution, state=TextAnswer.NOT_REVIEWED)
 
-        with patch('evap.evaluation.models.Course.is_fully_reviewed') as mock:
-            mock.__get__ = Mock(return_value=False)
-            Course.update_courses()
+        Course.update_courses()
 
         course = Course.objects.get(pk=course.pk)
         self.assertEqual(course.state, 'evaluated')
@@ -70,6 +77,29 @@ class TestCourses(TestCase):
         self.assertEqual(len(mail.outbox), 1)
         self.assertEqual(course.state, 'in_evaluation')
 
+    def test_update_courses_only_loads_due_courses(self):
+        mommy.make(Course, state='approved', vote_start_date=date.today())
+        mommy.make(Course, state='in_evaluation', vote_end_date=date.today() - timedelta(days=1), is_graded=False)
+        mommy.make(Course, state='in_evaluation', vote_end_date=date.today())
+        mommy.make(Course, state='published', vote_end_date=date.today() - timedelta(days=1), _quantity=3)
+
+        with patch('evap.evaluation.tools.send_publish_notifications'):
+            report = Course.update_courses(batch_size=1)
+
+        self.assertEqual(report, CourseUpdateReport(scanned_count=2, begun_count=1, ended_count=1, published_count=1))
+
+    def test_update_courses_continues_after_errors(self):
+        failing_course = mommy.make(Course, state='approved', vote_start_date=date.today() - timedelta(days=2), vote_end_date=date.today() - timedelta(days=1))
+        course = mommy.make(Course, state='approved', vote_start_date=date.today())
+
+        with patch('evap.evaluation.models.logger.exception') as mock_logger:
+            report = Course.update_courses()
+
+        self.assertEqual(mock_logger.call_count, 1)
+        self.assertEqual(report.begun_count, 1)
+        self.assertEqual(Course.objects.get(pk=failing_course.pk).state, 'approved')
+        self.assertEqual(Course.objects.get(pk=course.pk).state, 'in_evaluation')
+
     def test_has_enough_questionnaires(self):
         # manually circumvent Course's save() method to have a Course without a general contribution
         # the semester must be specified because of https://github.com/vandersonmota/model_mommy/issues/258
@@ -117,8 +147,91 @@ class TestCourses(TestCase):
         self.assertEqual(list(course.responsible_contributors), [responsible2, responsible1])
 
 
+class TestCourseAccessContext(TestCase):
+    def setUp(self):
+        self.user = mommy.make(UserProfile)
+        self.represented_user = mommy.make(UserProfile, delegates=[self.user])
+        self.courses = mommy.make(Course, state='in_evaluation', vote_start_date=date.today(), vote_end_date=date.today(), is_private=True, _quantity=4)
+
+    def test_permissions(self):
+        self.courses[0].participants.add(self.user)
+        self.courses[1].participants.add(self.user)
+        self.courses[1].voters.add(self.user)
+        mommy.make(Contribution, course=self.courses[2], contributor=self.user, can_edit=True)
+        mommy.make(Contribution, course=self.courses[3], contributor=self.represented_user, responsible=True, can_edit=True,
+                   comment_visibility=Contribution.ALL_COMMENTS)
+
+        self.assertEqual([course.can_user_vote(self.user) for course in self.courses], [True, False, False, False])
+        self.assertEqual([course.can_user_see_course(self.user) for course in self.courses], [True, True, True, True])
+        self.assertEqual([course.is_user_editor(self.user) for course in self.courses], [False, False, True, False])
+        self.assertEqual([course.is_user_editor_or_delegate(self.user) for course in self.courses], [False, False, True, True])
+        self.assertEqual([course.is_user_responsible_or_delegate(self.user) for course in self.courses], [False, False, False, True])
+        self.assertEqual([course.is_user_contributor(self.user) for course in self.courses], [False, False, True, False])
+        self.assertEqual([course.is_user_contributor_or_delegate(self.user) for course in self.courses], [False, False, True, True])
+        self.assertFalse(self.courses[0].can_user_see_course(mommy.make(UserProfile)))
+
+    def test_number_of_queries_is_independent_of_number_of_courses(self):
+        # the roles for is_reviewer, participants, contributions and contributions of represented users
+        with self.assertNumQueries(4):
+            for course in self.courses:
+                course.can_user_see_course(self.user)
+
+    def test_forget(self):
+        self.assertFalse(self.courses[0].can_user_vote(self.user))
+        self.courses[0].participants.add(self.user)
+        self.assertFalse(self.courses[0].can_user_vote(self.user))
+
+        CourseAccessContext.forget(self.user)
+        self.assertTrue(self.courses[0].can_user_vote(self.user))
+
+
 class TestUserProfile(TestCase):
 
+    def test_roles_are_loaded_with_one_query(self):
+        user = mommy.make(UserProfile, groups=[Group.objects.get(name='Reviewer')], courses_participating_in=[mommy.make(Course)])
+        mommy.make(UserProfile, delegates=[user])
+        user = UserProfile.objects.get(pk=user.pk)
+
+        with self.assertNumQueries(1):
+            roles = (user.is_staff, user.is_reviewer, user.is_grade_publisher, user.is_participant, user.is_contributor, user.is_editor, user.is_delegate)
+        self.assertEqual(roles, (False, True, False, True, False, False, True))
+
+    def test_roles_version_changes_with_roles(self):
+        user = mommy.make(UserProfile)
+        other_user = mommy.make(UserProfile)
+        course = mommy.make(Course)
+
+        def assert_version_changes(change, changed_user=user):
+            versions = {user.pk: get_user_roles_version(user.pk), other_user.pk: get_user_roles_version(other_user.pk)}
+            change()
+            for user_id, version in versions.items():
+                if user_id == changed_user.pk:
+                    self.assertNotEqual(get_user_roles_version(user_id), version)
+                else:
+                    self.assertEqual(get_user_roles_version(user_id), version)
+
+        staff_group = Group.objects.get(name='Staff')
+        assert_version_changes(lambda: user.groups.add(staff_group))
+        assert_version_changes(lambda: staff_group.user_set.clear())
+        assert_version_changes(lambda: course.participants.add(user))
+        assert_version_changes(lambda: course.participants.clear())
+        assert_version_changes(lambda: mommy.make(UserProfile, delegates=[user]))
+        contribution = mommy.make(Contribution, course=course, contributor=user)
+        assert_version_changes(lambda: Contribution.objects.get(pk=contribution.pk).delete())
+        course.participants.add(other_user)
+        assert_version_changes(lambda: course.delete(), changed_user=other_user)
+
+    def test_roles_version_changes_with_previous_contributor(self):
+        user = mommy.make(UserProfile)
+        contribution = mommy.make(Contribution, contributor=user)
+        version = get_user_roles_version(user.pk)
+
+        contribution = Contribution.objects.get(pk=contribution.pk)
+        contribution.contributor = mommy.make(UserProfile)
+        contribution.save()
+
+        self.assertNotEqual(get_user_roles_version(user.pk), version)
+
     def test_is_student(self):
         some_user = mommy.make(UserProfile)
         self.assertFalse(some_user.is_student)
@@ -238,10 +351,9 @@ class ArchivingTests(TestCase):
 
     def test_archiving_doesnt_change_single_results_participant_count(self):
         responsible = mommy.make(UserProfile)
-        course = mommy.make(Course, state="published")
+        course = mommy.make(Course, state="published", is_single_result=True)
         contribution = mommy.make(Contribution, course=course, contributor=responsible, responsible=True, can_edit=True, comment_visibility=Contribution.ALL_COMMENTS)
         contribution.questionnaires.add(Questionnaire.single_result_questionnaire())
-        self.assertTrue(course.is_single_result)
 
         course._participant_count = 5
         course._voter_count = 5
@@ -252,6 +364,192 @@ class ArchivingTests(TestCase):
         self.assertEqual(course._voter_count, 5)
 
 
+class TestParticipantAndVoterCounts(TestCase):
+    def setUp(self):
+        self.course = mommy.make(Course)
+        self.students = mommy.make(UserProfile, _quantity=3)
+
+    def assert_counts(self, participant_count, voter_count):
+        course = Course.objects.get(pk=self.course.pk)
+        self.assertEqual((course.num_participants, course.num_voters), (participant_count, voter_count))
+
+    def test_counts_follow_course_changes(self):
+        self.course.participants.add(*self.students)
+        self.course.voters.add(self.students[0])
+        self.assertEqual((self.course.num_participants, self.course.num_voters), (3, 1))
+        self.assert_counts(3, 1)
+
+        self.course.participants.remove(self.students[1])
+        self.assert_counts(2, 1)
+
+        self.course.voters.clear()
+        self.assert_counts(2, 0)
+
+    def test_counts_follow_user_changes(self):
+        self.students[0].courses_participating_in.add(self.course)
+        self.students[1].courses_participating_in.add(self.course)
+        self.students[0].courses_voted_for.add(self.course)
+        self.assert_counts(2, 1)
+
+        self.students[0].courses_voted_for.clear()
+        self.assert_counts(2, 0)
+
+        self.students[0].delete()
+        self.assert_counts(1, 0)
+
+    def test_counts_of_archived_courses_are_not_updated(self):
+        self.course.participants.add(*self.students)
+        self.course.semester.is_archived = True
+        self.course.semester.save()
+
+        self.course.participants.remove(self.students[0])
+        self.assert_counts(3, 0)
+
+    def test_counts_of_single_results_are_not_updated(self):
+        course = mommy.make(Course, is_single_result=True, _participant_count=5, _voter_count=5)
+        contribution = mommy.make(Contribution, course=course, contributor=mommy.make(UserProfile), responsible=True, can_edit=True, comment_visibility=Contribution.ALL_COMMENTS)
+        contribution.questionnaires.add(Questionnaire.single_result_questionnaire())
+
+        Course.update_participant_and_voter_counts([course.pk])
+        course = Course.objects.get(pk=course.pk)
+        self.assertEqual((course.num_participants, course.num_voters), (5, 5))
+
+
+class TestAddBallot(TestCase):
+    def setUp(self):
+        self.student = mommy.make(UserProfile)
+        self.course = mommy.make(Course, state='in_evaluation', participants=[self.student])
+        self.question = mommy.make(Question, type="G")
+        self.rating_votes = [(self.course.general_contribution.id, self.question.id, 1)]
+
+    def test_add_ballot(self):
+        with patch('evap.evaluation.models.transaction.on_commit'):
+            self.assertTrue(self.course.add_ballot(self.student, self.rating_votes, []))
+
+        self.assertEqual(list(self.course.voters.all()), [self.student])
+        self.assertEqual(RatingAnswerCounter.objects.get(contribution=self.course.general_contribution, question=self.question, answer=1).count, 1)
+
+        # a second vote of the same user isn't recorded
+        self.assertFalse(self.course.add_ballot(self.student, self.rating_votes, []))
+        self.assertEqual(RatingAnswerCounter.objects.get(contribution=self.course.general_contribution, question=self.question, answer=1).count, 1)
+
+    def test_voter_count_is_updated_after_commit(self):
+        with patch('evap.evaluation.models.transaction.on_commit') as mock:
+            self.course.add_ballot(self.student, self.rating_votes, [])
+
+            # the course row isn't locked while the ballot is written
+            self.assertEqual(Course.objects.get(pk=self.course.pk).num_voters, 0)
+
+        mock.call_args[0][0]()
+        self.assertEqual(Course.objects.get(pk=self.course.pk).num_voters, 1)
+
+
+class TestRatingAnswerCounter(TestCase):
+    def setUp(self):
+        self.contribution = mommy.make(Contribution)
+        self.question = mommy.make(Question, type="G")
+
+    def get_counts(self):
+        return dict(RatingAnswerCounter.objects.filter(contribution=self.contribution, question=self.question).values_list('answer', 'count'))
+
+    def test_add_votes(self):
+        mommy.make(RatingAnswerCounter, contribution=self.contribution, question=self.question, answer=1, count=2)
+
+        # loading, creating (in a savepoint) and incrementing the counters in a transaction
+        with self.assertNumQueries(7):
+            RatingAnswerCounter.add_votes([(self.contribution.id, self.question.id, 1), (self.contribution.id, self.question.id, 3)])
+
+        self.assertEqual(self.get_counts(), {1: 3, 3: 1})
+
+    def test_add_votes_to_shards(self):
+        for __ in range(20):
+            RatingAnswerCounter.add_votes([(self.contribution.id, self.question.id, 1)], shards=3)
+
+        counters = RatingAnswerCounter.objects.filter(contribution=self.contribution, question=self.question, answer=1)
+        self.assertLessEqual(counters.count(), 3)
+        self.assertEqual(sum(counter.count for counter in counters), 20)
+
+    def test_add_votes_with_concurrently_created_counter(self):
+        mommy.make(RatingAnswerCounter, contribution=self.contribution, question=self.question, answer=1, count=1)
+        queryset_filter = RatingAnswerCounter.objects.filter
+        lookups = []
+
+        def filter_with_concurrently_created_counter(*args, **kwargs):
+            # the first lookup happens before another vote created the counter
+            lookups.append(kwargs)
+            if len(lookups) == 1:
+                return RatingAnswerCounter.objects.none()
+            return queryset_filter(*args, **kwargs)
+
+        with patch.object(RatingAnswerCounter.objects, 'filter', side_effect=filter_with_concurrently_created_counter):
+            RatingAnswerCounter.add_votes([(self.contribution.id, self.question.id, 1)])
+
+        self.assertEqual(self.get_counts(), {1: 2})
+
+    def test_add_votes_with_concurrently_compacted_counters(self):
+        for shard in range(2):
+            mommy.make(RatingAnswerCounter, contribution=self.contribution, question=self.question, answer=1, shard=shard, count=1)
+        get_counter_ids = RatingAnswerCounter._get_counter_ids
+        lookups = []
+
+        def get_counter_ids_and_compact(vote_counts):
+            # the counters are compacted after the first lookup, which deletes the one that is about to be incremented
+            counter_ids = get_counter_ids(vote_counts)
+            lookups.append(vote_counts)
+            if len(lookups) == 1:
+                compact_counters(RatingAnswerCounter.objects.all())
+            return counter_ids
+
+        with patch.object(RatingAnswerCounter, '_get_counter_ids', side_effect=get_counter_ids_and_compact), \
+                patch('evap.evaluation.models.random.randrange', return_value=1):
+            RatingAnswerCounter.add_votes([(self.contribution.id, self.question.id, 1)], shards=2)
+
+        self.assertEqual(len(lookups), 2)
+        counters = RatingAnswerCounter.objects.filter(contribution=self.contribution, question=self.question, answer=1)
+        self.assertEqual(sum(counter.count for counter in counters), 3)
+
+
+class TestQueuedBallot(TestCase):
+    def setUp(self):
+        self.course = mommy.make(Course, state='published')
+        questionnaire = mommy.make(Questionnaire)
+        self.rating_question = mommy.make(Question, questionnaire=questionnaire, type="G")
+        self.text_question = mommy.make(Question, questionnaire=questionnaire, type="T")
+        self.contribution = mommy.make(Contribution, course=self.course, contributor=mommy.make(UserProfile), questionnaires=[questionnaire])
+        mommy.make(RatingAnswerCounter, contribution=self.contribution, question=self.rating_question, answer=1, count=1)
+        for answer in [1, 3, 3]:
+            text_answer = TextAnswer(contribution=self.contribution, question=self.text_question, answer="text {}".format(answer))
+            QueuedBallot.create(self.course, [(self.contribution.id, self.rating_question.id, answer)], [text_answer])
+
+    def test_results_contain_queued_votes(self):
+        rating_result = calculate_results(self.course)[0].results[0]
+
+        self.assertEqual(list(rating_result.counts.values()), [2, 0, 2, 0, 0])
+
+    def test_processing_keeps_results(self):
+        results = calculate_results(self.course)
+
+        self.assertEqual(QueuedBallot.process(batch_size=2), 2)
+        self.assertEqual(QueuedBallot.process(batch_size=2), 1)
+        self.assertEqual(QueuedBallot.process(batch_size=2), 0)
+
+        self.assertEqual(dict(RatingAnswerCounter.objects.values_list('answer', 'count')), {1: 2, 3: 2})
+        self.assertEqual(set(TextAnswer.objects.values_list('original_answer', flat=True)), {"text 1", "text 3"})
+        self.assertEqual(calculate_results(self.course), results)
+        self.assertEqual(calculate_results(self.course, force_recalculation=True), results)
+
+    def test_course_with_queued_ballots_is_not_fully_reviewed(self):
+        self.assertFalse(self.course.open_textanswer_set.exists())
+        self.assertFalse(self.course.is_fully_reviewed)
+        self.assertTrue(self.course.is_not_fully_reviewed)
+
+        QueuedBallot.process(batch_size=10)
+        TextAnswer.objects.update(state=TextAnswer.PUBLISHED)
+
+        self.assertTrue(self.course.is_fully_reviewed)
+        self.assertFalse(self.course.is_not_fully_reviewed)
+
+
 class TestLoginUrlEmail(TestCase):
 
     @classmethod
@@ -309,6 +607,146 @@ class TestEmailTemplate(TestCase):
         template = EmailTemplate.objects.get(name=EmailTemplate.STUDENT_REMINDER)
         EmailTemplate.send_to_user(user, template, {}, {}, False, None)
 
+    @override_settings(EMAIL_BATCH_SIZE=2)
+    def test_emails_are_sent_in_batches(self):
+        users = [mommy.make(UserProfile, email="user{}@institution.example.com".format(i)) for i in range(5)]
+        template = mommy.make(EmailTemplate, subject="Hello {{ user.username }}", body="")
+
+        with patch('evap.evaluation.models.get_connection', wraps=get_connection) as mock:
+            failed_users = EmailTemplate.send_to_users(template, [(user, {'user': user}, {}) for user in users], use_cc=False)
+
+        self.assertEqual(failed_users, [])
+        self.assertEqual(mock.call_count, 3)
+        self.assertEqual([message.subject for message in mail.outbox], ["Hello " + user.username for user in users])
+
+    def test_failed_emails_are_reported(self):
+        users = [mommy.make(UserProfile, email="user{}@institution.example.com".format(i)) for i in range(3)]
+        template = mommy.make(EmailTemplate, subject="", body="")
+        send_messages = locmem.EmailBackend.send_messages
+
+        def fail_for_second_user(backend, messages):
+            if messages[0].to == [users[1].email]:
+                raise SMTPException()
+            return send_messages(backend, messages)
+
+        with patch.object(locmem.EmailBackend, 'send_messages', autospec=True, side_effect=fail_for_second_user):
+            with patch('evap.evaluation.models.logger.exception') as mock_logger:
+                failed_users = EmailTemplate.send_to_users(template, [(user, {}, {}) for user in users], use_cc=False)
+
+        self.assertEqual(failed_users, [users[1]])
+        self.assertEqual(mock_logger.call_count, 1)
+        self.assertEqual([message.to for message in mail.outbox], [[users[0].email], [users[2].email]])
+
+    def test_templates_are_compiled_once(self):
+        users = [mommy.make(UserProfile, email="user{}@institution.example.com".format(i)) for i in range(3)]
+        template = mommy.make(EmailTemplate, subject="Hello {{ user.username }}", body="Body of {{ user.username }}")
+        compile_email_template.cache_clear()
+
+        with patch('evap.evaluation.models.Template', wraps=Template) as mock:
+            EmailTemplate.send_to_users(template, [(user, {'user': user}, {'user': user}) for user in users], use_cc=False)
+
+        self.assertEqual(mock.call_count, 2)
+        self.assertEqual([message.body for message in mail.outbox], ["Body of " + user.username for user in users])
+
+
+@override_settings(EMAIL_OUTBOX_ENABLED=True, EMAIL_OUTBOX_RETRY_DELAY=60, EMAIL_OUTBOX_MAX_ATTEMPTS=2)
+class TestOutboxMessage(TestCase):
+    def setUp(self):
+        self.users = [mommy.make(UserProfile, email="user{}@institution.example.com".format(i)) for i in range(3)]
+        template = mommy.make(EmailTemplate, subject="Hello {{ user.username }}", body="Body")
+        EmailTemplate.send_to_users(template, [(user, {'user': user}, {}) for user in self.users], use_cc=False)
+
+    def test_emails_are_enqueued(self):
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(OutboxMessage.objects.filter(state=OutboxMessage.QUEUED).count(), 3)
+
+    def test_login_url_is_sent_immediately(self):
+        EmailTemplate.send_login_url_to_user(mommy.make(UserProfile, email="external@example.com"))
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(OutboxMessage.objects.count(), 3)
+
+    def test_send_due(self):
+        with patch('evap.evaluation.models.get_connection', wraps=get_connection) as mock:
+            report = OutboxMessage.send_due(batch_size=2)
+
+        self.assertEqual(report, (3, 0, 0))
+        self.assertEqual(mock.call_count, 2)
+        self.assertEqual(sorted(message.to[0] for message in mail.outbox), [user.email for user in self.users])
+        self.assertEqual(mail.outbox[0].subject, "Hello " + self.users[0].username)
+        self.assertEqual(OutboxMessage.objects.filter(state=OutboxMessage.SENT, sent_time__isnull=False).count(), 3)
+        self.assertEqual(OutboxMessage.send_due(batch_size=2), (0, 0, 0))
+
+    def test_failed_emails_are_retried_and_marked_as_failed(self):
+        send_messages = locmem.EmailBackend.send_messages
+
+        def fail_for_first_user(backend, messages):
+            if messages[0].to == [self.users[0].email]:
+                raise SMTPException("unavailable")
+            return send_messages(backend, messages)
+
+        with patch.object(locmem.EmailBackend, 'send_messages', autospec=True, side_effect=fail_for_first_user):
+            with patch('evap.evaluation.models.logger.exception'):
+                self.assertEqual(OutboxMessage.send_due(batch_size=10), (2, 1, 0))
+                message = OutboxMessage.objects.get(user=self.users[0])
+                self.assertEqual(message.state, OutboxMessage.QUEUED)
+                self.assertEqual(message.last_error, "SMTPException: unavailable")
+                self.assertGreater(message.next_attempt_time, datetime.now() + timedelta(seconds=50))
+
+                # the next attempt isn't due yet
+                self.assertEqual(OutboxMessage.send_due(batch_size=10), (0, 0, 0))
+
+                OutboxMessage.objects.filter(pk=message.pk).update(next_attempt_time=datetime.now())
+                self.assertEqual(OutboxMessage.send_due(batch_size=10), (0, 0, 1))
+
+        self.assertEqual(OutboxMessage.objects.get(pk=message.pk).state, OutboxMessage.FAILED)
+        self.assertEqual(OutboxMessage.retry_failed(), 1)
+        self.assertEqual(OutboxMessage.send_due(batch_size=10), (1, 0, 0))
+        self.assertEqual(len(mail.outbox), 3)
+
+    def test_failed_connection(self):
+        with patch.object(locmem.EmailBackend, 'open', autospec=True, side_effect=SMTPException()):
+            with patch('evap.evaluation.models.logger.exception'):
+                self.assertEqual(OutboxMessage.send_due(batch_size=10), (0, 3, 0))
+        self.assertEqual(len(mail.outbox), 0)
+
+    def test_rate_limit(self):
+        with patch('evap.evaluation.models.time.sleep') as mock_sleep:
+            OutboxMessage.send_due(batch_size=10, rate_limit=2)
+
+        self.assertEqual(mock_sleep.call_count, 2)
+        self.assertLessEqual(mock_sleep.call_args[0][0], 0.5)
+
+    def test_messages_are_claimed_before_sending(self):
+        def send_messages(backend, messages):
+            # other workers don't get the messages of this batch while they are sent
+            self.assertEqual(OutboxMessage.claim_due(batch_size=10), [])
+            return len(messages)
+
+        with patch.object(locmem.EmailBackend, 'send_messages', autospec=True, side_effect=send_messages):
+            self.assertEqual(OutboxMessage.send_due(batch_size=10), (3, 0, 0))
+
+    def test_claimed_messages_are_sent_again_after_claim_duration(self):
+        claim_time = datetime.now()
+        self.assertEqual(len(OutboxMessage.claim_due(batch_size=10)), 3)
+        self.assertEqual(OutboxMessage.send_due(batch_size=10), (0, 0, 0))
+        for message in OutboxMessage.objects.all():
+            self.assertGreaterEqual(message.next_attempt_time, claim_time + OutboxMessage.CLAIM_DURATION)
+
+        # the worker that claimed the messages has been stopped
+        OutboxMessage.objects.update(next_attempt_time=datetime.now())
+        self.assertEqual(OutboxMessage.send_due(batch_size=10), (3, 0, 0))
+
+    @override_settings(EMAIL_OUTBOX_RETENTION_DAYS=30)
+    def test_delete_old_sent(self):
+        OutboxMessage.send_due(batch_size=10)
+        old_message = OutboxMessage.objects.get(user=self.users[0])
+        OutboxMessage.objects.filter(pk=old_message.pk).update(sent_time=datetime.now() - timedelta(days=31))
+        OutboxMessage.objects.filter(user=self.users[1]).update(state=OutboxMessage.FAILED, sent_time=None)
+
+        self.assertEqual(OutboxMessage.delete_old_sent(), 1)
+        self.assertFalse(OutboxMessage.objects.filter(pk=old_message.pk).exists())
+        self.assertEqual(OutboxMessage.objects.count(), 2)
+
 
 class TestEmailRecipientList(TestCase):
     def test_recipient_list(self):
@@ -342,6 +780,16 @@ class TestEmailRecipientList(TestCase):
         recipient_list = EmailTemplate.recipient_list_for_course(course, [EmailTemplate.DUE_PARTICIPANTS], filter_users_in_cc=False)
         self.assertCountEqual(recipient_list, [participant2])
 
+        # the broader one of several selected groups is used
+        recipient_list = EmailTemplate.recipient_list_for_course(course, [EmailTemplate.CONTRIBUTORS, EmailTemplate.EDITORS], filter_users_in_cc=False)
+        self.assertCountEqual(recipient_list, [responsible, editor, contributor])
+
+        recipient_list = EmailTemplate.recipient_list_for_course(course, [EmailTemplate.EDITORS, EmailTemplate.RESPONSIBLE], filter_users_in_cc=False)
+        self.assertCountEqual(recipient_list, [responsible, editor])
+
+        recipient_list = EmailTemplate.recipient_list_for_course(course, [EmailTemplate.RESPONSIBLE, EmailTemplate.DUE_PARTICIPANTS], filter_users_in_cc=False)
+        self.assertCountEqual(recipient_list, [responsible, participant2])
+
     def test_recipient_list_filtering(self):
         course = mommy.make(Course)
 
@@ -370,3 +818,24 @@ class TestEmailRecipientList(TestCase):
         # contributor2 is in cc of contributor3 but is not filtered since contributor1 wouldn't get an email at all then.
         recipient_list = EmailTemplate.recipient_list_for_course(course, [EmailTemplate.CONTRIBUTORS], filter_users_in_cc=True)
         self.assertCountEqual(recipient_list, [contributor2, contributor3])
+
+    def test_recipients_for_courses(self):
+        courses = mommy.make(Course, _quantity=3)
+        editor = mommy.make(UserProfile)
+        delegate = mommy.make(UserProfile)
+        editor.delegates.set([delegate])
+        for course in courses:
+            mommy.make(Contribution, course=course, contributor=editor, can_edit=True)
+            mommy.make(Contribution, course=course, contributor=delegate, can_edit=True)
+        other_editor = mommy.make(UserProfile)
+        mommy.make(Contribution, course=courses[0], contributor=other_editor, can_edit=True)
+        mommy.make(Contribution, course=courses[0], contributor=mommy.make(UserProfile))
+
+        # contributions, delegates, CC users, recipients and their delegates and CC users
+        with self.assertNumQueries(6):
+            recipients = EmailTemplate.recipients_for_courses(courses, [EmailTemplate.EDITORS], filter_users_in_cc=True)
+            # the delegates and CC users are prefetched
+            self.assertEqual({user: list(user.delegates.all()) + list(user.cc_users.all()) for user in recipients},
+                             {editor: [delegate], other_editor: []})
+
+        self.assertEqual(recipients, {editor: courses, other_editor: [courses[0]]})
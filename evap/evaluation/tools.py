@@ -2,11 +2,12 @@ from collections import OrderedDict, defaultdict
 
 from django.conf import settings
 from django.contrib.auth import user_logged_in
+from django.db.models import prefetch_related_objects
 from django.dispatch import receiver
 from django.utils.translation import ugettext_lazy as _
 from django.utils import translation
 from django.utils.translation import LANGUAGE_SESSION_KEY, get_language
-from evap.evaluation.models import Course, EmailTemplate
+from evap.evaluation.models import Contribution, Course, EmailTemplate
 
 LIKERT_NAMES = {
     1: _("Strongly agree"),
@@ -61,14 +62,25 @@ STUDENT_STATES_ORDERED = OrderedDict((
 
 def questionnaires_and_contributions(course):
     """Yields tuples of (questionnaire, contribution) for the given course."""
-    result = []
+    return questionnaires_and_contributions_for_courses([course])[course.id]
 
-    for contribution in course.contributions.all():
+
+def questionnaires_and_contributions_for_courses(courses):
+    """Returns a dict mapping the ids of the given courses to lists of
+    (questionnaire, contribution) tuples, like `questionnaires_and_contributions`.
+    The number of queries does not depend on the number of courses."""
+    courses_by_id = {course.id: course for course in courses}
+    result = defaultdict(list)
+
+    contributions = Contribution.objects.filter(course__in=courses).select_related('contributor').prefetch_related('questionnaires__question_set')
+    for contribution in contributions:
+        contribution.course = courses_by_id[contribution.course_id]
         for questionnaire in contribution.questionnaires.all():
-            result.append((questionnaire, contribution))
+            result[contribution.course_id].append((questionnaire, contribution))
 
     # sort questionnaires for general contributions first
-    result.sort(key=lambda t: not t[1].is_general)
+    for course_result in result.values():
+        course_result.sort(key=lambda t: not t[1].is_general)
 
     return result
 
@@ -100,9 +112,10 @@ def send_publish_notifications(courses, template=None):
             for contributor in course.responsible_contributors:
                 publish_notifications[contributor].add(course)
 
-    for user, course_set in publish_notifications.items():
-        body_params = {'user': user, 'courses': list(course_set)}
-        EmailTemplate.send_to_user(user, template, {}, body_params, use_cc=True)
+    # the delegates and CC users are put in CC
+    prefetch_related_objects(list(publish_notifications), 'delegates', 'cc_users')
+    recipients = [(user, {}, {'user': user, 'courses': list(course_set)}) for user, course_set in publish_notifications.items()]
+    EmailTemplate.send_to_users(template, recipients, use_cc=True)
 
 
 def sort_formset(request, formset):
@@ -0,0 +1,144 @@
+"""Rating answer distributions of many courses as NumPy arrays.
+
+A `SemesterDistribution` contains a dense array of the numbers of answers of
+each course (rows), rating question (columns) and possible answer (buckets),
+so that statistics on all courses and questions of a semester are calculated
+as vectorized operations instead of walking the results course by course.
+Like in the results, the answers of all contributions to a question are
+combined, the votes of queued ballots are included, and only answers to
+questionnaires that are still assigned to their contribution are counted.
+"""
+
+from collections import OrderedDict
+
+from django.db.models import F
+
+import numpy as np
+
+from evap.evaluation.models import Contribution, Course, QueuedBallot, RatingAnswerCounter
+from evap.results.histogram import ANSWERS
+
+ANSWER_VALUES = np.array(ANSWERS, dtype=float)
+
+
+def _statistics(counts):
+    """Returns the numbers of answers, the averages and the population standard
+    deviations of an array of histograms along its last axis. Averages and
+    deviations are NaN where there are no answers."""
+    totals = counts.sum(axis=-1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        averages = (counts * ANSWER_VALUES).sum(axis=-1) / totals
+        differences = ANSWER_VALUES - averages[..., np.newaxis]
+        deviations = np.sqrt((counts * differences ** 2).sum(axis=-1) / totals)
+    return totals, averages, deviations
+
+
+class SemesterDistribution:
+    def __init__(self, keys, question_ids, counts, contribution_deviation_sums):
+        # maps the ids of the courses (or of the groups of courses) and questions to their index in the arrays
+        self.index = OrderedDict((key, i) for i, key in enumerate(keys))
+        self.question_index = OrderedDict((question_id, i) for i, question_id in enumerate(question_ids))
+        # counts[i, j, k] is the number of answers ANSWERS[k] to question j in course i
+        self.counts = counts
+        # the standard deviations of all contributions' answers, weighted by their number of answers
+        self.contribution_deviation_sums = contribution_deviation_sums
+
+    @classmethod
+    def for_courses(cls, courses):
+        """Loads the rating answers of the given courses with two queries."""
+        courses = list(courses)
+        answer_counters = list(RatingAnswerCounter.objects.filter(
+            contribution__course__in=courses,
+            contribution__questionnaires=F('question__questionnaire'),
+        ).values_list('contribution_id', 'contribution__course_id', 'question_id', 'answer', 'count'))
+        queued_vote_counts = QueuedBallot.get_rating_vote_counts(courses)
+        if queued_vote_counts:
+            contribution_courses = dict(Contribution.objects.filter(id__in={vote[0] for vote in queued_vote_counts}).values_list('id', 'course_id'))
+            answer_counters.extend(
+                (contribution_id, contribution_courses[contribution_id], question_id, answer, count)
+                for (contribution_id, question_id, answer), count in queued_vote_counts.items()
+            )
+        rows = np.array(answer_counters, dtype=np.int64).reshape(-1, 5)
+        contribution_ids, course_ids, question_ids, answers, answer_counts = rows.T
+
+        course_index = {course.id: i for i, course in enumerate(courses)}
+        all_question_ids, question_indices = np.unique(question_ids, return_inverse=True)
+        course_indices = np.array([course_index[course_id] for course_id in course_ids], dtype=np.int64)
+
+        # histograms of the answers of each contribution to each question
+        pairs, pair_indices = np.unique(contribution_ids * len(all_question_ids) + question_indices, return_inverse=True)
+        pair_counts = np.zeros((len(pairs), len(ANSWERS)))
+        np.add.at(pair_counts, (pair_indices, answers - ANSWERS[0]), answer_counts)
+        pair_totals, __, pair_deviations = _statistics(pair_counts)
+
+        pair_course_indices = np.zeros(len(pairs), dtype=np.int64)
+        pair_course_indices[pair_indices] = course_indices
+        pair_question_indices = np.zeros(len(pairs), dtype=np.int64)
+        pair_question_indices[pair_indices] = question_indices
+
+        counts = np.zeros((len(courses), len(all_question_ids), len(ANSWERS)))
+        np.add.at(counts, (pair_course_indices, pair_question_indices), pair_counts)
+        contribution_deviation_sums = np.zeros((len(courses), len(all_question_ids)))
+        np.add.at(contribution_deviation_sums, (pair_course_indices, pair_question_indices), np.nan_to_num(pair_deviations) * pair_totals)
+
+        return cls([course.id for course in courses], all_question_ids.tolist(), counts, contribution_deviation_sums)
+
+    def get_index(self, key, question_id):
+        """Returns the index of the given course (or group) and question in the
+        arrays or `None` if the question has not been answered."""
+        if question_id not in self.question_index:
+            return None
+        return self.index[key], self.question_index[question_id]
+
+    @property
+    def totals(self):
+        return self.counts.sum(axis=-1)
+
+    def averages(self):
+        return _statistics(self.counts)[1]
+
+    def deviations(self):
+        """Returns the standard deviations of all answers to each question."""
+        return _statistics(self.counts)[2]
+
+    def contribution_deviations(self):
+        """Returns the averages of the standard deviations of the answers of each
+        contribution, weighted by their numbers of answers, as in the exports."""
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.contribution_deviation_sums / self.totals
+
+    def percentile_ranks(self):
+        """Returns the percentage of courses (or groups) whose average answer to a
+        question is lower than or equal to the one of each course, so a low rank
+        means a good result. Only courses with answers to the question are ranked."""
+        averages = self.averages()
+        ranks = np.full(averages.shape, np.nan)
+        for column, question_averages in enumerate(averages.T):
+            answered = ~np.isnan(question_averages)
+            sorted_averages = np.sort(question_averages[answered])
+            ranks[answered, column] = 100 * np.searchsorted(sorted_averages, question_averages[answered], side='right') / len(sorted_averages)
+        return ranks
+
+    def aggregate(self, groups):
+        """Returns a distribution with one row per group, combining the answers of
+        its courses. `groups` maps the group keys to the ids of their courses."""
+        membership = np.zeros((len(groups), len(self.index)))
+        for i, course_ids in enumerate(groups.values()):
+            membership[i, [self.index[course_id] for course_id in course_ids]] = 1
+        counts = np.tensordot(membership, self.counts, axes=1)
+        contribution_deviation_sums = membership.dot(self.contribution_deviation_sums)
+        return SemesterDistribution(list(groups.keys()), list(self.question_index.keys()), counts, contribution_deviation_sums)
+
+    def by_degree(self):
+        """Returns a distribution with one row per degree, keyed by degree id."""
+        groups = OrderedDict()
+        for course_id, degree_id in Course.degrees.through.objects.filter(course_id__in=self.index.keys()).values_list('course_id', 'degree_id').order_by('degree_id'):
+            groups.setdefault(degree_id, []).append(course_id)
+        return self.aggregate(groups)
+
+    def by_course_type(self):
+        """Returns a distribution with one row per course type, keyed by course type id."""
+        groups = OrderedDict()
+        for course_id, type_id in Course.objects.filter(id__in=self.index.keys()).values_list('id', 'type_id').order_by('type_id'):
+            groups.setdefault(type_id, []).append(course_id)
+        return self.aggregate(groups)
@@ -0,0 +1,9 @@
+from django.conf import settings
+from django.core.signals import request_finished, request_started
+
+from evap.evaluation.cache import TwoTierCache
+
+
+results_cache = TwoTierCache('evap.results.cache.version-', settings.RESULTS_LOCAL_CACHE_MAX_ENTRIES, settings.RESULTS_LOCAL_CACHE_MAX_BYTES)
+request_started.connect(results_cache.request_started, dispatch_uid='evap.results.cache.request_started')
+request_finished.connect(results_cache.request_finished, dispatch_uid='evap.results.cache.request_finished')
@@ -1,11 +1,12 @@
-from collections import OrderedDict
-
+from django.conf import settings
+from django.db.models import ExpressionWrapper, F, FloatField
 from django.utils.translation import ugettext as _
 
 import xlwt
 
-from evap.evaluation.models import CourseType
-from evap.results.tools import calculate_results, calculate_average_grades_and_deviation, get_grade_color, get_deviation_color, has_no_rating_answers
+from evap.evaluation.models import CourseType, Questionnaire
+from evap.results.analytics import SemesterDistribution
+from evap.results.tools import complete_grade_summaries, get_grade_color, get_deviation_color, with_grade_summaries
 
 
 class ExcelExporter(object):
@@ -88,42 +89,40 @@ class ExcelExporter(object):
             self.row = 0
             self.col = 0
 
-            courses_with_results = list()
             course_states = ['published']
             if include_unpublished:
                 course_states.extend(['evaluated', 'reviewed'])
 
-            used_questionnaires = set()
-            for course in self.semester.course_set.filter(state__in=course_states, type__in=course_types).all():
-                if course.is_single_result:
-                    continue
-                if not course.can_publish_grades and not include_not_enough_answers:
-                    continue
-                results = OrderedDict()
-                for questionnaire, contributor, __, data, __ in calculate_results(course):
-                    if has_no_rating_answers(course, contributor, questionnaire):
-                        continue
-                    results.setdefault(questionnaire.id, []).extend(data)
-                    used_questionnaires.add(questionnaire)
-                courses_with_results.append((course, results))
-
-            courses_with_results.sort(key=lambda cr: (cr[0].type, cr[0].name))
-            used_questionnaires = sorted(used_questionnaires)
+            courses = self.semester.course_set.filter(state__in=course_states, type__in=course_types, is_single_result=False)
+            if not include_not_enough_answers:
+                # the same condition as in Course.can_publish_grades
+                min_voter_count = ExpressionWrapper(F('_participant_count') * settings.MIN_ANSWER_PERCENTAGE, output_field=FloatField())
+                courses = courses.filter(_voter_count__gte=settings.MIN_ANSWER_COUNT).filter(_voter_count__gte=min_voter_count)
+            courses = list(with_grade_summaries(courses).select_related('type', 'grade_summary'))
+            complete_grade_summaries(self.semester, courses)
+            courses.sort(key=lambda course: (course.type, course.name))
+
+            distribution = SemesterDistribution.for_courses(courses)
+            totals = distribution.totals
+            averages = distribution.averages()
+            deviations = distribution.contribution_deviations()
+            answered_question_ids = [question_id for question_id, index in distribution.question_index.items() if totals[:, index].any()]
+            used_questionnaires = Questionnaire.objects.filter(question__id__in=answered_question_ids).distinct().prefetch_related('question_set')
 
             course_type_names = [ct.name for ct in CourseType.objects.filter(pk__in=course_types)]
             writec(self, _("Evaluation {0}\n\n{1}").format(self.semester.name, ", ".join(course_type_names)), "headline")
 
-            for course, results in courses_with_results:
+            for course in courses:
                 writec(self, course.name, "course", cols=2)
 
             writen(self)
-            for course, results in courses_with_results:
+            for course in courses:
                 writec(self, _("Avg."), "avg")
                 writec(self, _("Std. dev."), "border_top_bottom_right")
 
             for questionnaire in used_questionnaires:
                 writen(self, questionnaire.name, "bold")
-                for course, results in courses_with_results:
+                for course in courses:
                     self.write_two_empty_cells_with_borders()
 
                 for question in questionnaire.question_set.all():
@@ -132,52 +131,39 @@ class ExcelExporter(object):
 
                     writen(self, question.text)
 
-                    for course, results in courses_with_results:
-                        if questionnaire.id not in results:
-                            self.write_two_empty_cells_with_borders()
-                            continue
-                        qn_results = results[questionnaire.id]
-                        values = []
-                        deviations = []
-                        total_count = 0
-
-                        for grade_result in qn_results:
-                            if grade_result.question.id == question.id:
-                                if grade_result.average:
-                                    values.append(grade_result.average * grade_result.total_count)
-                                    deviations.append(grade_result.deviation * grade_result.total_count)
-                                    total_count += grade_result.total_count
+                    for course in courses:
+                        index = distribution.get_index(course.id, question.id)
                         enough_answers = course.can_publish_grades
-                        if values and enough_answers:
-                            avg = sum(values) / total_count
+                        if index is not None and totals[index] > 0 and enough_answers:
+                            avg = averages[index]
                             writec(self, avg, self.grade_to_style(avg))
 
-                            dev = sum(deviations) / total_count
+                            dev = deviations[index]
                             writec(self, dev, self.deviation_to_style(dev))
                         else:
                             self.write_two_empty_cells_with_borders()
                 writen(self, None)
-                for course, results in courses_with_results:
+                for course in courses:
                     self.write_two_empty_cells_with_borders()
 
             writen(self, _("Overall Average Grade"), "bold")
-            for course, results in courses_with_results:
-                avg, dev = calculate_average_grades_and_deviation(course)
+            for course in courses:
+                avg = course.avg_grade
                 if avg:
                     writec(self, avg, self.grade_to_style(avg, total=True), cols=2)
                 else:
                     self.write_two_empty_cells_with_borders()
 
             writen(self, _("Overall Average Standard Deviation"), "bold")
-            for course, results in courses_with_results:
-                avg, dev = calculate_average_grades_and_deviation(course)
+            for course in courses:
+                dev = course.avg_deviation
                 if dev is not None:
                     writec(self, dev, self.deviation_to_style(dev, total=True), cols=2)
                 else:
                     self.write_two_empty_cells_with_borders()
 
             writen(self, _("Total voters/Total participants"), "bold")
-            for course, results in courses_with_results:
+            for course in courses:
                 percent_participants = float(course.num_voters) / float(course.num_participants) if course.num_participants > 0 else 0
                 writec(self, "{}/{} ({:.0%})".format(course.num_voters, course.num_participants, percent_participants), "total_voters", cols=2)
 
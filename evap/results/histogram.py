@@ -0,0 +1,93 @@
+"""Statistics on rating answer histograms.
+
+A histogram (called `counts` throughout the results code) is an `OrderedDict`
+mapping each possible answer of a rating question (1 to 5) to the number of
+times it was given. The functions in this module work directly on these
+histograms, so their cost depends on the number of possible answers and not
+on the number of votes. Their results equal those of computing `avg`,
+`statistics.pstdev` and `statistics.median` on the list of all single answers.
+"""
+
+from collections import OrderedDict
+from fractions import Fraction
+from math import sqrt
+
+ANSWERS = range(1, 6)
+
+
+def get_empty_counts():
+    counts = OrderedDict()
+    # ensure ordering of answers
+    for answer in ANSWERS:
+        counts[answer] = 0
+    return counts
+
+
+def get_counts_from_answer_counters(answer_counters):
+    counts = get_empty_counts()
+    for answer_counter in answer_counters:
+        counts[answer_counter.answer] += answer_counter.count
+    return counts
+
+
+def merge_counts(counts_list):
+    """Returns the histogram of all answers of the given histograms."""
+    merged_counts = get_empty_counts()
+    for counts in counts_list:
+        for answer, count in counts.items():
+            merged_counts[answer] += count
+    return merged_counts
+
+
+def get_total_count(counts):
+    return sum(counts.values())
+
+
+def get_average(counts):
+    """Returns the arithmetic mean of all answers or `None` if there are none."""
+    total_count = get_total_count(counts)
+    if total_count == 0:
+        return None
+    return float(sum(answer * count for answer, count in counts.items())) / total_count
+
+
+def get_deviation(counts, average=None):
+    """Returns the population standard deviation of all answers or `None` if
+    there are none. Like `statistics.pstdev`, an already known `average` can
+    be passed in, and the sums are calculated exactly before converting the
+    variance to a float."""
+    total_count = get_total_count(counts)
+    if total_count == 0:
+        return None
+    if average is None:
+        average = get_average(counts)
+
+    sum_of_squares = Fraction(0)
+    sum_of_differences = Fraction(0)
+    for answer, count in counts.items():
+        if count == 0:
+            continue
+        difference = answer - average
+        sum_of_squares += count * Fraction(difference ** 2)
+        sum_of_differences += count * Fraction(difference)
+    # the sum of differences should be zero, but might not be due to the rounding of the average
+    sum_of_squares -= sum_of_differences ** 2 / total_count
+    return sqrt(float(sum_of_squares / total_count))
+
+
+def get_median(counts):
+    """Returns the median of all answers or `None` if there are none."""
+    total_count = get_total_count(counts)
+    if total_count == 0:
+        return None
+
+    def answer_at(index):
+        seen = 0
+        for answer, count in counts.items():
+            seen += count
+            if index < seen:
+                return answer
+
+    if total_count % 2 == 1:
+        return answer_at(total_count // 2)
+    return (answer_at(total_count // 2 - 1) + answer_at(total_count // 2)) / 2
@@ -0,0 +1,91 @@
+import random
+
+from django.test import TestCase
+
+from model_mommy import mommy
+import numpy as np
+
+from evap.evaluation.models import Contribution, Course, CourseType, Degree, Question, Questionnaire, RatingAnswerCounter, Semester, UserProfile
+from evap.results.analytics import SemesterDistribution
+from evap.results.histogram import get_average, get_deviation, merge_counts
+from evap.results.tools import RatingResult, calculate_results
+
+
+class TestSemesterDistribution(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        random.seed(0)
+        cls.semester = mommy.make(Semester)
+        cls.degrees = mommy.make(Degree, _quantity=2)
+        cls.course_types = mommy.make(CourseType, _quantity=2)
+        questionnaire = mommy.make(Questionnaire)
+        cls.questions = [mommy.make(Question, questionnaire=questionnaire, type=question_type) for question_type in "GLGT"]
+
+        cls.courses = []
+        for i in range(4):
+            course = mommy.make(Course, semester=cls.semester, state='published', type=cls.course_types[i % 2], degrees=cls.degrees[:i % 2 + 1])
+            course.general_contribution.questionnaires.set([questionnaire])
+            contribution = mommy.make(Contribution, course=course, contributor=mommy.make(UserProfile), questionnaires=[questionnaire])
+            for question in cls.questions[:3]:
+                for answer in range(1, 6):
+                    for answered_contribution in [course.general_contribution, contribution]:
+                        mommy.make(RatingAnswerCounter, question=question, contribution=answered_contribution, answer=answer, count=random.randint(0, 5))
+            cls.courses.append(course)
+
+        # answers to questionnaires which are no longer assigned are ignored
+        mommy.make(RatingAnswerCounter, question=mommy.make(Question, type="G"), contribution=contribution, answer=1, count=100)
+
+    def setUp(self):
+        self.distribution = SemesterDistribution.for_courses(self.courses)
+
+    def test_statistics_equal_results(self):
+        averages = self.distribution.averages()
+        deviations = self.distribution.deviations()
+        contribution_deviations = self.distribution.contribution_deviations()
+
+        for course in self.courses:
+            sections = calculate_results(course)
+            for question in self.questions[:3]:
+                results = [result for section in sections for result in section.results
+                           if isinstance(result, RatingResult) and result.question == question]
+                counts = merge_counts(result.counts for result in results)
+                total_count = sum(result.total_count for result in results)
+                index = self.distribution.get_index(course.id, question.id)
+
+                self.assertEqual(self.distribution.totals[index], total_count)
+                self.assertAlmostEqual(averages[index], get_average(counts))
+                self.assertAlmostEqual(deviations[index], get_deviation(counts))
+                self.assertAlmostEqual(contribution_deviations[index], sum(result.deviation * result.total_count for result in results) / total_count)
+
+    def test_loads_answers_with_two_queries(self):
+        # the answer counters and the queued ballots
+        with self.assertNumQueries(2):
+            distribution = SemesterDistribution.for_courses(self.courses)
+
+        self.assertEqual(distribution.counts.shape, (4, 3, 5))
+        self.assertIsNone(distribution.get_index(self.courses[0].id, self.questions[3].id))
+
+    def test_empty_distribution(self):
+        distribution = SemesterDistribution.for_courses([mommy.make(Course)])
+
+        self.assertEqual(distribution.counts.shape, (1, 0, 5))
+        self.assertEqual(distribution.averages().shape, (1, 0))
+
+    def test_aggregates(self):
+        by_course_type = self.distribution.by_course_type()
+        by_degree = self.distribution.by_degree()
+
+        self.assertEqual(list(by_course_type.index.keys()), [course_type.id for course_type in self.course_types])
+        np.testing.assert_array_equal(by_course_type.counts[0], self.distribution.counts[0] + self.distribution.counts[2])
+        # the second degree only belongs to the second and fourth course
+        np.testing.assert_array_equal(by_degree.counts[1], self.distribution.counts[1] + self.distribution.counts[3])
+        np.testing.assert_array_equal(by_degree.totals.sum(axis=1), [self.distribution.totals.sum(), self.distribution.totals[[1, 3]].sum()])
+
+    def test_percentile_ranks(self):
+        distribution = SemesterDistribution(
+            [1, 2, 3, 4], [1],
+            np.array([[[1, 0, 0, 0, 0]], [[0, 0, 1, 0, 0]], [[0, 0, 0, 0, 0]], [[0, 0, 1, 0, 0]]], dtype=float),
+            np.zeros((4, 1)),
+        )
+
+        np.testing.assert_array_equal(distribution.percentile_ranks(), [[100 / 3], [100], [np.nan], [100]])
@@ -0,0 +1,37 @@
+import json
+
+from django.contrib.auth.models import Group
+from django.core.cache import cache
+from django.test import TestCase
+
+from model_mommy import mommy
+
+from evap.evaluation.models import Course, UserProfile
+from evap.evaluation.tests.tools import WebTest
+from evap.results.tools import calculate_results, get_results_cache_key
+
+
+class TestResultsCache(TestCase):
+    def test_results_are_cached_locally(self):
+        course = mommy.make(Course, state='published')
+        calculate_results(course)
+        cache.delete(get_results_cache_key(course))
+
+        # only the check of the version
+        with self.assertNumQueries(1):
+            calculate_results(course)
+
+
+class TestCacheStatisticsView(WebTest):
+    url = '/results/cache_statistics'
+
+    def test_staff_only(self):
+        mommy.make(UserProfile, username='student')
+        self.get_assert_403(self.url, 'student')
+
+    def test_returns_statistics(self):
+        mommy.make(UserProfile, username='staff', groups=[Group.objects.get(name='Staff')])
+
+        statistics = json.loads(self.get_assert_200(self.url, 'staff').text)
+
+        self.assertEqual(set(statistics), {'hits', 'misses', 'evictions', 'evicted_bytes', 'invalidations', 'entries', 'max_entries', 'bytes', 'max_bytes'})
@@ -0,0 +1,67 @@
+import random
+from statistics import median, pstdev
+
+from django.test import TestCase
+
+from model_mommy import mommy
+
+from evap.evaluation.models import RatingAnswerCounter
+from evap.results.histogram import (get_average, get_counts_from_answer_counters, get_deviation, get_empty_counts, get_median,
+                                    get_total_count, merge_counts)
+from evap.results.tools import avg
+
+
+def make_counts(*counts):
+    histogram = get_empty_counts()
+    for answer, count in zip(histogram.keys(), counts):
+        histogram[answer] = count
+    return histogram
+
+
+class TestHistogram(TestCase):
+    def assert_equal_to_answer_list_statistics(self, counts):
+        answers = [answer for answer, count in counts.items() for __ in range(count)]
+        average = avg(answers)
+
+        self.assertEqual(get_total_count(counts), len(answers))
+        self.assertEqual(get_average(counts), average)
+        self.assertEqual(get_deviation(counts, average), pstdev(answers, average))
+        self.assertEqual(get_deviation(counts), pstdev(answers, average))
+        self.assertEqual(get_median(counts), median(answers))
+
+    def test_statistics_equal_answer_list_statistics(self):
+        self.assert_equal_to_answer_list_statistics(make_counts(5, 15, 40, 60, 30))
+        self.assert_equal_to_answer_list_statistics(make_counts(1, 0, 4, 2, 3))
+        self.assert_equal_to_answer_list_statistics(make_counts(0, 0, 7, 0, 0))
+        self.assert_equal_to_answer_list_statistics(make_counts(1, 0, 0, 0, 1))
+        self.assert_equal_to_answer_list_statistics(make_counts(0, 1, 0, 0, 0))
+        self.assert_equal_to_answer_list_statistics(make_counts(901, 3, 0, 12, 77))
+
+        random.seed(0)
+        for __ in range(100):
+            self.assert_equal_to_answer_list_statistics(make_counts(*(random.randint(0, 300) for __ in range(5))))
+
+    def test_empty_histogram(self):
+        counts = get_empty_counts()
+        self.assertEqual(list(counts.keys()), [1, 2, 3, 4, 5])
+        self.assertEqual(get_total_count(counts), 0)
+        self.assertIsNone(get_average(counts))
+        self.assertIsNone(get_deviation(counts))
+        self.assertIsNone(get_median(counts))
+
+    def test_counts_from_answer_counters(self):
+        answer_counters = [
+            mommy.prepare(RatingAnswerCounter, answer=4, count=2),
+            mommy.prepare(RatingAnswerCounter, answer=1, count=3),
+        ]
+
+        counts = get_counts_from_answer_counters(answer_counters)
+
+        self.assertEqual(list(counts.items()), [(1, 3), (2, 0), (3, 0), (4, 2), (5, 0)])
+        self.assertEqual(get_average(counts), 2.2)
+
+    def test_merge_counts(self):
+        merged_counts = merge_counts([make_counts(1, 2, 3, 4, 5), make_counts(5, 0, 0, 0, 1)])
+
+        self.assertEqual(merged_counts, make_counts(6, 2, 3, 4, 6))
+        self.assertEqual(merge_counts([]), get_empty_counts())
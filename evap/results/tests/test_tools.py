@@ -1,13 +1,22 @@
+from datetime import date, timedelta
+from unittest.mock import patch
 
 from django.test.testcases import TestCase
 from django.core.cache import cache
 from django.conf import settings
+from django.db import IntegrityError, transaction
 from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.db import connection
 
 from model_mommy import mommy
 
-from evap.evaluation.models import Contribution, RatingAnswerCounter, Questionnaire, Question, Course, UserProfile
-from evap.results.tools import get_answers, get_answers_from_answer_counters, calculate_average_grades_and_deviation, calculate_results
+from evap.evaluation.models import (Contribution, CourseGradeSummary, RatingAnswerCounter, Questionnaire, Question, Course, Semester,
+                                    UserProfile, TextAnswer)
+from evap.results import tools
+from evap.results.tools import (get_answers, calculate_average_grades_and_deviation, calculate_results, calculate_results_for_semester,
+                                complete_grade_summaries, get_results_cache_key, get_results_projection, recalculate_results,
+                                with_grade_summaries, get_text_answer_visibility, RESULTS_SNAPSHOT_VERSION)
 from evap.staff.tools import merge_users
 
 
@@ -46,6 +55,28 @@ class TestCalculateResults(TestCase):
         self.assertAlmostEqual(result.average, float(109) / 30)
         self.assertAlmostEqual(result.deviation, 1.015983376941878)
 
+    def test_calculation_results_number_of_queries(self):
+        course = mommy.make(Course, state='evaluated')
+        questionnaire = mommy.make(Questionnaire)
+        rating_questions = mommy.make(Question, questionnaire=questionnaire, type="L", _quantity=5)
+        text_question = mommy.make(Question, questionnaire=questionnaire, type="T")
+        course.general_contribution.questionnaires.set([questionnaire])
+        contributions = mommy.make(Contribution, course=course, questionnaires=[questionnaire], _quantity=10)
+
+        for contribution in contributions + [course.general_contribution]:
+            for question in rating_questions:
+                mommy.make(RatingAnswerCounter, question=question, contribution=contribution, answer=2, count=3)
+            mommy.make(TextAnswer, question=text_question, contribution=contribution, state=TextAnswer.PUBLISHED)
+
+        # contributions, questionnaires, questions, answer counters, queued ballots and text answers
+        with self.assertNumQueries(6):
+            sections = calculate_results(course)
+
+        self.assertEqual(len(sections), 11)
+        for section in sections:
+            self.assertEqual([result.total_count for result in section.results[:5]], [3] * 5)
+            self.assertEqual(len(section.results[5].answers), 1)
+
     def test_calculate_results_after_user_merge(self):
         """ Asserts that merge_users leaves the results cache in a consistent state. Regression test for #907 """
         contributor = mommy.make(UserProfile)
@@ -93,9 +124,6 @@ class TestCalculateResults(TestCase):
         answer_counters = get_answers(contribution1, question1)
         self.assertSetEqual(set(rating_answer_counters), set(answer_counters))
 
-        answers = get_answers_from_answer_counters(answer_counters)
-        self.assertListEqual(answers, [1, 3, 3, 3, 3, 4, 4, 5, 5, 5])
-
     @override_settings(CONTRIBUTION_PERCENTAGE=0.3, GRADE_PERCENTAGE=0.6)
     def test_average_grades(self):
         contributor1 = mommy.make(UserProfile)
@@ -151,3 +179,332 @@ class TestCalculateResults(TestCase):
         total_dev = settings.GRADE_PERCENTAGE * total_grade_dev + (1 - settings.GRADE_PERCENTAGE) * total_likert_dev
 
         self.assertAlmostEqual(deviation, total_dev)
+
+
+class TestResultsCacheMaintenance(TestCase):
+    def setUp(self):
+        self.course = mommy.make(Course, state='reviewed')
+        questionnaire = mommy.make(Questionnaire)
+        self.rating_question = mommy.make(Question, questionnaire=questionnaire, type="G")
+        self.text_question = mommy.make(Question, questionnaire=questionnaire, type="T")
+        self.contribution = mommy.make(Contribution, course=self.course, contributor=mommy.make(UserProfile), questionnaires=[questionnaire])
+        self.answer_counter = mommy.make(RatingAnswerCounter, question=self.rating_question, contribution=self.contribution, answer=1, count=5)
+        self.textanswer = mommy.make(TextAnswer, question=self.text_question, contribution=self.contribution, state=TextAnswer.NOT_REVIEWED)
+
+        self.course.publish()
+        self.course.save()
+        self.cache_key = get_results_cache_key(self.course)
+
+    def get_cached_results(self):
+        self.assertIsNotNone(cache.get(self.cache_key))
+        return calculate_results(self.course)[0].results
+
+    def test_publish_calculates_results(self):
+        rating_result, text_result = self.get_cached_results()
+        self.assertEqual(rating_result.total_count, 5)
+        self.assertEqual(text_result.answers, ())
+
+    def test_unpublish_invalidates_results(self):
+        self.course.unpublish()
+        self.course.save()
+
+        self.assertIsNone(cache.get(self.cache_key))
+
+    def test_textanswer_change_invalidates_results(self):
+        self.textanswer.publish()
+        self.textanswer.save()
+
+        self.assertIsNone(cache.get(self.cache_key))
+        __, text_result = calculate_results(self.course)[0].results
+        self.assertEqual(text_result.answers, (self.textanswer,))
+
+        self.textanswer.hide()
+        self.textanswer.save()
+
+        __, text_result = calculate_results(self.course)[0].results
+        self.assertEqual(text_result.answers, ())
+
+    def test_answer_counter_change_invalidates_results(self):
+        self.answer_counter.count = 1
+        self.answer_counter.save()
+        mommy.make(RatingAnswerCounter, question=self.rating_question, contribution=self.contribution, answer=3, count=1)
+
+        self.assertIsNone(cache.get(self.cache_key))
+        rating_result, __ = calculate_results(self.course)[0].results
+        self.assertEqual(rating_result.total_count, 2)
+        self.assertEqual(rating_result.average, 2)
+        self.assertTrue(rating_result.warning)
+
+    def test_concurrent_textanswer_changes_are_kept(self):
+        other_textanswer = mommy.make(TextAnswer, question=self.text_question, contribution=self.contribution, state=TextAnswer.PUBLISHED)
+        self.textanswer.publish()
+        self.textanswer.save()
+        calculate_results(self.course)
+        invalidate_results_cache = tools.invalidate_results_cache
+        invalidations = []
+
+        def invalidate_and_hide_other_textanswer(course):
+            # another moderation of the course happens while the first one drops the cached results
+            invalidations.append(course)
+            if len(invalidations) == 1:
+                other_textanswer.hide()
+                other_textanswer.save()
+            invalidate_results_cache(course)
+
+        with patch('evap.results.tools.invalidate_results_cache', side_effect=invalidate_and_hide_other_textanswer):
+            self.textanswer.hide()
+            self.textanswer.save()
+
+        __, text_result = calculate_results(self.course)[0].results
+        self.assertEqual(text_result.answers, ())
+
+    def test_rolled_back_change_is_not_cached(self):
+        calculate_results(self.course)
+        with self.assertRaises(IntegrityError):
+            with transaction.atomic():
+                self.textanswer.publish()
+                self.textanswer.save()
+                raise IntegrityError()
+
+        __, text_result = calculate_results(self.course)[0].results
+        self.assertEqual(text_result.answers, ())
+
+    def test_contribution_change_invalidates_results(self):
+        self.contribution.label = "changed"
+        self.contribution.save()
+
+        self.assertIsNone(cache.get(self.cache_key))
+        self.assertEqual(calculate_results(self.course)[0].label, "changed")
+
+    def test_questionnaire_change_invalidates_results(self):
+        self.contribution.questionnaires.add(mommy.make(Questionnaire))
+
+        self.assertIsNone(cache.get(self.cache_key))
+        self.assertEqual(len(calculate_results(self.course)), 2)
+
+
+class TestResultsSnapshots(TestCase):
+    def setUp(self):
+        self.course = mommy.make(Course, state='published')
+        questionnaire = mommy.make(Questionnaire)
+        rating_question = mommy.make(Question, questionnaire=questionnaire, type="L")
+        text_question = mommy.make(Question, questionnaire=questionnaire, type="T")
+        contribution = mommy.make(Contribution, course=self.course, contributor=mommy.make(UserProfile), questionnaires=[questionnaire])
+        mommy.make(RatingAnswerCounter, question=rating_question, contribution=contribution, answer=2, count=3)
+        mommy.make(TextAnswer, question=text_question, contribution=contribution, state=TextAnswer.PUBLISHED, original_answer="original", reviewed_answer="reviewed")
+        self.cache_key = get_results_cache_key(self.course)
+
+    def assert_contains_only_builtins(self, value):
+        if isinstance(value, tuple):
+            for item in value:
+                self.assert_contains_only_builtins(item)
+        else:
+            self.assertIn(type(value), (int, str, type(None)))
+
+    def test_snapshot_contains_no_model_instances(self):
+        calculate_results(self.course)
+
+        snapshot = cache.get(self.cache_key)
+        self.assertEqual(snapshot[0], RESULTS_SNAPSHOT_VERSION)
+        self.assert_contains_only_builtins(snapshot)
+
+    def test_results_from_snapshot_equal_calculated_results(self):
+        calculated_results = calculate_results(self.course)
+        results = calculate_results(self.course)
+
+        self.assertEqual(results, calculated_results)
+        __, text_result = results[0].results
+        self.assertEqual(text_result.answers[0].answer, "reviewed")
+        self.assertTrue(text_result.answers[0].is_published)
+
+    def test_outdated_snapshot_is_recalculated(self):
+        cache.set(self.cache_key, (RESULTS_SNAPSHOT_VERSION - 1, ()), None)
+
+        self.assertEqual(len(calculate_results(self.course)), 1)
+        self.assertEqual(cache.get(self.cache_key)[0], RESULTS_SNAPSHOT_VERSION)
+
+    def test_average_grade_does_not_load_models(self):
+        average_grade = calculate_average_grades_and_deviation(self.course)
+
+        # only the lookup in the database cache
+        with self.assertNumQueries(1):
+            self.assertEqual(calculate_average_grades_and_deviation(self.course), average_grade)
+
+
+class TestCalculateResultsForSemester(TestCase):
+    def setUp(self):
+        self.semester = mommy.make(Semester)
+        self.questionnaire = mommy.make(Questionnaire)
+        self.rating_question = mommy.make(Question, questionnaire=self.questionnaire, type="G")
+        self.text_question = mommy.make(Question, questionnaire=self.questionnaire, type="T")
+
+    def make_courses(self, state, count):
+        courses = []
+        for answer in range(1, count + 1):
+            course = mommy.make(Course, semester=self.semester, state=state)
+            contribution = mommy.make(Contribution, course=course, contributor=mommy.make(UserProfile), questionnaires=[self.questionnaire])
+            mommy.make(RatingAnswerCounter, question=self.rating_question, contribution=contribution, answer=answer, count=2)
+            mommy.make(TextAnswer, question=self.text_question, contribution=contribution, state=TextAnswer.PUBLISHED)
+            courses.append(course)
+        return courses
+
+    def count_queries(self, courses):
+        with CaptureQueriesContext(connection) as context:
+            calculate_results_for_semester(self.semester, courses)
+        return len(context)
+
+    def test_results_equal_single_course_results(self):
+        courses = self.make_courses('published', 3)
+
+        course_results = calculate_results_for_semester(self.semester)
+
+        self.assertCountEqual(course_results.keys(), courses)
+        for course, results in course_results.items():
+            self.assertEqual(results.sections, calculate_results(course))
+            self.assertEqual((results.average_grade, results.average_deviation), calculate_average_grades_and_deviation(course))
+
+    def test_number_of_queries_does_not_depend_on_number_of_courses(self):
+        courses = self.make_courses('evaluated', 4)
+
+        self.assertEqual(self.count_queries(courses[:1]), self.count_queries(courses))
+
+    def test_cached_results_are_fetched_together(self):
+        courses = self.make_courses('published', 3)
+        calculated_results = calculate_results_for_semester(self.semester, courses)
+
+        with patch.object(tools.results_cache, 'get_many', wraps=tools.results_cache.get_many) as get_many:
+            course_results = calculate_results_for_semester(self.semester, courses)
+
+        get_many.assert_called_once_with([get_results_cache_key(course) for course in courses])
+        self.assertEqual(course_results, calculated_results)
+
+
+class TestGradeSummaries(TestCase):
+    def setUp(self):
+        self.questionnaire = mommy.make(Questionnaire)
+        self.question = mommy.make(Question, questionnaire=self.questionnaire, type="G")
+
+    def make_course(self, state, answer):
+        course = mommy.make(Course, state=state)
+        contribution = mommy.make(Contribution, course=course, contributor=mommy.make(UserProfile), questionnaires=[self.questionnaire])
+        mommy.make(RatingAnswerCounter, question=self.question, contribution=contribution, answer=answer, count=2)
+        return course
+
+    def test_summaries_equal_results(self):
+        course = self.make_course('evaluated', 2)
+
+        summary = CourseGradeSummary.objects.get(course=course)
+
+        self.assertEqual((summary.average_grade, summary.average_deviation), calculate_average_grades_and_deviation(course))
+        self.assertEqual(list(summary.counts.values()), [0, 2, 0, 0, 0])
+        self.assertEqual(summary.total_count, 2)
+
+    def test_summaries_are_stored_after_evaluation(self):
+        in_evaluation_course = self.make_course('in_evaluation', 1)
+        self.assertFalse(CourseGradeSummary.objects.filter(course=in_evaluation_course).exists())
+
+        in_evaluation_course.evaluation_end()
+        in_evaluation_course.save()
+
+        self.assertEqual(CourseGradeSummary.objects.get(course=in_evaluation_course).average_grade, 1)
+
+    def test_summaries_are_deleted_when_evaluation_is_reopened(self):
+        course = self.make_course('evaluated', 1)
+        course.vote_start_date = date.today() - timedelta(days=1)
+        course.vote_end_date = date.today() + timedelta(days=1)
+
+        course.reopen_evaluation()
+        course.save()
+
+        self.assertFalse(CourseGradeSummary.objects.filter(course=course).exists())
+
+    def test_answer_change_updates_summary(self):
+        course = self.make_course('evaluated', 1)
+
+        mommy.make(RatingAnswerCounter, question=self.question, contribution=course.contributions.get(contributor__isnull=False), answer=3, count=2)
+
+        self.assertEqual(CourseGradeSummary.objects.get(course=course).average_grade, 2)
+
+    def test_recalculating_results_updates_outdated_summaries(self):
+        course = self.make_course('evaluated', 1)
+        CourseGradeSummary.objects.filter(course=course).update(average_grade=5, version=CourseGradeSummary.VERSION - 1)
+        self.assertIsNone(with_grade_summaries(Course.objects.filter(pk=course.pk)).get().avg_grade)
+
+        recalculate_results([course])
+
+        self.assertEqual(CourseGradeSummary.objects.get(course=course).version, CourseGradeSummary.VERSION)
+        self.assertEqual(with_grade_summaries(Course.objects.filter(pk=course.pk)).get().avg_grade, 1)
+
+    def test_publishing_stores_summary(self):
+        course = self.make_course('reviewed', 1)
+
+        course.publish()
+        course.save()
+
+        self.assertEqual(CourseGradeSummary.objects.get(course=course).average_grade, 1)
+
+    def test_missing_summaries_are_completed(self):
+        courses = [self.make_course('evaluated', answer) for answer in [1, 2]]
+        CourseGradeSummary.objects.filter(course=courses[1]).delete()
+        semester = mommy.make(Semester)
+        semester.course_set.set(courses)
+        courses = list(with_grade_summaries(semester.course_set.all()).select_related('grade_summary').order_by('pk'))
+        self.assertIsNone(courses[1].avg_grade)
+
+        summaries = complete_grade_summaries(semester, courses)
+
+        self.assertEqual(list(summaries.keys()), [courses[1]])
+        self.assertEqual(courses[1].avg_grade, 2)
+        self.assertEqual(list(summaries[courses[1]].counts.values()), [0, 2, 0, 0, 0])
+        # the summaries are not stored
+        self.assertFalse(CourseGradeSummary.objects.filter(course=courses[1]).exists())
+
+    def test_courses_can_be_sorted_and_filtered_by_summary(self):
+        courses = [self.make_course('evaluated', answer) for answer in [3, 1, 2]]
+        courses_with_summaries = with_grade_summaries(Course.objects.all())
+
+        # a single query, no answers are loaded
+        with self.assertNumQueries(1):
+            self.assertEqual(list(courses_with_summaries.order_by('avg_grade')), [courses[1], courses[2], courses[0]])
+        self.assertCountEqual(courses_with_summaries.filter(avg_grade__lt=2.5), [courses[1], courses[2]])
+
+
+class TestResultsProjection(TestCase):
+    def setUp(self):
+        self.contributor = mommy.make(UserProfile)
+        self.delegate = mommy.make(UserProfile)
+        self.contributor.delegates.set([self.delegate])
+        self.students = mommy.make(UserProfile, _quantity=2)
+        self.course = mommy.make(Course, state='reviewed', participants=self.students)
+        questionnaire = mommy.make(Questionnaire)
+        question = mommy.make(Question, questionnaire=questionnaire, type="T")
+        contribution = mommy.make(Contribution, course=self.course, contributor=self.contributor, questionnaires=[questionnaire])
+        self.published_answer = mommy.make(TextAnswer, question=question, contribution=contribution, state=TextAnswer.PUBLISHED)
+        self.private_answer = mommy.make(TextAnswer, question=question, contribution=contribution, state=TextAnswer.PRIVATE)
+        self.course.publish()
+        self.course.save()
+
+    def get_answers(self, user):
+        sections = get_results_projection(self.course, get_text_answer_visibility(self.course, user))
+        return [answer for section in sections for result in section.results for answer in result.answers]
+
+    def test_projection_depends_on_visibility(self):
+        self.assertEqual(self.get_answers(self.contributor), [self.published_answer, self.private_answer])
+        self.assertEqual(self.get_answers(self.delegate), [self.published_answer])
+        self.assertEqual(self.get_answers(self.students[0]), [])
+
+    def test_projection_does_not_change_results(self):
+        results = calculate_results(self.course)
+
+        self.get_answers(self.students[0])
+
+        self.assertEqual(calculate_results(self.course), results)
+        self.assertEqual(len(results[0].results[0].answers), 2)
+
+    def test_projection_is_shared_by_users_with_equal_visibility(self):
+        self.assertEqual(get_text_answer_visibility(self.course, self.students[0]), get_text_answer_visibility(self.course, self.students[1]))
+        self.get_answers(self.students[0])
+
+        # only the query for the visibility and the check of the cache generation
+        with self.assertNumQueries(2):
+            self.get_answers(self.students[1])
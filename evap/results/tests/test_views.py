@@ -1,8 +1,10 @@
 from django.contrib.auth.models import Group
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from model_mommy import mommy
 
-from evap.evaluation.models import Semester, UserProfile, Course, Contribution, Questionnaire, Degree
-from evap.evaluation.tests.tools import ViewTest
+from evap.evaluation.models import Semester, UserProfile, Course, Contribution, Questionnaire, Question, Degree, RatingAnswerCounter
+from evap.evaluation.tests.tools import ViewTest, WebTest
 
 
 class TestResultsView(ViewTest):
@@ -25,6 +27,41 @@ class TestResultsSemesterDetailView(ViewTest):
         cls.semester = mommy.make(Semester, id=1)
 
 
+class TestResultsSemesterDetailViewGradeSummaries(WebTest):
+    fixtures = ['minimal_test_data_results']
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.semester = mommy.make(Semester)
+        mommy.make(UserProfile, username='evap', groups=[Group.objects.get(name='Staff')])
+        degree = mommy.make(Degree)
+
+        course = mommy.make(Course, state='reviewed', semester=cls.semester, degrees=[degree])
+        questionnaire = mommy.make(Questionnaire)
+        question = mommy.make(Question, questionnaire=questionnaire, type="G")
+        contribution = mommy.make(Contribution, course=course, contributor=mommy.make(UserProfile), questionnaires=[questionnaire])
+        mommy.make(RatingAnswerCounter, question=question, contribution=contribution, answer=2, count=3)
+
+        single_result_course = mommy.make(Course, state='reviewed', semester=cls.semester, degrees=[degree], is_single_result=True)
+        single_result_questionnaire = Questionnaire.single_result_questionnaire()
+        contribution = mommy.make(Contribution, course=single_result_course, contributor=mommy.make(UserProfile), questionnaires=[single_result_questionnaire], responsible=True,
+                                  can_edit=True, comment_visibility=Contribution.ALL_COMMENTS)
+        single_result_question = mommy.make(Question, questionnaire=single_result_questionnaire, type="G")
+        mommy.make(RatingAnswerCounter, question=single_result_question, contribution=contribution, answer=4, count=5)
+
+        for course in [course, single_result_course]:
+            course.publish()
+            course.save()
+
+    def test_answer_counters_are_not_used(self):
+        with CaptureQueriesContext(connection) as context:
+            page = self.get_assert_200('/results/semester/{}'.format(self.semester.id), 'evap')
+
+        self.assertFalse(any(RatingAnswerCounter._meta.db_table in query['sql'] for query in context.captured_queries))
+        self.assertIn("2.0", page)
+        self.assertIn("4.0", page)
+
+
 class TestResultsSemesterCourseDetailView(ViewTest):
     url = '/results/semester/2/course/21'
     test_users = ['evap', 'contributor', 'responsible']
@@ -45,7 +82,7 @@ class TestResultsSemesterCourseDetailView(ViewTest):
         cls.course = mommy.make(Course, id=21, state='published', semester=cls.semester)
 
         # Special single result course.
-        cls.single_result_course = mommy.make(Course, state='published', semester=cls.semester)
+        cls.single_result_course = mommy.make(Course, state='published', semester=cls.semester, is_single_result=True)
         questionnaire = Questionnaire.objects.get(name_en=Questionnaire.SINGLE_RESULT_QUESTIONNAIRE_NAME)
         mommy.make(Contribution, course=cls.single_result_course, questionnaires=[questionnaire], responsible=True, can_edit=True, comment_visibility=Contribution.ALL_COMMENTS)
 
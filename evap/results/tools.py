@@ -1,14 +1,16 @@
 from collections import namedtuple, defaultdict, OrderedDict
-from functools import partial
 from math import ceil
-from statistics import pstdev, median
+from statistics import median
 
 from django.conf import settings
-from django.core.cache import cache
-from django.db.models import Sum
+from django.db import IntegrityError, transaction
+from django.db.models import Case, F, FloatField, Q, Sum, When
 
-from evap.evaluation.models import TextAnswer, Contribution, RatingAnswerCounter
-from evap.evaluation.tools import questionnaires_and_contributions
+from evap.evaluation.models import Contribution, CourseGradeSummary, Question, Questionnaire, QueuedBallot, TextAnswer, RatingAnswerCounter
+from evap.evaluation.tools import questionnaires_and_contributions_for_courses
+from evap.results.cache import results_cache
+from evap.results.histogram import (ANSWERS, get_average, get_counts_from_answer_counters, get_deviation, get_empty_counts, get_total_count,
+                                    merge_counts)
 
 
 GRADE_COLORS = {
@@ -20,11 +22,21 @@ GRADE_COLORS = {
 }
 
 
+# text answers in other states are not shown on the results pages
+TEXTANSWER_STATES_IN_RESULTS = [TextAnswer.PRIVATE, TextAnswer.PUBLISHED]
+
+# the rating answers of courses in these states can't change by voting anymore, so their grade summaries are stored
+GRADE_SUMMARY_STATES = ['evaluated', 'reviewed', 'published']
+
 # see calculate_results
 ResultSection = namedtuple('ResultSection', ('questionnaire', 'contributor', 'label', 'results', 'warning'))
 CommentSection = namedtuple('CommentSection', ('questionnaire', 'contributor', 'label', 'is_responsible', 'results'))
 RatingResult = namedtuple('RatingResult', ('question', 'total_count', 'average', 'deviation', 'counts', 'warning'))
 TextResult = namedtuple('TextResult', ('question', 'answers'))
+# see calculate_results_for_semester
+CourseResults = namedtuple('CourseResults', ('sections', 'average_grade', 'average_deviation'))
+# see get_text_answer_visibility
+TextAnswerVisibility = namedtuple('TextAnswerVisibility', ('can_see_all', 'user_id', 'contributor_ids', 'all_comments', 'course_comments'))
 
 
 def avg(iterable):
@@ -51,26 +63,10 @@ def get_answers(contribution, question):
     return question.answer_class.objects.filter(contribution=contribution, question=question)
 
 
-def get_number_of_answers(contribution, question):
-    answers = get_answers(contribution, question)
-    if question.is_rating_question:
-        return get_sum_of_answer_counters(answers)
-    else:
-        return len(answers)
-
-
 def get_sum_of_answer_counters(answer_counters):
     return answer_counters.aggregate(total_count=Sum('count'))['total_count'] or 0
 
 
-def get_answers_from_answer_counters(answer_counters):
-    answers = []
-    for answer_counter in answer_counters:
-        for __ in range(0, answer_counter.count):
-            answers.append(answer_counter.answer)
-    return answers
-
-
 def get_textanswers(contribution, question, filter_states=None):
     assert question.is_text_question
     answers = get_answers(contribution, question)
@@ -80,77 +76,456 @@ def get_textanswers(contribution, question, filter_states=None):
 
 
 def get_counts(answer_counters):
-    counts = OrderedDict()
-    # ensure ordering of answers
-    for answer in range(1, 6):
-        counts[answer] = 0
+    return get_counts_from_answer_counters(answer_counters)
+
 
-    for answer_counter in answer_counters:
-        counts[answer_counter.answer] = answer_counter.count
-    return counts
+def get_results_cache_key(course):
+    return 'evap.staff.results.tools.calculate_results-{:d}'.format(course.id)
 
 
 def calculate_results(course, force_recalculation=False):
+    """Calculates the result data for a single course. Returns a tuple of
+    `ResultSection` tuples. Each of those tuples contains the questionnaire, the
+    contributor (or None), the label of the contribution, a tuple of single
+    result elements and whether a warning should be shown for the section. The
+    result elements are either `RatingResult` or `TextResult` instances.
+
+    The results can be shared between requests, so they must not be modified.
+    Use `project_results` to get the results shown to a specific user."""
+    snapshots, models = _get_snapshots([course], force_recalculation)
+    return _sections_from_snapshot(snapshots[course.id], course, models)
+
+
+def calculate_results_for_semester(semester, courses=None):
+    """Calculates the results of the given courses of a semester, or of all of
+    its courses. Returns an OrderedDict mapping the courses to `CourseResults`
+    tuples of their sections, as returned by `calculate_results`, and their
+    final average grade and deviation.
+
+    The cached results are fetched together and the missing ones are
+    calculated together, so the number of queries does not depend on the
+    number of courses. Lists of courses should use the stored grade summaries
+    (see `with_grade_summaries`) or a `SemesterDistribution` instead and only
+    calculate the results of the courses these don't cover."""
+    if courses is None:
+        courses = semester.course_set.all()
+    courses = list(courses)
+    assert all(course.semester_id == semester.id for course in courses)
+
+    snapshots, models = _get_snapshots(courses)
+    _load_snapshot_models(snapshots.values(), models)
+    course_results = OrderedDict()
+    for course in courses:
+        snapshot = snapshots[course.id]
+        course_results[course] = CourseResults(_sections_from_snapshot(snapshot, course, models), *_calculate_average_grades_and_deviation(snapshot))
+    return course_results
+
+
+def invalidate_results_cache(course):
+    results_cache.delete(get_results_cache_key(course))
+
+
+def invalidate_results_cache_for_answer(answer):
+    """Drops the cached results of a course after one of its rating answer
+    counters or text answers has been changed, created or deleted. The entry
+    is dropped again when the transaction is committed, because concurrent
+    requests might have cached the results without the change in between.
+    Patching the cached results instead would lose concurrent changes."""
+    course = answer.contribution.course
+    invalidate_results_cache(course)
+    transaction.on_commit(lambda: invalidate_results_cache(course))
+
+
+def get_text_answer_visibility(course, user, public_view=False):
+    """Determines which of the course's text answers the user can see. Users
+    with equal visibilities see the same projection of the results, so it is
+    suitable as a cache key for them. Needs at most one query."""
+    if public_view:
+        return TextAnswerVisibility(False, None, frozenset(), False, False)
+    if user.is_reviewer:
+        return TextAnswerVisibility(True, None, frozenset(), False, False)
+
+    # the contributions of the user and of the users represented by them
+    comment_visibilities = list(course.contributions.filter(Q(contributor=user) | Q(contributor__delegates=user))
+                                .values_list('contributor_id', 'comment_visibility').distinct())
+    contributor_ids = frozenset(contributor_id for contributor_id, __ in comment_visibilities)
+    return TextAnswerVisibility(
+        can_see_all=False,
+        # private answers are only shown to the contributor themselves
+        user_id=user.id if user.id in contributor_ids else None,
+        contributor_ids=contributor_ids,
+        all_comments=any(visibility == Contribution.ALL_COMMENTS for __, visibility in comment_visibilities),
+        course_comments=any(visibility == Contribution.COURSE_COMMENTS for __, visibility in comment_visibilities),
+    )
+
+
+def can_see_text_answer(visibility, textanswer):
+    if visibility.can_see_all:
+        return True
+    contribution = textanswer.contribution
+    if textanswer.is_private:
+        return visibility.user_id is not None and contribution.contributor_id == visibility.user_id
+    if textanswer.is_published:
+        return (contribution.contributor_id in visibility.contributor_ids or visibility.all_comments or
+                contribution.is_general and visibility.course_comments)
+    return False
+
+
+def project_results(sections, visibility):
+    """Returns a copy of the given sections containing only the text answers
+    allowed by the `TextAnswerVisibility`. Text results without answers and
+    sections without results are left out."""
+    projected_sections = []
+    for section in sections:
+        results = []
+        for result in section.results:
+            if isinstance(result, TextResult):
+                answers = tuple(answer for answer in result.answers if can_see_text_answer(visibility, answer))
+                if answers:
+                    results.append(result._replace(answers=answers))
+            else:
+                results.append(result)
+        if results:
+            projected_sections.append(section._replace(results=tuple(results)))
+    return tuple(projected_sections)
+
+
+def get_results_projection(course, visibility):
+    """Returns `project_results` of the course's results. Projections of
+    published courses are kept in the local results cache per visibility."""
     if course.state != "published":
-        return _calculate_results_impl(course)
+        return project_results(calculate_results(course), visibility)
+
+    cache_key = ('evap.results.tools.get_results_projection', course.id, visibility)
+    projection = results_cache.get_local(cache_key)
+    if projection is None:
+        projection = project_results(calculate_results(course), visibility)
+        results_cache.set_local(cache_key, projection, source_key=get_results_cache_key(course))
+    return projection
+
+
+def recalculate_results(courses):
+    """Recalculates the results of the given courses without looking at the
+    cache, replaces the cached results of the published ones and stores the
+    grade summaries. Returns a dict mapping the course ids to the result
+    snapshots."""
+    courses = list(courses)
+    snapshots, __ = _get_snapshots(courses, force_recalculation=True)
+    update_grade_summaries(courses, snapshots)
+    return snapshots
+
+
+def get_courses_with_outdated_results(courses):
+    """Returns those of the given courses whose cached results or stored grade
+    summary are missing or have been created by an older version."""
+    courses = list(courses)
+    published_courses = [course for course in courses if course.state == "published"]
+    cached_snapshots = results_cache.get_many([get_results_cache_key(course) for course in published_courses]) if published_courses else {}
+    summary_course_ids = set(CourseGradeSummary.objects.filter(course__in=courses, version=CourseGradeSummary.VERSION).values_list('course_id', flat=True))
+
+    outdated_courses = []
+    for course in courses:
+        snapshot = cached_snapshots.get(get_results_cache_key(course))
+        if course.state == "published" and (snapshot is None or not _is_current_snapshot(snapshot)):
+            outdated_courses.append(course)
+        elif course.state in GRADE_SUMMARY_STATES and course.id not in summary_course_ids:
+            outdated_courses.append(course)
+    return outdated_courses
+
+
+# The results are cached as snapshots, which only consist of tuples, ids, strings
+# and numbers instead of pickled model instances. This keeps the cache entries
+# small and fast to load and does not break when the models change:
+#   snapshot: (RESULTS_SNAPSHOT_VERSION, sections)
+#   section:  (questionnaire_id, contribution_id, contributor_id, results)
+#   result:   (question_id, question_type, counts) for rating questions, where counts
+#             is a tuple of the numbers of the answers 1 to 5, or
+#             (question_id, question_type, textanswers) for text questions, where each
+#             text answer is an (id, state, original_answer, reviewed_answer) tuple.
+# The version must be increased whenever this format changes.
+RESULTS_SNAPSHOT_VERSION = 1
+
+# questionnaires, questions and contributions referenced by snapshots, keyed by their ids
+SnapshotModels = namedtuple('SnapshotModels', ('questionnaires', 'questions', 'contributions'))
+
+
+def _is_current_snapshot(snapshot):
+    return isinstance(snapshot, tuple) and len(snapshot) == 2 and snapshot[0] == RESULTS_SNAPSHOT_VERSION
+
+
+def _get_snapshots(courses, force_recalculation=False):
+    """Returns a dict mapping the ids of the given courses to their result
+    snapshots and the `SnapshotModels` of the snapshots that had to be
+    calculated. Snapshots of published courses are taken from the cache if
+    possible, and newly calculated ones are stored in it."""
+    published_courses = [course for course in courses if course.state == "published"]
+    cached_snapshots = {}
+    if published_courses and not force_recalculation:
+        cached_snapshots = results_cache.get_many([get_results_cache_key(course) for course in published_courses])
+
+    snapshots = {}
+    for course in published_courses:
+        snapshot = cached_snapshots.get(get_results_cache_key(course))
+        if snapshot is not None and _is_current_snapshot(snapshot):
+            snapshots[course.id] = snapshot
+
+    missing_courses = [course for course in courses if course.id not in snapshots]
+    calculated_snapshots, models = _calculate_snapshots(missing_courses)
+    snapshots.update(calculated_snapshots)
+    new_cache_entries = {get_results_cache_key(course): calculated_snapshots[course.id] for course in missing_courses if course.state == "published"}
+    if new_cache_entries:
+        results_cache.set_many(new_cache_entries)
+    return snapshots, models
+
+
+def _get_counts_and_textanswers(courses):
+    """Loads all rating answer counters, the rating votes of queued ballots and
+    all visible text answers of the given courses with one query each. Returns
+    the histograms of the rating answers and the snapshot records of the text
+    answers, both keyed by the ids of their contribution and question."""
+    counts = defaultdict(get_empty_counts)
+    for answer_counter in RatingAnswerCounter.objects.filter(contribution__course__in=courses):
+        counts[(answer_counter.contribution_id, answer_counter.question_id)][answer_counter.answer] += answer_counter.count
+    # the votes of ballots which have not been processed yet are part of the results as well
+    for (contribution_id, question_id, answer), count in QueuedBallot.get_rating_vote_counts(courses).items():
+        counts[(contribution_id, question_id)][answer] += count
+
+    textanswers = defaultdict(list)
+    textanswer_values = TextAnswer.objects.filter(contribution__course__in=courses, state__in=TEXTANSWER_STATES_IN_RESULTS).order_by('id').values_list(
+        'contribution_id', 'question_id', 'id', 'state', 'original_answer', 'reviewed_answer')
+    for contribution_id, question_id, *record in textanswer_values:
+        textanswers[(contribution_id, question_id)].append(tuple(record))
+
+    return counts, textanswers
+
+
+def _calculate_snapshots(courses):
+    """Calculates the result snapshots of the given courses. Returns a dict
+    mapping course ids to snapshots and the `SnapshotModels` that were loaded
+    for the calculation, so that the snapshots can be turned into sections
+    without further queries.
+
+    All answers of the courses are loaded upfront, so the number of queries
+    does not depend on the number of courses, contributions and questions."""
+    models = SnapshotModels({}, {}, {})
+    if not courses:
+        return {}, models
+
+    questionnaires_and_contributions_by_course = questionnaires_and_contributions_for_courses(courses)
+    counts, textanswers = _get_counts_and_textanswers(courses)
+
+    snapshots = {}
+    for course in courses:
+        # there will be one section per relevant questionnaire--contributor pair
+        sections = []
+        for questionnaire, contribution in questionnaires_and_contributions_by_course[course.id]:
+            models.questionnaires[questionnaire.id] = questionnaire
+            models.contributions[contribution.id] = contribution
+            # will contain one record per question
+            results = []
+            for question in questionnaire.question_set.all():
+                models.questions[question.id] = question
+                if question.is_rating_question:
+                    results.append((question.id, question.type, tuple(counts[(contribution.id, question.id)].values())))
+                elif question.is_text_question:
+                    results.append((question.id, question.type, tuple(textanswers[(contribution.id, question.id)])))
+            sections.append((questionnaire.id, contribution.id, contribution.contributor_id, tuple(results)))
+        snapshots[course.id] = (RESULTS_SNAPSHOT_VERSION, tuple(sections))
+    return snapshots, models
+
+
+def _load_snapshot_models(snapshots, models):
+    """Adds the questionnaires, questions and contributions referenced by the
+    given snapshots to `models`. Only objects that are not already contained
+    are loaded, with at most one query per model."""
+    questionnaire_ids, question_ids, contribution_ids = set(), set(), set()
+    for __, sections in snapshots:
+        for questionnaire_id, contribution_id, __, results in sections:
+            questionnaire_ids.add(questionnaire_id)
+            contribution_ids.add(contribution_id)
+            question_ids.update(question_id for question_id, __, __ in results)
+
+    for objects, queryset, ids in [
+            (models.questionnaires, Questionnaire.objects.all(), questionnaire_ids),
+            (models.questions, Question.objects.all(), question_ids),
+            (models.contributions, Contribution.objects.select_related('contributor'), contribution_ids)]:
+        missing_ids = ids - objects.keys()
+        if missing_ids:
+            objects.update(queryset.in_bulk(missing_ids))
+
+
+def _sections_from_snapshot(snapshot, course, models):
+    """Turns a result snapshot of the given course back into a tuple of
+    `ResultSection` tuples, loading the referenced models if necessary."""
+    _load_snapshot_models([snapshot], models)
+
+    sections = []
+    for questionnaire_id, contribution_id, __, snapshot_results in snapshot[1]:
+        contribution = models.contributions[contribution_id]
+        contribution.course = course
+        results = []
+        for question_id, question_type, data in snapshot_results:
+            question = models.questions[question_id]
+            if question_type == "T":
+                answers = tuple(
+                    TextAnswer(id=id, contribution=contribution, question=question, state=state, original_answer=original_answer, reviewed_answer=reviewed_answer)
+                    for id, state, original_answer, reviewed_answer in data
+                )
+                results.append(TextResult(question=question, answers=answers))
+            else:
+                results.append(_calculate_rating_result(question, _counts_from_record(data)))
+        sections.append(ResultSection(models.questionnaires[questionnaire_id], contribution.contributor, contribution.label, results, False))
 
-    cache_key = 'evap.staff.results.tools.calculate_results-{:d}'.format(course.id)
-    if force_recalculation:
-        cache.delete(cache_key)
-    return cache.get_or_set(cache_key, partial(_calculate_results_impl, course), None)
+    return _calculate_warnings(sections)
 
 
-def _calculate_results_impl(course):
-    """Calculates the result data for a single course. Returns a list of
-    `ResultSection` tuples. Each of those tuples contains the questionnaire, the
-    contributor (or None), a list of single result elements, the average grade and
-    deviation for that section (or None). The result elements are either
-    `RatingResult` or `TextResult` instances."""
+def _counts_from_record(data):
+    return OrderedDict(zip(ANSWERS, data))
+
+
+def _calculate_rating_result(question, counts):
+    total_count = get_total_count(counts)
+    average = get_average(counts)
+    deviation = get_deviation(counts, average)
+    # the warning is set later on by _calculate_warnings
+    return RatingResult(question, total_count, average, deviation, counts, False)
 
-    # there will be one section per relevant questionnaire--contributor pair
-    sections = []
+
+def _calculate_warnings(sections):
+    """Returns a copy of the given sections with the warnings of all sections
+    and rating results set according to the number of answers in comparison
+    to the other sections of the same questionnaire."""
 
     # calculate the median values of how many people answered a questionnaire type (lecturer, tutor, ...)
     questionnaire_med_answers = defaultdict(list)
-    questionnaire_max_answers = {}
+    section_max_answers = []
     questionnaire_warning_thresholds = {}
-    for questionnaire, contribution in questionnaires_and_contributions(course):
-        max_answers = max([get_number_of_answers(contribution, question) for question in questionnaire.rating_questions], default=0)
-        questionnaire_max_answers[(questionnaire, contribution)] = max_answers
-        questionnaire_med_answers[questionnaire].append(max_answers)
+    for section in sections:
+        max_answers = max([result.total_count for result in section.results if isinstance(result, RatingResult)], default=0)
+        section_max_answers.append(max_answers)
+        questionnaire_med_answers[section.questionnaire].append(max_answers)
     for questionnaire, max_answers in questionnaire_med_answers.items():
         questionnaire_warning_thresholds[questionnaire] = max(settings.RESULTS_WARNING_PERCENTAGE * median(max_answers), settings.RESULTS_WARNING_COUNT)
 
-    for questionnaire, contribution in questionnaires_and_contributions(course):
-        # will contain one object per question
-        results = []
-        for question in questionnaire.question_set.all():
-            if question.is_rating_question:
-                answer_counters = get_answers(contribution, question)
-                answers = get_answers_from_answer_counters(answer_counters)
-
-                total_count = len(answers)
-                average = avg(answers) if total_count > 0 else None
-                deviation = pstdev(answers, average) if total_count > 0 else None
-                counts = get_counts(answer_counters)
-                warning = total_count > 0 and total_count < questionnaire_warning_thresholds[questionnaire]
-
-                results.append(RatingResult(question, total_count, average, deviation, counts, warning))
-
-            elif question.is_text_question:
-                allowed_states = [TextAnswer.PRIVATE, TextAnswer.PUBLISHED]
-                answers = get_textanswers(contribution, question, allowed_states)
-                results.append(TextResult(question=question, answers=answers))
+    sections_with_warnings = []
+    for section, max_answers in zip(sections, section_max_answers):
+        threshold = questionnaire_warning_thresholds[section.questionnaire]
+        results = tuple(
+            result._replace(warning=result.total_count > 0 and result.total_count < threshold) if isinstance(result, RatingResult) else result
+            for result in section.results
+        )
+        sections_with_warnings.append(section._replace(results=results, warning=max_answers < threshold))
+    return tuple(sections_with_warnings)
 
-        section_warning = questionnaire_max_answers[(questionnaire, contribution)] < questionnaire_warning_thresholds[questionnaire]
 
-        sections.append(ResultSection(questionnaire, contribution.contributor, contribution.label, results, section_warning))
+def calculate_average_grades_and_deviation(course):
+    """Determines the final average grade and deviation for a course."""
+    snapshots, __ = _get_snapshots([course])
+    return _calculate_average_grades_and_deviation(snapshots[course.id])
+
+
+def with_grade_summaries(courses):
+    """Annotates the given queryset of courses with the `avg_grade` and
+    `avg_deviation` of their stored `CourseGradeSummary`, so they can be
+    sorted and filtered in the database. Both are None if the summary is
+    missing or has been created by an older version."""
+    def summary_field(name):
+        return Case(When(grade_summary__version=CourseGradeSummary.VERSION, then=F('grade_summary__' + name)), output_field=FloatField())
+
+    return courses.annotate(avg_grade=summary_field('average_grade'), avg_deviation=summary_field('average_deviation'))
+
+
+def complete_grade_summaries(semester, courses):
+    """Sets the `avg_grade` and `avg_deviation` of those of the given courses
+    annotated by `with_grade_summaries` that should have a stored grade
+    summary but whose summary is missing or outdated, e.g. before
+    refresh_results_cache has run. The courses need their `grade_summary`
+    selected. Their results are calculated together by
+    `calculate_results_for_semester`. Returns an OrderedDict mapping these
+    courses to their summaries, which are not stored."""
+    courses = [course for course in courses if course.state in GRADE_SUMMARY_STATES and not _has_current_grade_summary(course)]
+    if not courses:
+        return OrderedDict()
+
+    summaries = OrderedDict()
+    for course, results in calculate_results_for_semester(semester, courses).items():
+        course.avg_grade, course.avg_deviation = results.average_grade, results.average_deviation
+        counts = merge_counts(result.counts for section in results.sections for result in section.results if isinstance(result, RatingResult))
+        summaries[course] = _grade_summary(course, results.average_grade, results.average_deviation, counts)
+    return summaries
+
+
+def _has_current_grade_summary(course):
+    summary = getattr(course, 'grade_summary', None)
+    return summary is not None and summary.version == CourseGradeSummary.VERSION
+
+
+def update_grade_summaries(courses, snapshots=None):
+    """Calculates the grade summaries of the given courses and stores those of
+    courses in `GRADE_SUMMARY_STATES`. Returns a dict mapping course ids to
+    the summaries. Already known result snapshots of the courses can be
+    passed in."""
+    courses = list(courses)
+    if not courses:
+        return {}
+
+    if snapshots is None:
+        snapshots, __ = _get_snapshots(courses)
+    summaries = {course.id: _grade_summary_from_snapshot(course, snapshots[course.id]) for course in courses}
+
+    stored_summaries = [summaries[course.id] for course in courses if course.state in GRADE_SUMMARY_STATES]
+    if stored_summaries:
+        try:
+            with transaction.atomic():
+                CourseGradeSummary.objects.filter(course__in=[summary.course_id for summary in stored_summaries]).delete()
+                CourseGradeSummary.objects.bulk_create(stored_summaries)
+        except IntegrityError:
+            # another request has stored the summaries in the meantime
+            pass
+    return summaries
+
+
+def update_grade_summary_for_answer(answer):
+    """Recalculates the stored grade summary of the course of a rating answer
+    counter that has been changed, created or deleted. The results are
+    calculated without filling the results cache."""
+    course = answer.contribution.course
+    if course.state in GRADE_SUMMARY_STATES:
+        snapshots, __ = _calculate_snapshots([course])
+        update_grade_summaries([course], snapshots)
+
+
+def get_single_result_rating_result(summary, question):
+    """Returns the `RatingResult` of a single result course from its grade
+    summary, as all of its answers belong to its single question."""
+    result = _calculate_rating_result(question, summary.counts)
+    section = ResultSection(None, None, None, (result,), False)
+    return _calculate_warnings([section])[0].results[0]
+
+
+def _grade_summary_from_snapshot(course, snapshot):
+    average_grade, average_deviation = _calculate_average_grades_and_deviation(snapshot)
+    counts = merge_counts(
+        _counts_from_record(data)
+        for __, __, __, results in snapshot[1]
+        for __, question_type, data in results if question_type != "T"
+    )
+    return _grade_summary(course, average_grade, average_deviation, counts)
 
-    return sections
 
+def _grade_summary(course, average_grade, average_deviation, counts):
+    return CourseGradeSummary(
+        course=course,
+        average_grade=average_grade,
+        average_deviation=average_deviation,
+        version=CourseGradeSummary.VERSION,
+        **{'answer_{}_count'.format(answer): count for answer, count in counts.items()}
+    )
 
-def calculate_average_grades_and_deviation(course):
-    """Determines the final average grade and deviation for a course."""
+
+def _calculate_average_grades_and_deviation(snapshot):
+    """Calculates the final average grade and deviation directly from a result
+    snapshot, so no models have to be loaded."""
     avg_generic_likert = []
     avg_contribution_likert = []
     dev_generic_likert = []
@@ -160,16 +535,18 @@ def calculate_average_grades_and_deviation(course):
     dev_generic_grade = []
     dev_contribution_grade = []
 
-    for __, contributor, __, results, __ in calculate_results(course):
-        average_likert = avg([result.average for result in results if result.question.is_likert_question])
-        deviation_likert = avg([result.deviation for result in results if result.question.is_likert_question])
-        average_grade = avg([result.average for result in results if result.question.is_grade_question])
-        deviation_grade = avg([result.deviation for result in results if result.question.is_grade_question])
+    for __, __, contributor_id, results in snapshot[1]:
+        likert_counts = [_counts_from_record(data) for __, question_type, data in results if question_type == "L"]
+        grade_counts = [_counts_from_record(data) for __, question_type, data in results if question_type == "G"]
+        average_likert = avg([get_average(counts) for counts in likert_counts])
+        deviation_likert = avg([get_deviation(counts) for counts in likert_counts])
+        average_grade = avg([get_average(counts) for counts in grade_counts])
+        deviation_grade = avg([get_deviation(counts) for counts in grade_counts])
 
-        (avg_contribution_likert if contributor else avg_generic_likert).append(average_likert)
-        (dev_contribution_likert if contributor else dev_generic_likert).append(deviation_likert)
-        (avg_contribution_grade if contributor else avg_generic_grade).append(average_grade)
-        (dev_contribution_grade if contributor else dev_generic_grade).append(deviation_grade)
+        (avg_contribution_likert if contributor_id else avg_generic_likert).append(average_likert)
+        (dev_contribution_likert if contributor_id else dev_generic_likert).append(deviation_likert)
+        (avg_contribution_grade if contributor_id else avg_generic_grade).append(average_grade)
+        (dev_contribution_grade if contributor_id else dev_generic_grade).append(deviation_grade)
 
     # the final total grade will be calculated by the following formula (GP = GRADE_PERCENTAGE, CP = CONTRIBUTION_PERCENTAGE):
     # final_likert = CP * likert_answers_about_persons + (1-CP) * likert_answers_about_courses
@@ -187,12 +564,6 @@ def calculate_average_grades_and_deviation(course):
     return final_avg, final_dev
 
 
-def has_no_rating_answers(course, contributor, questionnaire):
-    questions = questionnaire.rating_questions
-    contribution = Contribution.objects.get(course=course, contributor=contributor)
-    return RatingAnswerCounter.objects.filter(question__in=questions, contribution=contribution).count() == 0
-
-
 def color_mix(color1, color2, fraction):
     return tuple(
         int(round(color1[i] * (1 - fraction) + color2[i] * fraction)) for i in range(3)
@@ -9,4 +9,5 @@ urlpatterns = [
     url(r"^$", views.index, name="index"),
     url(r"semester/(\d+)$", views.semester_detail, name="semester_detail"),
     url(r"semester/(\d+)/course/(\d+)$", views.course_detail, name="course_detail"),
+    url(r"cache_statistics$", views.cache_statistics, name="cache_statistics"),
 ]
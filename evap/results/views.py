@@ -1,11 +1,16 @@
 from collections import OrderedDict, namedtuple
 
 from django.core.exceptions import PermissionDenied
+from django.db.models import F
+from django.http import JsonResponse
 from django.shortcuts import get_object_or_404, render
 from django.contrib.auth.decorators import login_required
 
-from evap.evaluation.models import Semester, Degree, Contribution
-from evap.results.tools import calculate_results, calculate_average_grades_and_deviation, TextResult, RatingResult
+from evap.evaluation.auth import staff_required
+from evap.evaluation.models import CourseGradeSummary, Semester, Degree, Question, Questionnaire
+from evap.results.cache import results_cache
+from evap.results.tools import (calculate_average_grades_and_deviation, complete_grade_summaries, get_results_projection,
+                                get_single_result_rating_result, get_text_answer_visibility, with_grade_summaries, RatingResult)
 
 
 @login_required
@@ -19,26 +24,36 @@ def index(request):
 def semester_detail(request, semester_id):
     semester = get_object_or_404(Semester, id=semester_id)
     if request.user.is_reviewer:
-        courses = list(semester.course_set.filter(state__in=["in_evaluation", "evaluated", "reviewed", "published"]).prefetch_related("degrees"))
+        courses = semester.course_set.filter(state__in=["in_evaluation", "evaluated", "reviewed", "published"])
     else:
-        courses = list(semester.course_set.filter(state="published").prefetch_related("degrees"))
+        courses = semester.course_set.filter(state="published")
+    # the grades are read from the stored grade summaries
+    courses = with_grade_summaries(courses).select_related('grade_summary').prefetch_related("degrees")
+    courses = courses.order_by(F('avg_grade').asc(nulls_last=True), 'name_de')
 
     courses = [course for course in courses if course.can_user_see_course(request.user)]
 
-    # Annotate each course object with its grades.
-    for course in courses:
-        course.avg_grade, course.avg_deviation = calculate_average_grades_and_deviation(course)
+    # courses without a current summary, e.g. before refresh_results_cache has run, are calculated together
+    calculated_summaries = complete_grade_summaries(semester, courses)
+    if calculated_summaries:
+        courses.sort(key=lambda course: (course.avg_grade is None, course.avg_grade or 0, course.name_de))
 
     CourseTuple = namedtuple('CourseTuple', ('courses', 'single_results'))
 
     courses_by_degree = OrderedDict()
     for degree in Degree.objects.all():
         courses_by_degree[degree] = CourseTuple([], [])
+    single_result_question = None
     for course in courses:
         if course.is_single_result:
+            if single_result_question is None:
+                single_result_question = Question.objects.filter(questionnaire__name_en=Questionnaire.SINGLE_RESULT_QUESTIONNAIRE_NAME).first()
+            summary = calculated_summaries.get(course) or getattr(course, 'grade_summary', None)
+            if summary is None or summary.version != CourseGradeSummary.VERSION:
+                # single results in other states than GRADE_SUMMARY_STATES are shown without answers
+                summary = CourseGradeSummary(course=course)
+            result = get_single_result_rating_result(summary, single_result_question)
             for degree in course.degrees.all():
-                section = calculate_results(course)[0]
-                result = section.results[0]
                 courses_by_degree[degree].single_results.append((course, result))
         else:
             for degree in course.degrees.all():
@@ -56,27 +71,11 @@ def course_detail(request, semester_id, course_id):
     if not course.can_user_see_results(request.user):
         raise PermissionDenied
 
-    sections = calculate_results(course)
-
     public_view = request.GET.get('public_view') == 'true'  # if parameter is not given, show own view.
 
-    represented_users = list(request.user.represented_users.all())
-    represented_users.append(request.user)
-
-    # filter text answers
-    for section in sections:
-        results = []
-        for result in section.results:
-            if isinstance(result, TextResult):
-                answers = [answer for answer in result.answers if user_can_see_text_answer(request.user, represented_users, answer, public_view)]
-                if answers:
-                    results.append(TextResult(question=result.question, answers=answers))
-            else:
-                results.append(result)
-        section.results[:] = results
-
-    # remove empty sections
-    sections = [section for section in sections if section.results]
+    # the cached results are shared, so only the projection for the user's visibility is used
+    visibility = get_text_answer_visibility(course, request.user, public_view)
+    sections = get_results_projection(course, visibility)
 
     # group by contributor
     course_sections = []
@@ -122,22 +121,7 @@ def course_detail(request, semester_id, course_id):
     return render(request, "results_course_detail.html", template_data)
 
 
-def user_can_see_text_answer(user, represented_users, text_answer, public_view=False):
-    if public_view:
-        return False
-    if user.is_reviewer:
-        return True
-    contributor = text_answer.contribution.contributor
-    if text_answer.is_private:
-        return contributor == user
-    if text_answer.is_published:
-        if contributor in represented_users:
-            return True
-        if text_answer.contribution.course.contributions.filter(
-                contributor__in=represented_users, comment_visibility=Contribution.ALL_COMMENTS).exists():
-            return True
-        if text_answer.contribution.is_general and text_answer.contribution.course.contributions.filter(
-                contributor__in=represented_users, comment_visibility=Contribution.COURSE_COMMENTS).exists():
-            return True
-
-    return False
+@staff_required
+def cache_statistics(request):
+    """The statistics of the in-memory results cache of the process handling the request, for monitoring."""
+    return JsonResponse(results_cache.statistics())
@@ -109,6 +109,23 @@ CACHES = {
     }
 }
 
+# the results are additionally cached in the memory of each process, limited by the number of entries and their pickled size
+RESULTS_LOCAL_CACHE_MAX_ENTRIES = 500
+RESULTS_LOCAL_CACHE_MAX_BYTES = 32 * 1024 * 1024
+
+# the votes for each rating answer are spread randomly across this many database rows, so that concurrent voters
+# don't wait for each other's row locks. the shards can be merged with the compact_rating_answer_counters command.
+RATING_ANSWER_COUNTER_SHARDS = 1
+
+# if enabled, votes are only queued when submitted and added to the answers by the process_vote_queue command,
+# which should then run regularly (e.g. every minute). this keeps the transactions of the vote view short.
+VOTE_QUEUE_ENABLED = False
+
+# if enabled, the roles of a user (e.g. staff, participant, editor) are kept in their session until their roles
+# change, instead of being loaded in each request. this needs one cache lookup per request instead of one query,
+# so it only pays off if the cache is faster than the database.
+USER_ROLES_SESSION_CACHE = False
+
 # Config for feedback links
 FEEDBACK_EMAIL = "webmaster@localhost"
 TRACKER_URL = "https://github.com/fsr-itse/EvaP"
@@ -116,6 +133,19 @@ TRACKER_URL = "https://github.com/fsr-itse/EvaP"
 # Config for mail system
 DEFAULT_FROM_EMAIL = "webmaster@localhost"
 REPLY_TO_EMAIL = DEFAULT_FROM_EMAIL
+# the number of recipients whose emails are sent over one connection to the mail server
+EMAIL_BATCH_SIZE = 100
+
+# if enabled, mass emails are stored in the outbox and sent by the send_outbox command, which should then run regularly
+# (e.g. every minute), so that slow mail servers don't block requests and cron jobs. the command sends at most
+# EMAIL_OUTBOX_RATE_LIMIT emails per second, retries failed emails after 1, 2, 4, ... times EMAIL_OUTBOX_RETRY_DELAY
+# seconds and gives up after EMAIL_OUTBOX_MAX_ATTEMPTS attempts. the failed emails are listed in the outbox staff page.
+# sent emails are deleted by the command after EMAIL_OUTBOX_RETENTION_DAYS days, as they might contain login urls.
+EMAIL_OUTBOX_ENABLED = False
+EMAIL_OUTBOX_RATE_LIMIT = 10
+EMAIL_OUTBOX_RETRY_DELAY = 60
+EMAIL_OUTBOX_MAX_ATTEMPTS = 5
+EMAIL_OUTBOX_RETENTION_DAYS = 30
 if DEBUG:
     EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
 
@@ -198,6 +228,7 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'django.middleware.locale.LocaleMiddleware',
     'evap.evaluation.auth.RequestAuthMiddleware',
+    'evap.evaluation.auth.UserRolesMiddleware',
 ]
 
 TEMPLATES = [
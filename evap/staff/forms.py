@@ -233,6 +233,7 @@ class SingleResultForm(forms.ModelForm):
         self.instance.vote_start_date = self.cleaned_data['event_date']
         self.instance.vote_end_date = self.cleaned_data['event_date']
         self.instance.is_graded = False
+        self.instance.is_single_result = True
         super().save(*args, **kw)
 
         single_result_questionnaire = Questionnaire.single_result_questionnaire()
@@ -509,9 +510,7 @@ class UserForm(forms.ModelForm):
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        courses_in_active_semester = Course.objects.filter(semester=Semester.active_semester())
-        excludes = [x.id for x in courses_in_active_semester if x.is_single_result]
-        courses_in_active_semester = courses_in_active_semester.exclude(id__in=excludes)
+        courses_in_active_semester = Course.objects.filter(semester=Semester.active_semester(), is_single_result=False)
         self.fields['courses_participating_in'].queryset = courses_in_active_semester
         if self.instance.pk:
             self.fields['courses_participating_in'].initial = courses_in_active_semester.filter(participants=self.instance)
@@ -108,6 +108,7 @@ class SingleResultFormTests(TestCase):
         form.save(user=mommy.make(UserProfile))
 
         course = Course.objects.get()
+        self.assertTrue(course.is_single_result)
         self.assertEqual(course.num_participants, 10)
         self.assertEqual(course.num_voters, 10)
 
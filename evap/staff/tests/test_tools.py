@@ -3,7 +3,7 @@ from django.contrib.auth.models import Group
 
 from model_mommy import mommy
 
-from evap.evaluation.models import UserProfile, Course, Contribution
+from evap.evaluation.models import UserProfile, Course, Contribution, get_user_roles_version
 from evap.rewards.models import RewardPointGranting, RewardPointRedemption
 from evap.staff.tools import merge_users
 
@@ -92,6 +92,7 @@ class MergeUsersTest(TestCase):
         additional_handled_attrs = {
             'grades_last_modified_user+',
             'course_last_modified_user+',
+            'outbox_messages',
         }
 
         actual_attrs = handled_attrs | additional_handled_attrs
@@ -166,3 +167,14 @@ class MergeUsersTest(TestCase):
         self.assertTrue(RewardPointRedemption.objects.filter(user_profile=self.main_user).exists())
         self.assertFalse(RewardPointGranting.objects.filter(user_profile=self.other_user).exists())
         self.assertFalse(RewardPointRedemption.objects.filter(user_profile=self.other_user).exists())
+
+    def test_merge_changes_roles_version(self):
+        main_user = mommy.make(UserProfile)
+        other_user = mommy.make(UserProfile, contributions=[mommy.make(Contribution)])
+        version = get_user_roles_version(main_user.pk)
+
+        # the contribution is reassigned without sending any signals
+        merge_users(main_user, other_user)
+
+        self.assertNotEqual(get_user_roles_version(main_user.pk), version)
+        self.assertTrue(UserProfile.objects.get(pk=main_user.pk).is_contributor)
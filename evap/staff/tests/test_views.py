@@ -10,7 +10,7 @@ from model_mommy import mommy
 import xlrd
 
 from evap.evaluation.models import Semester, UserProfile, Course, CourseType, TextAnswer, Contribution, \
-                                   Questionnaire, Question, EmailTemplate, Degree, FaqSection, FaqQuestion
+                                   Questionnaire, Question, EmailTemplate, Degree, FaqSection, FaqQuestion, OutboxMessage
 from evap.evaluation.tests.tools import FuzzyInt, WebTest, ViewTest
 from evap.staff.tools import generate_import_filename
 
@@ -764,7 +764,6 @@ class TestCourseEditView(ViewTest):
         semester = mommy.make(Semester, pk=1)
         course = mommy.make(Course, semester=semester, pk=1)
 
-        # This is necessary so that the call to is_single_result does not fail.
         user = mommy.make(UserProfile)
         mommy.make(Contribution, course=course, contributor=user, responsible=True, can_edit=True, comment_visibility=Contribution.ALL_COMMENTS)
 
@@ -1231,6 +1230,33 @@ class TestTemplateEditView(ViewTest):
         self.assertEqual(EmailTemplate.objects.get(pk=1).body, "body: mflkd862xmnbo5")
 
 
+class TestOutboxView(ViewTest):
+    url = "/staff/outbox/"
+    test_users = ['staff']
+
+    @classmethod
+    def setUpTestData(cls):
+        mommy.make(UserProfile, username='staff', groups=[Group.objects.get(name='Staff')])
+
+    def test_retry_failed_emails(self):
+        user = mommy.make(UserProfile, first_name="Failed", last_name="Recipient")
+        mommy.make(OutboxMessage, user=user, subject="queued subject", state=OutboxMessage.QUEUED)
+        mommy.make(OutboxMessage, user=user, subject="failed subject", state=OutboxMessage.FAILED, attempts=5, last_error="SMTPException: unavailable")
+
+        page = self.get_assert_200(self.url, "staff")
+        self.assertIn("queued subject", page)
+        self.assertIn("failed subject", page)
+        self.assertIn("SMTPException: unavailable", page)
+
+        page = page.forms["retry-form"].submit().follow()
+        self.assertIn("Successfully queued 1 failed email again.", page)
+        self.assertFalse(OutboxMessage.objects.filter(state=OutboxMessage.FAILED).exists())
+
+    def test_retry_requires_post(self):
+        response = self.app.get("/staff/outbox/retry", user="staff", expect_errors=True)
+        self.assertEqual(response.status_code, 405)
+
+
 class TestDegreeView(ViewTest):
     url = "/staff/degrees/"
     test_users = ['staff']
@@ -13,7 +13,7 @@ from django.conf import settings
 from django.utils.translation import ugettext_lazy as _
 from django.utils.safestring import mark_safe
 
-from evap.evaluation.models import UserProfile, Course, Contribution
+from evap.evaluation.models import UserProfile, Course, Contribution, OutboxMessage, invalidate_user_roles
 from evap.grades.models import GradeDocument
 from evap.results.tools import calculate_results
 
@@ -139,6 +139,9 @@ def merge_users(main_user, other_user, preview=False):
     Course.objects.filter(last_modified_user=other_user).update(last_modified_user=main_user)
     GradeDocument.objects.filter(last_modified_user=other_user).update(last_modified_user=main_user)
 
+    # keep the emails to other_user on the outbox page
+    OutboxMessage.objects.filter(user=other_user).update(user=main_user)
+
     # email must not exist twice. other_user can't be deleted before contributions have been changed
     other_user.email = ""
     other_user.save()
@@ -152,6 +155,9 @@ def merge_users(main_user, other_user, preview=False):
             setattr(main_user, key, value)  # use direct assignment for everything else
     main_user.save()
 
+    # the contributions have been reassigned with QuerySet.update, which doesn't send any signals
+    invalidate_user_roles([main_user.pk, other_user.pk])
+
     # delete rewards
     other_user.reward_point_grantings.all().delete()
     other_user.reward_point_redemptions.all().delete()
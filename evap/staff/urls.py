@@ -64,6 +64,9 @@ urlpatterns = [
     url(r"^template/$", RedirectView.as_view(url='/staff/', permanent=True)),
     url(r"^template/(\d+)$", views.template_edit, name="template_edit"),
 
+    url(r"^outbox/$", views.outbox, name="outbox"),
+    url(r"^outbox/retry$", views.outbox_retry, name="outbox_retry"),
+
     url(r"faq/$", views.faq_index, name="faq_index"),
     url(r"faq/(\d+)$", views.faq_section, name="faq_section"),
 ]
@@ -3,10 +3,11 @@ import datetime
 import random
 from collections import OrderedDict, defaultdict
 
+from django.conf import settings
 from django.contrib import messages
 from django.core.exceptions import PermissionDenied, SuspiciousOperation
 from django.db import IntegrityError, transaction
-from django.db.models import BooleanField, Case, Count, ExpressionWrapper, IntegerField, Max, Prefetch, Q, Sum, When
+from django.db.models import BooleanField, Case, Count, Exists, ExpressionWrapper, IntegerField, Max, OuterRef, Prefetch, Q, Sum, When
 from django.forms import formset_factory
 from django.forms.models import inlineformset_factory, modelformset_factory
 from django.http import HttpResponse, HttpResponseRedirect
@@ -16,12 +17,12 @@ from django.utils.translation import ugettext as _
 from django.utils.translation import get_language, ungettext
 from django.views.decorators.http import require_POST
 from evap.evaluation.auth import reviewer_required, staff_required
-from evap.evaluation.models import (Contribution, Course, CourseType, Degree, EmailTemplate, FaqQuestion, FaqSection, Question, Questionnaire,
-                                    Semester, TextAnswer, UserProfile)
+from evap.evaluation.models import (Contribution, Course, CourseType, Degree, EmailTemplate, FaqQuestion, FaqSection, OutboxMessage, Question,
+                                    Questionnaire, Semester, TextAnswer, UserProfile)
 from evap.evaluation.tools import STATES_ORDERED, questionnaires_and_contributions, send_publish_notifications, sort_formset
 from evap.grades.tools import are_grades_activated
 from evap.results.exporters import ExcelExporter
-from evap.results.tools import CommentSection, TextResult, calculate_average_grades_and_deviation, get_textanswers
+from evap.results.tools import CommentSection, TextResult, complete_grade_summaries, get_textanswers, with_grade_summaries
 from evap.rewards.models import RewardPointGranting
 from evap.rewards.tools import can_user_use_reward_points, is_semester_activated
 from evap.staff.forms import (AtLeastOneFormSet, ContributionForm, ContributionFormSet, CourseEmailForm, CourseForm, CourseParticipantCopyForm,
@@ -54,17 +55,12 @@ def get_courses_with_prefetched_data(semester):
         Prefetch("contributions", queryset=Contribution.objects.filter(responsible=True).select_related("contributor"), to_attr="responsible_contributions"),
         Prefetch("contributions", queryset=Contribution.objects.filter(contributor=None), to_attr="general_contribution"),
         "degrees")
-    participant_counts = semester.course_set.annotate(num_participants=Count("participants")).values_list("num_participants", flat=True)
-    voter_counts = semester.course_set.annotate(num_voters=Count("voters")).values_list("num_voters", flat=True)
     textanswer_counts = semester.course_set.annotate(num_textanswers=Count("contributions__textanswer_set")).values_list("num_textanswers", flat=True)
 
-    for course, participant_count, voter_count, textanswer_count in zip(courses, participant_counts, voter_counts, textanswer_counts):
+    for course, textanswer_count in zip(courses, textanswer_counts):
         course.general_contribution = course.general_contribution[0]
         course.responsible_contributors = [contribution.contributor for contribution in course.responsible_contributions]
         course.num_textanswers = textanswer_count
-        if course._participant_count is None:
-            course.num_voters = voter_count
-            course.num_participants = participant_count
     return courses
 
 
@@ -401,9 +397,10 @@ def semester_raw_export(request, semester_id):
     writer = csv.writer(response, delimiter=";")
     writer.writerow([_('Name'), _('Degrees'), _('Type'), _('Single result'), _('State'), _('#Voters'),
         _('#Participants'), _('#Comments'), _('Average grade')])
-    for course in semester.course_set.all():
+    courses = list(with_grade_summaries(semester.course_set.all()).select_related('grade_summary'))
+    complete_grade_summaries(semester, courses)
+    for course in courses:
         degrees = ", ".join([degree.name for degree in course.degrees.all()])
-        course.avg_grade, course.avg_deviation = calculate_average_grades_and_deviation(course)
         if course.state in ['evaluated', 'reviewed', 'published'] and course.avg_grade is not None:
             avg_grade = "{:.1f}".format(course.avg_grade)
         else:
@@ -1071,6 +1068,7 @@ def user_index(request):
         .annotate(is_reviewer=ExpressionWrapper(Q(reviewer_group_count__exact=1), output_field=BooleanField()))
         .annotate(grade_publisher_group_count=Sum(Case(When(groups__name="Grade publisher", then=1), output_field=IntegerField())))
         .annotate(is_grade_publisher=ExpressionWrapper(Q(grade_publisher_group_count__exact=1), output_field=BooleanField()))
+        .annotate(is_contributor=Exists(Contribution.objects.filter(contributor=OuterRef('pk'))))
         .prefetch_related('contributions', 'courses_participating_in', 'courses_participating_in__semester', 'represented_users', 'ccing_users'))
 
     return render(request, "staff_user_index.html", dict(users=users))
@@ -1215,6 +1213,27 @@ def template_edit(request, template_id):
         return render(request, "staff_template_form.html", dict(form=form, template=template))
 
 
+@staff_required
+def outbox(request):
+    state_counts = dict(OutboxMessage.objects.order_by().values_list('state').annotate(Count('id')))
+    template_data = dict(
+        state_counts=[(label, state_counts.get(state, 0)) for state, label in OutboxMessage.STATES],
+        queued_messages=OutboxMessage.objects.filter(state=OutboxMessage.QUEUED).select_related('user').order_by('next_attempt_time', 'id')[:100],
+        failed_messages=OutboxMessage.objects.filter(state=OutboxMessage.FAILED).select_related('user')[:100],
+        outbox_enabled=settings.EMAIL_OUTBOX_ENABLED,
+    )
+    return render(request, "staff_outbox.html", template_data)
+
+
+@require_POST
+@staff_required
+def outbox_retry(request):
+    retried_count = OutboxMessage.retry_failed()
+    messages.success(request, ungettext("Successfully queued %(emails)d failed email again.",
+        "Successfully queued %(emails)d failed emails again.", retried_count) % {'emails': retried_count})
+    return redirect('staff:outbox')
+
+
 @staff_required
 def faq_index(request):
     sections = FaqSection.objects.all()
@@ -1,5 +1,12 @@
+from collections import namedtuple
+
 from django import forms
+from django.conf import settings
+from django.core.signals import request_finished, request_started
+from django.utils.translation import get_language
 
+from evap.evaluation.cache import TwoTierCache
+from evap.evaluation.models import Question
 from evap.student.tools import make_form_identifier
 from evap.evaluation.tools import LIKERT_NAMES, GRADE_NAMES
 
@@ -7,32 +14,77 @@ from evap.evaluation.tools import LIKERT_NAMES, GRADE_NAMES
 LIKERT_CHOICES = [(str(k), v) for k, v in LIKERT_NAMES.items()]
 GRADE_CHOICES = [(str(k), v) for k, v in GRADE_NAMES.items()]
 
+# a question of a voting form with its texts in all languages, see get_form_specs
+FieldSpec = namedtuple('FieldSpec', ('id', 'type', 'labels'))
+
+# the form specs are kept in the cache and in the memory of each process
+FORM_SPEC_LOCAL_CACHE_MAX_ENTRIES = 200
+FORM_SPEC_LOCAL_CACHE_MAX_BYTES = 4 * 1024 * 1024
+form_spec_cache = TwoTierCache('evap.student.forms.version-', FORM_SPEC_LOCAL_CACHE_MAX_ENTRIES, FORM_SPEC_LOCAL_CACHE_MAX_BYTES)
+request_started.connect(form_spec_cache.request_started, dispatch_uid='evap.student.forms.request_started')
+request_finished.connect(form_spec_cache.request_finished, dispatch_uid='evap.student.forms.request_finished')
+
+
+def get_form_spec_cache_key(questionnaire_id):
+    return 'evap.student.forms.form_spec-{:d}'.format(questionnaire_id)
+
+
+def get_form_specs(questionnaires):
+    """Returns a dict mapping the ids of the given questionnaires to tuples of
+    `FieldSpec`s, one for each of their questions. Specs that are not cached
+    yet are loaded with a single query."""
+    cache_keys = {questionnaire.id: get_form_spec_cache_key(questionnaire.id) for questionnaire in questionnaires}
+    cached_specs = form_spec_cache.get_many(list(cache_keys.values()))
+    form_specs = {questionnaire_id: cached_specs[cache_key] for questionnaire_id, cache_key in cache_keys.items() if cache_key in cached_specs}
+
+    missing_questionnaire_ids = [questionnaire_id for questionnaire_id in cache_keys if questionnaire_id not in form_specs]
+    if missing_questionnaire_ids:
+        field_specs = {questionnaire_id: [] for questionnaire_id in missing_questionnaire_ids}
+        for question in Question.objects.filter(questionnaire_id__in=missing_questionnaire_ids):
+            labels = {language: getattr(question, 'text_' + language) for language, __ in settings.LANGUAGES}
+            field_specs[question.questionnaire_id].append(FieldSpec(question.id, question.type, labels))
+        new_form_specs = {questionnaire_id: tuple(specs) for questionnaire_id, specs in field_specs.items()}
+        form_spec_cache.set_many({cache_keys[questionnaire_id]: specs for questionnaire_id, specs in new_form_specs.items()})
+        form_specs.update(new_form_specs)
+
+    return form_specs
+
+
+def invalidate_form_spec(questionnaire_id):
+    form_spec_cache.delete(get_form_spec_cache_key(questionnaire_id))
+
 
 class QuestionsForm(forms.Form):
     """Dynamic form class that adds one field per question. Pass the arguments
-    `contribution` and `questionnaire` to the constructor.
+    `contribution` and `questionnaire` to the constructor. The questionnaire's
+    `FieldSpec`s can be passed as `form_spec`, otherwise they are loaded.
 
     See http://jacobian.org/writing/dynamic-form-generation/"""
 
     def __init__(self, *args, **kwargs):
         self.contribution = kwargs.pop('contribution')
         self.questionnaire = kwargs.pop('questionnaire')
+        form_spec = kwargs.pop('form_spec', None)
+        if form_spec is None:
+            form_spec = get_form_specs([self.questionnaire])[self.questionnaire.id]
 
         super().__init__(*args, **kwargs)
 
-        for question in self.questionnaire.question_set.all():
+        # pairs of the field identifiers and their specs
+        self.field_specs = []
+        for field_spec in form_spec:
             # generic arguments for all kinds of fields
-            field_args = dict(label=question.text)
+            field_args = dict(label=field_spec.labels.get(get_language(), field_spec.labels[settings.LANGUAGE_CODE]))
 
-            if question.is_text_question:
+            if field_spec.type == "T":
                 field = forms.CharField(required=False, widget=forms.Textarea(),
                                         **field_args)
-            elif question.is_likert_question:
+            elif field_spec.type == "L":
                 field = forms.TypedChoiceField(widget=forms.RadioSelect(),
                                                choices=LIKERT_CHOICES,
                                                coerce=int,
                                                **field_args)
-            elif question.is_grade_question:
+            elif field_spec.type == "G":
                 field = forms.TypedChoiceField(widget=forms.RadioSelect(),
                                                choices=GRADE_CHOICES,
                                                coerce=int,
@@ -40,8 +92,9 @@ class QuestionsForm(forms.Form):
 
             identifier = make_form_identifier(self.contribution,
                                               self.questionnaire,
-                                              question)
+                                              field_spec)
             self.fields[identifier] = field
+            self.field_specs.append((identifier, field_spec))
 
     def caption(self):
         return self.questionnaire.public_name
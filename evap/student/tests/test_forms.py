@@ -0,0 +1,48 @@
+from django.test import TestCase
+from django.utils import translation
+
+from model_mommy import mommy
+
+from evap.evaluation.models import Contribution, Question, Questionnaire
+from evap.student.forms import QuestionsForm, form_spec_cache, get_form_specs
+
+
+class TestFormSpecs(TestCase):
+    def setUp(self):
+        form_spec_cache.clear_local()
+        self.questionnaire = mommy.make(Questionnaire)
+        self.question = mommy.make(Question, questionnaire=self.questionnaire, type="G", text_de="Frage", text_en="question")
+
+    def test_form_has_field_per_question(self):
+        mommy.make(Question, questionnaire=self.questionnaire, type="T")
+        contribution = mommy.make(Contribution)
+
+        with translation.override('de'):
+            form = QuestionsForm(contribution=contribution, questionnaire=self.questionnaire)
+
+        self.assertEqual(len(form.fields), 2)
+        identifier = "question_{}_{}_{}".format(contribution.id, self.questionnaire.id, self.question.id)
+        self.assertEqual(form.fields[identifier].label, "Frage")
+
+    def test_specs_are_cached(self):
+        other_questionnaire = mommy.make(Questionnaire)
+        get_form_specs([self.questionnaire, other_questionnaire])
+
+        # only the checks of the versions, as the database cache loads each key separately
+        with self.assertNumQueries(2):
+            form_specs = get_form_specs([self.questionnaire, other_questionnaire])
+
+        self.assertEqual(form_specs[other_questionnaire.id], ())
+
+    def test_question_change_invalidates_spec(self):
+        get_form_specs([self.questionnaire])
+
+        self.question.text_en = "changed question"
+        self.question.save()
+        self.assertEqual(get_form_specs([self.questionnaire])[self.questionnaire.id][0].labels['en'], "changed question")
+
+        mommy.make(Question, questionnaire=self.questionnaire, type="L")
+        self.assertEqual(len(get_form_specs([self.questionnaire])[self.questionnaire.id]), 2)
+
+        self.question.delete()
+        self.assertEqual(len(get_form_specs([self.questionnaire])[self.questionnaire.id]), 1)
@@ -1,8 +1,11 @@
-from django.test.utils import override_settings
+from datetime import date
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext, override_settings
 from django.urls import reverse
 from model_mommy import mommy
 
-from evap.evaluation.models import UserProfile, Course, Questionnaire, Question, Contribution
+from evap.evaluation.models import UserProfile, Course, Semester, Questionnaire, Question, Contribution, QueuedBallot, RatingAnswerCounter, TextAnswer
 from evap.evaluation.tests.tools import WebTest, ViewTest
 
 
@@ -12,8 +15,32 @@ class TestStudentIndexView(ViewTest):
 
     def setUp(self):
         # View is only visible to users participating in at least one course.
-        user = mommy.make(UserProfile, username='student')
-        mommy.make(Course, participants=[user])
+        self.user = mommy.make(UserProfile, username='student')
+        mommy.make(Course, participants=[self.user])
+
+    def test_number_of_queries_is_independent_of_number_of_courses(self):
+        def make_courses(semester):
+            for state in ['prepared', 'in_evaluation', 'evaluated', 'published']:
+                course = mommy.make(Course, semester=semester, state=state, participants=[self.user], vote_start_date=date(2000, 1, 1), vote_end_date=date(2000, 1, 2))
+                if state != 'in_evaluation':
+                    course.voters.add(self.user)
+
+        def get_index_page():
+            with CaptureQueriesContext(connection) as context:
+                page = self.app.get(self.url, user='student')
+            return page, len(context)
+
+        make_courses(mommy.make(Semester))
+        # the first request fills the template fragment cache of the navbar
+        get_index_page()
+        __, query_count = get_index_page()
+        for __ in range(3):
+            make_courses(mommy.make(Semester))
+        page, more_courses_query_count = get_index_page()
+
+        self.assertEqual(query_count, more_courses_query_count)
+        self.assertEqual(page.body.count(b'You already evaluated this course'), 0)
+        self.assertEqual(page.body.count(b'btn btn-sm btn-primary'), 4)
 
 
 @override_settings(INSTITUTION_EMAIL_DOMAINS=["example.com"])
@@ -78,3 +105,70 @@ class TestVoteView(WebTest):
         response = get_vote_page(student)
         self.assertTrue(any(contributor == contributor1 for contributor, _, _, _ in response.context['contributor_form_groups']),
             "Regular students should see the questionnaire about a contributor")
+
+    def test_number_of_queries_is_independent_of_number_of_questions(self):
+        student = mommy.make(UserProfile)
+        contributor = mommy.make(UserProfile)
+
+        def vote_on_course(number_of_questions):
+            course = mommy.make(Course, state='in_evaluation', participants=[student])
+            questionnaire = mommy.make(Questionnaire)
+            questions = [mommy.make(Question, questionnaire=questionnaire, type=question_type) for question_type in "GLT" * number_of_questions]
+            course.general_contribution.questionnaires.set([questionnaire])
+            contribution = mommy.make(Contribution, contributor=contributor, course=course, questionnaires=[questionnaire])
+            # an existing counter is incremented
+            mommy.make(RatingAnswerCounter, question=questions[0], contribution=contribution, answer=1, count=2)
+
+            form = self.app.get(reverse('student:vote', kwargs={'course_id': course.id}), user=student).forms["student-vote-form"]
+            for contribution_to_vote_on in [course.general_contribution, contribution]:
+                for question in questions:
+                    field = "question_{}_{}_{}".format(contribution_to_vote_on.id, questionnaire.id, question.id)
+                    form[field] = "some text" if question.is_text_question else 1
+            with CaptureQueriesContext(connection) as context:
+                form.submit()
+
+            self.assertEqual(RatingAnswerCounter.objects.get(question=questions[0], contribution=contribution, answer=1).count, 3)
+            self.assertEqual(RatingAnswerCounter.objects.filter(contribution__course=course).count(), 4 * number_of_questions)
+            self.assertEqual(TextAnswer.objects.filter(contribution__course=course).count(), 2 * number_of_questions)
+            return len(context)
+
+        self.assertEqual(vote_on_course(1), vote_on_course(10))
+
+    @override_settings(VOTE_QUEUE_ENABLED=True)
+    def test_vote_is_queued(self):
+        student = mommy.make(UserProfile)
+        course = mommy.make(Course, state='in_evaluation', participants=[student])
+        questionnaire = mommy.make(Questionnaire)
+        rating_question = mommy.make(Question, questionnaire=questionnaire, type="G")
+        text_question = mommy.make(Question, questionnaire=questionnaire, type="T")
+        course.general_contribution.questionnaires.set([questionnaire])
+
+        form = self.app.get(reverse('student:vote', kwargs={'course_id': course.id}), user=student).forms["student-vote-form"]
+        form["question_{}_{}_{}".format(course.general_contribution.id, questionnaire.id, rating_question.id)] = 2
+        form["question_{}_{}_{}".format(course.general_contribution.id, questionnaire.id, text_question.id)] = "some text"
+        form.submit()
+
+        self.assertEqual(list(course.voters.all()), [student])
+        self.assertFalse(RatingAnswerCounter.objects.filter(contribution__course=course).exists())
+        self.assertFalse(TextAnswer.objects.filter(contribution__course=course).exists())
+        ballot = QueuedBallot.objects.get(course=course)
+        self.assertEqual(ballot.get_rating_votes(), [(course.general_contribution.id, rating_question.id, 2)])
+        self.assertEqual([text_answer.answer for text_answer in ballot.get_text_answers()], ["some text"])
+
+    def test_number_of_queries_is_independent_of_number_of_contributors(self):
+        student = mommy.make(UserProfile)
+        questionnaire = mommy.make(Questionnaire)
+        mommy.make(Question, questionnaire=questionnaire, type="G", _quantity=5)
+
+        def get_vote_page(number_of_contributors):
+            course = mommy.make(Course, state='in_evaluation', participants=[student])
+            course.general_contribution.questionnaires.set([questionnaire])
+            for __ in range(number_of_contributors):
+                mommy.make(Contribution, contributor=mommy.make(UserProfile), course=course, questionnaires=[questionnaire])
+            with CaptureQueriesContext(connection) as context:
+                self.app.get(reverse('student:vote', kwargs={'course_id': course.id}), user=student)
+            return len(context)
+
+        # the first request loads the questions into the cache
+        get_vote_page(1)
+        self.assertEqual(get_vote_page(1), get_vote_page(10))
@@ -1,3 +1,13 @@
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db.models import BooleanField, Case, Exists, IntegerField, OuterRef, Value, When
+from django.utils.translation import get_language
+
+from evap.evaluation.models import Course, STUDENT_STATES_NAMES
+from evap.evaluation.tools import STUDENT_STATES_ORDERED
+
+
 def make_form_identifier(contribution, questionnaire, question):
     """Generates a form field identifier for voting forms using the given
     parameters."""
@@ -6,3 +16,32 @@ def make_form_identifier(contribution, questionnaire, question):
         contribution.id,
         questionnaire.id,
         question.id)
+
+
+def get_student_courses_by_semester(user):
+    """Returns an OrderedDict mapping semesters to the courses the user
+    participates in, sorted by the student state, end of the evaluation and
+    name. The courses are loaded with a single query and annotated with
+    `has_voted`, `is_due` (whether the user still has to vote) and
+    `student_state_order`."""
+    student_state_order = Case(
+        *[When(state=state, then=Value(list(STUDENT_STATES_ORDERED.keys()).index(student_state))) for state, student_state in STUDENT_STATES_NAMES.items()],
+        output_field=IntegerField()
+    )
+    name_field = 'name_' + get_language()
+    if name_field not in [field.name for field in Course._meta.get_fields()]:
+        name_field = 'name_' + settings.LANGUAGE_CODE
+
+    courses = (Course.objects.filter(participants=user).exclude(state='new')
+               .annotate(
+                   has_voted=Exists(Course.voters.through.objects.filter(course_id=OuterRef('pk'), userprofile_id=user.id)),
+                   student_state_order=student_state_order)
+               .annotate(is_due=Case(When(state='in_evaluation', has_voted=False, then=Value(True)), default=Value(False), output_field=BooleanField()))
+               .select_related('semester', 'type')
+               .prefetch_related('grade_documents')
+               .order_by('-semester__created_at', 'semester__name_de', 'student_state_order', 'vote_end_date', name_field))
+
+    courses_by_semester = OrderedDict()
+    for course in courses:
+        courses_by_semester.setdefault(course.semester, []).append(course)
+    return courses_by_semester
@@ -7,30 +7,26 @@ from django.shortcuts import get_object_or_404, redirect, render
 from django.utils.translation import ugettext as _
 
 from evap.evaluation.auth import participant_required
-from evap.evaluation.models import Course, Semester
-from evap.evaluation.tools import STUDENT_STATES_ORDERED
+from evap.evaluation.models import Course, TextAnswer
+from evap.grades.models import SemesterGradeDownloadActivation
 
-from evap.student.forms import QuestionsForm
-from evap.student.tools import make_form_identifier
+from evap.student.forms import QuestionsForm, get_form_specs
+from evap.student.tools import get_student_courses_by_semester
 
 
 @participant_required
 def index(request):
-    # retrieve all courses, where the user is a participant and that are not new
-    courses = list(set(Course.objects.filter(participants=request.user).exclude(state="new")))
-    voted_courses = list(set(Course.objects.filter(voters=request.user)))
-    due_courses = list(set(Course.objects.filter(participants=request.user, state='in_evaluation').exclude(voters=request.user)))
+    courses_by_semester = get_student_courses_by_semester(request.user)
+    grades_activated_semester_ids = set(SemesterGradeDownloadActivation.objects.filter(
+        semester__in=courses_by_semester.keys(), is_active=True).values_list('semester_id', flat=True))
 
-    sorter = lambda course: (list(STUDENT_STATES_ORDERED.keys()).index(course.student_state), course.vote_end_date, course.name)
-    courses.sort(key=sorter)
-
-    semesters = Semester.objects.all()
-    semester_list = [dict(semester_name=semester.name, id=semester.id, courses=[course for course in courses if course.semester_id == semester.id]) for semester in semesters]
+    semester_list = [
+        dict(semester_name=semester.name, id=semester.id, courses=courses, grades_activated=semester.id in grades_activated_semester_ids)
+        for semester, courses in courses_by_semester.items()
+    ]
 
     template_data = dict(
         semester_list=semester_list,
-        voted_courses=voted_courses,
-        due_courses=due_courses,
         can_download_grades=request.user.can_download_grades,
     )
     return render(request, "student_index.html", template_data)
@@ -82,33 +78,24 @@ def vote(request, course_id):
         return render(request, "student_vote.html", template_data)
 
     # all forms are valid, begin vote operation
+    rating_votes = []
+    text_answers = []
+    for contribution, form_group in form_groups.items():
+        for questionnaire_form in form_group:
+            for identifier, field_spec in questionnaire_form.field_specs:
+                value = questionnaire_form.cleaned_data.get(identifier)
+
+                if field_spec.type == "T":
+                    if value:
+                        text_answers.append(TextAnswer(contribution=contribution, question_id=field_spec.id, answer=value))
+                else:
+                    if value != 6:
+                        rating_votes.append((contribution.id, field_spec.id, value))
+
     with transaction.atomic():
-        # add user to course.voters
-        # not using course.voters.add(request.user) since it fails silently when done twice.
-        # manually inserting like this gives us the 'created' return value and ensures at the database level that nobody votes twice.
-        __, created = course.voters.through.objects.get_or_create(userprofile_id=request.user.pk, course_id=course.pk)
-        if not created:  # vote already got recorded, bail out
+        if not course.add_ballot(request.user, rating_votes, text_answers):  # vote already got recorded, bail out
             raise SuspiciousOperation("A second vote has been received shortly after the first one.")
 
-        for contribution, form_group in form_groups.items():
-            for questionnaire_form in form_group:
-                questionnaire = questionnaire_form.questionnaire
-                for question in questionnaire.question_set.all():
-                    identifier = make_form_identifier(contribution, questionnaire, question)
-                    value = questionnaire_form.cleaned_data.get(identifier)
-
-                    if question.is_text_question:
-                        if value:
-                            question.answer_class.objects.create(
-                                contribution=contribution,
-                                question=question,
-                                answer=value)
-                    else:
-                        if value != 6:
-                            answer_counter, __ = question.answer_class.objects.get_or_create(contribution=contribution, question=question, answer=value)
-                            answer_counter.add_vote()
-                            answer_counter.save()
-
         course.course_evaluated.send(sender=Course, request=request, semester=course.semester)
 
     messages.success(request, _("Your vote was recorded."))
@@ -116,12 +103,18 @@ def vote(request, course_id):
 
 
 def helper_create_voting_form_groups(request, contributions):
+    contributions = list(contributions.select_related('contributor').prefetch_related('questionnaires'))
+    form_specs = get_form_specs({questionnaire for contribution in contributions for questionnaire in contribution.questionnaires.all()})
+
     form_groups = OrderedDict()
     for contribution in contributions:
         questionnaires = contribution.questionnaires.all()
-        if not questionnaires.exists():
+        if not questionnaires:
             continue
-        form_groups[contribution] = [QuestionsForm(request.POST or None, contribution=contribution, questionnaire=questionnaire) for questionnaire in questionnaires]
+        form_groups[contribution] = [
+            QuestionsForm(request.POST or None, contribution=contribution, questionnaire=questionnaire, form_spec=form_specs[questionnaire.id])
+            for questionnaire in questionnaires
+        ]
     return form_groups
 
 